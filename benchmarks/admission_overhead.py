@@ -0,0 +1,104 @@
+"""
+Gateway admission control micro-benchmark
+Measures the per-request cost of rate limiting and concurrency limiting in microseconds
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GATEWAY_DIR = os.path.join(ROOT, 'microservices', 'api-gateway')
+sys.path[:0] = [os.path.join(ROOT, 'microservices'), GATEWAY_DIR]
+os.environ.setdefault('TRACING_EXPORTER', 'none')
+
+
+def per_call(func, calls, repeats):
+    """Median microseconds per call over several timed runs"""
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for index in range(calls):
+            func(index)
+        runs.append((time.perf_counter() - started) / calls * 1e6)
+    return statistics.median(runs)
+
+
+def threaded_per_call(func, calls, threads):
+    """Wall-clock microseconds per call with threads calling concurrently"""
+    share = calls // threads
+
+    def worker():
+        for index in range(share):
+            func(index)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter() - started) / (share * threads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=1000, help='distinct client addresses in the mix')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--redis', default='', help='redis://... to time the shared bucket backend as well')
+    args = parser.parse_args()
+
+    os.environ.update(GATEWAY_RATE_LIMITS='*=1000000:1000000,orders=1000000:1000000', GATEWAY_MAX_CONCURRENCY='64')
+    from admission import ConcurrencyLimiter, LocalBuckets, RateLimiter, client_id, parse_rate_limits
+    import app as gateway
+
+    limits = parse_rate_limits(os.environ['GATEWAY_RATE_LIMITS'])
+    addresses = [f'10.0.{index // 256}.{index % 256}' for index in range(args.clients)]
+    buckets = LocalBuckets()
+    limiter = RateLimiter(limits)
+    concurrency = ConcurrencyLimiter('bench', 64)
+    headers = {'X-Forwarded-For': '203.0.113.7, 10.0.0.1'}
+
+    def acquire_release(_):
+        concurrency.acquire()
+        concurrency.release()
+
+    def hook(_):
+        gateway.admit_request()
+        gateway.release_admission()
+
+    results = [
+        ('client id from X-Forwarded-For', lambda _: client_id(headers, '10.0.0.2')),
+        ('one bucket, one client', lambda _: buckets.take('orders:10.0.0.1', 1e6, 1e6)),
+        (f'route + global buckets, {args.clients} clients',
+         lambda index: limiter.check(addresses[index % args.clients], 'orders')),
+        ('concurrency acquire + release', acquire_release),
+    ]
+    print(f"{'operation':46} {'us/call':>8}")
+    for label, func in results:
+        print(f"{label:46} {per_call(func, args.calls, args.repeats):>8.2f}")
+
+    with gateway.app.test_request_context('/api/orders', headers=headers):
+        print(f"{'before_request + teardown hooks, GET /api/orders':46} "
+              f"{per_call(hook, args.calls, args.repeats):>8.2f}")
+
+    contended = threaded_per_call(lambda index: limiter.check(addresses[index % args.clients], 'orders'),
+                                  args.calls, args.threads)
+    print(f"{f'route + global buckets, {args.threads} threads':46} {contended:>8.2f}")
+
+    if args.redis:
+        from admission import RedisBuckets
+        shared = RateLimiter(limits, RedisBuckets(args.redis))
+        calls = min(args.calls, 5000)
+        print(f"{'route + global buckets on Redis':46} "
+              f"{per_call(lambda index: shared.check(addresses[index % args.clients], 'orders'), calls, 3):>8.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+JSON serialization micro-benchmark
+Compares the per-row dict + jsonify path with precompiled row mappers and the fast JSON provider
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'microservices'))
+
+from flask import Flask  # noqa: E402
+
+from common import serialization  # noqa: E402
+from common.pagination import json_value  # noqa: E402
+
+ORDER_FIELDS = ('id', 'user_id', 'product_id', 'quantity', 'total_amount', 'status', 'created_at', 'updated_at')
+
+
+def make_rows(count):
+    """Rows shaped like SELECT ... FROM orders, with the types psycopg2 returns"""
+    started = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    return [
+        (index, index % 5000, f'{index % 977:024x}', index % 7 + 1, Decimal(f'{index % 500}.{index % 100:02d}'),
+         'pending', started + timedelta(seconds=index), started + timedelta(seconds=index))
+        for index in range(count)
+    ]
+
+
+def legacy_project_row(columns, row, fields):
+    """The mapping the list handlers used before row mappers"""
+    values = dict(zip(columns, row))
+    return {field: json_value(values[field]) for field in fields}
+
+
+def legacy_path(app, rows, fields):
+    result = [legacy_project_row(ORDER_FIELDS, row, fields) for row in rows]
+    return result, app.json.response({'orders': result, 'count': len(result), 'next_cursor': None}).get_data()
+
+
+def fast_path(app, rows, fields):
+    to_document = serialization.row_mapper(ORDER_FIELDS, fields)
+    result = [to_document(row) for row in rows]
+    return result, app.json.response({'orders': result, 'count': len(result), 'next_cursor': None}).get_data()
+
+
+class StdlibProvider(serialization.FastJSONProvider):
+    """The fast provider as it runs when orjson is not installed"""
+
+    encode = staticmethod(serialization.stdlib_dumps)
+
+
+def build_app(provider=None):
+    app = Flask(__name__)
+    if provider is not None:
+        app.json = provider(app)
+    return app
+
+
+def measure(path, app, rows, fields, repeats):
+    """Median seconds per call, plus the memory one call allocates"""
+    with app.app_context():
+        _, body = path(app, rows, fields)
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            path(app, rows, fields)
+            timings.append(time.perf_counter() - started)
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        kept = path(app, rows, fields)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Objects still held by the documents and body: dicts, converted values, buffers
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        del kept
+    return statistics.median(timings), peak, blocks, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--fields', default=','.join(ORDER_FIELDS))
+    args = parser.parse_args()
+
+    fields = tuple(args.fields.split(','))
+    rows = make_rows(args.rows)
+    variants = [('per-row dict + jsonify', legacy_path, build_app())]
+    if serialization.orjson is not None:
+        variants.append(('row mapper + orjson', fast_path, build_app(serialization.FastJSONProvider)))
+    else:
+        print('orjson is not installed; only the standard library fallback is measured')
+    variants.append(('row mapper + json fallback', fast_path, build_app(StdlibProvider)))
+
+    print(f"{args.rows} rows, fields {','.join(fields)}, median of {args.repeats}\n")
+    print(f"{'path':28} {'ms/call':>9} {'rows/s':>11} {'peak KiB':>9} {'objects':>8} {'bytes':>10}")
+    baseline = None
+    for label, path, app in variants:
+        seconds, peak, blocks, body = measure(path, app, rows, fields, args.repeats)
+        baseline = baseline or seconds
+        print(f"{label:28} {seconds * 1000:>9.2f} {args.rows / seconds:>11,.0f} {peak / 1024:>9.0f} "
+              f"{blocks:>8} {len(body):>10}  x{baseline / seconds:.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""
+Gateway load test
+Drives a mixed read/write workload through the API gateway and reports throughput and latency per endpoint
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import requests
+
+from stack import ROOT, Stack
+
+BASELINE_SCHEMA = 1
+SEED_BATCH = 500
+
+# Relative weights of each operation; names are the endpoint labels in reports
+MIXES = {
+    'mixed': {
+        'GET /api/users': 10,
+        'GET /api/users/<id>': 15,
+        'POST /api/users': 3,
+        'GET /api/products': 15,
+        'GET /api/products/<id>': 15,
+        'GET /api/orders?user_id=': 15,
+        'GET /api/orders/<id>': 12,
+        'GET /api/orders/expanded': 5,
+        'POST /api/orders': 10
+    },
+    'read': {
+        'GET /api/users': 10,
+        'GET /api/users/<id>': 20,
+        'GET /api/products': 15,
+        'GET /api/products/<id>': 20,
+        'GET /api/orders?user_id=': 20,
+        'GET /api/orders/<id>': 10,
+        'GET /api/orders/expanded': 5
+    },
+    'write': {
+        'GET /api/users/<id>': 20,
+        'GET /api/orders/<id>': 20,
+        'POST /api/users': 20,
+        'POST /api/orders': 40
+    }
+}
+
+
+class Workload:
+    """Seeded ids and one request function per endpoint label"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.user_ids = []
+        self.product_ids = []
+        self.order_ids = []
+
+    def _bulk(self, path, items, key):
+        ids = []
+        for start in range(0, len(items), SEED_BATCH):
+            response = requests.post(f'{self.base_url}{path}', json={'items': items[start:start + SEED_BATCH]},
+                                     timeout=120)
+            response.raise_for_status()
+            ids.extend(result[key]['id'] for result in response.json()['results'] if result['status'] == 201)
+        return ids
+
+    def seed(self, users, products, orders):
+        run = uuid.uuid4().hex[:8]
+        self.user_ids = self._bulk('/api/users/bulk', [
+            {'username': f'bench-{run}-{index}', 'email': f'bench-{run}-{index}@example.com'}
+            for index in range(users)
+        ], 'user')
+        # Stock is large enough that order placement never runs out during a run
+        self.product_ids = self._bulk('/api/products/bulk', [
+            {'name': f'bench {run} product {index}', 'price': round(random.uniform(1, 100), 2), 'stock': 10 ** 7}
+            for index in range(products)
+        ], 'product')
+        self.order_ids = self._bulk('/api/orders/bulk', [
+            {'user_id': random.choice(self.user_ids), 'product_id': random.choice(self.product_ids),
+             'quantity': 1, 'total_amount': 10}
+            for _ in range(orders)
+        ], 'order')
+
+    def request(self, session, label):
+        base = self.base_url
+        if label == 'GET /api/users':
+            return session.get(f'{base}/api/users?limit=20')
+        if label == 'GET /api/users/<id>':
+            return session.get(f'{base}/api/users/{random.choice(self.user_ids)}')
+        if label == 'POST /api/users':
+            name = uuid.uuid4().hex
+            response = session.post(f'{base}/api/users', json={'username': name, 'email': f'{name}@example.com'})
+            if response.status_code == 201:
+                self.user_ids.append(response.json()['id'])
+            return response
+        if label == 'GET /api/products':
+            return session.get(f'{base}/api/products?limit=20&sort={random.choice(["newest", "price_asc"])}')
+        if label == 'GET /api/products/<id>':
+            return session.get(f'{base}/api/products/{random.choice(self.product_ids)}')
+        if label == 'GET /api/orders?user_id=':
+            return session.get(f'{base}/api/orders?limit=20&user_id={random.choice(self.user_ids)}')
+        if label == 'GET /api/orders/<id>':
+            return session.get(f'{base}/api/orders/{random.choice(self.order_ids)}')
+        if label == 'GET /api/orders/expanded':
+            return session.get(f'{base}/api/orders/expanded?limit=20')
+        if label == 'POST /api/orders':
+            response = session.post(f'{base}/api/orders', json={
+                'user_id': random.choice(self.user_ids), 'product_id': random.choice(self.product_ids), 'quantity': 1
+            })
+            if response.status_code == 201:
+                self.order_ids.append(response.json()['id'])
+            return response
+        raise ValueError(f'Unknown operation: {label}')
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def run_load(workload, mix, concurrency, duration, warmup, timeout=30):
+    """Run the mix for warmup + duration seconds; returns samples taken after the warmup"""
+    labels = list(mix)
+    weights = [mix[label] for label in labels]
+    measure_from = time.monotonic() + warmup
+    stop_at = measure_from + duration
+    samples = []
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        session.request = _with_timeout(session.request, timeout)
+        local = []
+        while True:
+            started = time.monotonic()
+            if started >= stop_at:
+                break
+            label = random.choices(labels, weights)[0]
+            try:
+                status = workload.request(session, label).status_code
+            except requests.exceptions.RequestException:
+                status = 0
+            if started >= measure_from:
+                local.append((label, status, time.monotonic() - started))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def _with_timeout(request, timeout):
+    def send(method, url, **kwargs):
+        kwargs.setdefault('timeout', timeout)
+        return request(method, url, **kwargs)
+    return send
+
+
+def summarize(samples, duration):
+    """Throughput, error rate and latency percentiles (ms) per endpoint and in total"""
+    groups = {}
+    for label, status, latency in samples:
+        groups.setdefault(label, []).append((status, latency))
+    groups['total'] = [(status, latency) for _, status, latency in samples]
+
+    report = {}
+    for label, results in groups.items():
+        if not results:
+            continue
+        latencies = [latency * 1000 for _, latency in results]
+        errors = sum(1 for status, _ in results if status == 0 or status >= 500)
+        report[label] = {
+            'requests': len(results),
+            'throughput_rps': round(len(results) / duration, 1),
+            'error_rate': round(errors / len(results), 4),
+            'client_errors': sum(1 for status, _ in results if 400 <= status < 500),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(max(latencies), 2)
+        }
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print(f"{'endpoint':28} {'req':>7} {'req/s':>8} {'err%':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, row in sorted(report.items(), key=lambda item: item[0] == 'total'):
+        print(f"{label:28} {row['requests']:>7} {row['throughput_rps']:>8.1f} {row['error_rate'] * 100:>6.2f} "
+              f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+
+
+def compare(report, baseline, tolerance):
+    """Print changes against a saved baseline; returns the regressed endpoints"""
+    regressions = []
+    print(f"\nAgainst baseline {baseline['meta'].get('git_commit')} from {baseline['meta'].get('created_at')} "
+          f"(tolerance {tolerance:.0%}):")
+    for label, base in sorted(baseline['endpoints'].items(), key=lambda item: item[0] == 'total'):
+        row = report.get(label)
+        if row is None:
+            print(f"  {label:28} missing from this run")
+            continue
+        problems = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if base[key] and row[key] > base[key] * (1 + tolerance):
+                problems.append(f"{key} {base[key]:.2f} -> {row[key]:.2f}")
+        if row['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            problems.append(f"req/s {base['throughput_rps']:.1f} -> {row['throughput_rps']:.1f}")
+        if row['error_rate'] > base['error_rate'] + 0.01:
+            problems.append(f"errors {base['error_rate']:.2%} -> {row['error_rate']:.2%}")
+        if problems:
+            regressions.append(label)
+        print(f"  {label:28} {'REGRESSED: ' + '; '.join(problems) if problems else 'ok'}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gateway-url', help='load an already running gateway instead of starting the local stack')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds run before measuring')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers per service in the local stack')
+    parser.add_argument('--postgres', choices=['embedded', 'external'], default='embedded')
+    parser.add_argument('--mongodb', choices=['mongomock', 'external'], default='mongomock')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to check this run against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before failing')
+    parser.add_argument('--keep-logs', action='store_true', help='keep the local stack run directory')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stack = None
+    if args.gateway_url:
+        base_url = args.gateway_url.rstrip('/')
+    else:
+        stack = Stack(workers=args.workers, postgres=args.postgres, mongodb=args.mongodb,
+                      keep_logs=args.keep_logs).start()
+        base_url = stack.gateway_url
+        print(f"Local stack up: {', '.join(f'{name} {url}' for name, url in stack.urls.items())}")
+        if args.keep_logs:
+            print(f"Logs in {stack.run_dir}")
+
+    try:
+        workload = Workload(base_url)
+        started = time.monotonic()
+        workload.seed(args.users, args.products, args.orders)
+        print(f"Seeded {len(workload.user_ids)} users, {len(workload.product_ids)} products and "
+              f"{len(workload.order_ids)} orders in {time.monotonic() - started:.1f}s")
+        print(f"Running '{args.mix}' mix at concurrency {args.concurrency} for {args.duration:.0f}s "
+              f"after {args.warmup:.0f}s warmup\n")
+        samples = run_load(workload, MIXES[args.mix], args.concurrency, args.duration, args.warmup)
+    finally:
+        if stack is not None:
+            stack.stop()
+
+    report = summarize(samples, args.duration)
+    print_report(report)
+
+    result = {
+        'schema': BASELINE_SCHEMA,
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'git_commit': git_commit(),
+            'target': args.gateway_url or f'local stack (postgres {args.postgres}, mongodb {args.mongodb})',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {
+                'mix': args.mix,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'warmup': args.warmup,
+                'users': args.users,
+                'products': args.products,
+                'orders': args.orders,
+                'workers': args.workers,
+                'seed': args.seed
+            }
+        },
+        'endpoints': report
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as baseline_file:
+            json.dump(result, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('schema') != BASELINE_SCHEMA:
+            print(f"Baseline {args.compare} has an unsupported schema")
+            return 2
+        if baseline['meta']['config'] != result['meta']['config']:
+            print('Warning: baseline was recorded with a different configuration')
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Product search query plan benchmark
+Seeds a scratch MongoDB database and checks every /api/products query shape uses an index
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'microservices'), os.path.join(ROOT, 'microservices', 'product-service')]
+
+import migrations  # noqa: E402
+from common.migrations import MongoMigrator  # noqa: E402
+
+WORDS = [
+    'steel', 'cotton', 'wireless', 'compact', 'classic', 'organic', 'portable', 'ceramic',
+    'leather', 'bamboo', 'smart', 'vintage', 'outdoor', 'kitchen', 'desk', 'lamp', 'chair',
+    'bottle', 'speaker', 'backpack', 'jacket', 'kettle', 'keyboard', 'blanket', 'mug'
+]
+
+# (label, query parameters) mirroring what the storefront sends to /api/products
+QUERY_SHAPES = [
+    ('newest', {}),
+    ('newest, next page', {'after': True}),
+    ('price range', {'min_price': '20', 'max_price': '40', 'sort': 'price_asc'}),
+    ('price desc, next page', {'sort': 'price_desc', 'after': True}),
+    ('in stock by price', {'in_stock': 'true', 'sort': 'price_asc'}),
+    ('in stock, price range', {'in_stock': 'true', 'min_price': '20', 'max_price': '40'}),
+    ('name order', {'sort': 'name'}),
+    ('text search', {'q': 'wireless speaker'}),
+    ('text search, price range', {'q': 'leather', 'max_price': '50', 'sort': 'price_asc'}),
+]
+
+
+def seed(db, count, batch_size=5000):
+    """Insert count random products into a freshly dropped database"""
+    db.client.drop_database(db.name)
+    now = datetime.utcnow()
+    batch = []
+    for _ in range(count):
+        name = ' '.join(random.sample(WORDS, 3))
+        batch.append({
+            'name': name,
+            'description': f"A {' '.join(random.sample(WORDS, 6))}",
+            'price': round(random.uniform(1, 100), 2),
+            'stock': random.choice([0, 0, 1, 5, 20, 100]),
+            'created_at': now,
+            'updated_at': now
+        })
+        if len(batch) == batch_size:
+            db.products.insert_many(batch)
+            batch = []
+    if batch:
+        db.products.insert_many(batch)
+
+
+def build_query(app, params):
+    """The filter, sort and projection get_products would send for params"""
+    clauses, searching = app.product_filters(params)
+    sort_name = params.get('sort') or ('relevance' if searching else 'newest')
+    projection = None
+    if sort_name == 'relevance':
+        sort = [('score', {'$meta': 'textScore'}), ('_id', -1)]
+        projection = {'score': {'$meta': 'textScore'}}
+    else:
+        sort = app.PRODUCT_SORTS[sort_name]
+        if params.get('after'):
+            # A cursor from the middle of the collection
+            middle = sort[:-1]
+            pivot = app.get_db().products.find_one({}, sort=middle + [('_id', sort[-1][1])], skip=1000)
+            values = [pivot.get(field) for field, _ in middle] + [str(pivot['_id'])]
+            clauses.append(app.after_clause(sort, app.encode_cursor(*values)))
+    query = {'$and': clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
+    return query, sort, projection
+
+
+def plan_stages(plan):
+    """Every stage name in an explain plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def explain(db, query, sort, projection, limit):
+    command = {'find': 'products', 'filter': query, 'sort': dict(sort), 'limit': limit + 1}
+    if projection:
+        command['projection'] = projection
+    return db.command('explain', command, verbosity='executionStats')
+
+
+def run(db, app, limit, repeats):
+    rows = []
+    for label, params in QUERY_SHAPES:
+        query, sort, projection = build_query(app, params)
+        result = explain(db, query, sort, projection, limit)
+        stages = plan_stages(result['queryPlanner']['winningPlan'])
+        stats = result['executionStats']
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            list(db.products.find(query, projection).sort(sort).limit(limit + 1))
+            timings.append((time.perf_counter() - started) * 1000)
+        rows.append({
+            'label': label,
+            'stages': stages,
+            'keys_examined': stats['totalKeysExamined'],
+            'docs_examined': stats['totalDocsExamined'],
+            'returned': stats['nReturned'],
+            'p50_ms': statistics.median(timings),
+            'collscan': 'COLLSCAN' in stages
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch database')
+    args = parser.parse_args()
+
+    os.environ['MONGODB_DB'] = os.getenv('BENCH_MONGODB_DB', 'products_bench')
+    import app
+    db = app.get_db()
+    random.seed(42)
+    print(f"Seeding {args.products} products into {db.name}")
+    seed(db, args.products)
+    version = MongoMigrator(db, migrations.COMPONENT, migrations.MIGRATIONS).migrate()
+    print(f"Schema at version {version}\n")
+
+    try:
+        rows = run(db, app, args.limit, args.repeats)
+    finally:
+        if not args.keep:
+            app.get_mongodb_client().drop_database(db.name)
+
+    print(f"{'query':28} {'plan':48} {'keys':>8} {'docs':>8} {'ret':>5} {'p50 ms':>8}")
+    for row in rows:
+        plan = ' <- '.join(row['stages'])
+        print(f"{row['label']:28} {plan[:48]:48} {row['keys_examined']:>8} "
+              f"{row['docs_examined']:>8} {row['returned']:>5} {row['p50_ms']:>8.2f}")
+    scans = [row['label'] for row in rows if row['collscan']]
+    if scans:
+        print(f"\nCollection scans: {', '.join(scans)}")
+        return 1
+    print('\nEvery query shape is served by an index')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
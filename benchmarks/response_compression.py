@@ -0,0 +1,89 @@
+"""
+Response compression and conditional GET micro-benchmark
+Compares body size and CPU per encoding for an orders page, and a 304 against a full 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'microservices'))
+
+from flask import Flask, jsonify  # noqa: E402
+
+from common import compression, serialization  # noqa: E402
+from json_serialization import ORDER_FIELDS, make_rows  # noqa: E402
+
+
+def timed(func, repeats):
+    """Median microseconds per call"""
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - started) * 1e6)
+    return statistics.median(runs)
+
+
+def build_app(rows):
+    app = Flask(__name__)
+    serialization.init_app(app)
+    compression.init_app(app)
+    to_document = serialization.row_mapper(ORDER_FIELDS, ORDER_FIELDS)
+    versions = [(row[0], str(1000 + row[0])) for row in rows]
+
+    @app.route('/orders')
+    def orders():
+        # As the order-service listing: ETag from row versions, checked before serializing
+        etag = compression.version_etag(ORDER_FIELDS, None, versions)
+        unchanged = compression.conditional(etag)
+        if unchanged is not None:
+            return unchanged
+        result = [to_document(row) for row in rows]
+        response = jsonify({'orders': result, 'count': len(result), 'next_cursor': None})
+        response.set_etag(etag)
+        return response
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    app = build_app(rows)
+    body = app.json.dumps({'orders': [dict(zip(ORDER_FIELDS, row)) for row in rows]}).encode()
+    print(f"{args.rows}-row orders page, {len(body)} bytes of JSON\n")
+    print(f"{'encoding':10} {'bytes':>8} {'ratio':>7} {'compress us':>12} {'decompress us':>14}")
+    for encoding in compression.AVAILABLE_ENCODINGS:
+        compressed = compression.compress(body, encoding)
+        compress_us = timed(lambda: compression.compress(body, encoding), args.repeats)
+        decompress_us = timed(lambda: compression.decompress(compressed, encoding), args.repeats)
+        print(f"{encoding:10} {len(compressed):>8} {len(body) / len(compressed):>7.1f} "
+              f"{compress_us:>12.0f} {decompress_us:>14.0f}")
+
+    client = app.test_client()
+    print(f"\n{'request':34} {'status':>6} {'bytes':>8} {'us/request':>11}")
+    for label, headers in (('GET, identity', {'Accept-Encoding': 'identity'}),
+                           ('GET, gzip', {'Accept-Encoding': 'gzip'}),
+                           ('GET, zstd', {'Accept-Encoding': 'zstd'})):
+        response = client.get('/orders', headers=headers)
+        etag = response.headers['ETag']
+        # Repeated 200s still serialize, but take the compressed body from the per-process cache
+        cost = timed(lambda: client.get('/orders', headers=headers), args.repeats)
+        print(f"{label:34} {response.status_code:>6} {len(response.get_data()):>8} {cost:>11.0f}")
+        conditional = dict(headers, **{'If-None-Match': etag})
+        response = client.get('/orders', headers=conditional)
+        cost = timed(lambda: client.get('/orders', headers=conditional), args.repeats)
+        print(f"{label + ', If-None-Match':34} {response.status_code:>6} {len(response.get_data()):>8} {cost:>11.0f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Local service stack for benchmarks
+Runs all four services under gunicorn against containerless Postgres and in-memory MongoDB stand-ins
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES_DIR = os.path.join(ROOT, 'microservices')
+STANDINS_DIR = os.path.join(ROOT, 'benchmarks', 'standins')
+
+SERVICES = ('user-service', 'order-service', 'product-service', 'api-gateway')
+STARTUP_TIMEOUT = 60
+
+
+class StackError(Exception):
+    """A process of the stack failed to start"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Stack:
+    """Starts Postgres, migrations, the three services and the gateway; stops them on exit.
+
+    postgres='embedded' runs a throwaway server from the pgserver package;
+    'external' uses the DB_* variables from the environment. mongodb='mongomock'
+    serves product-service from an in-memory stand-in in a single process;
+    'external' uses the MONGODB_* variables. Extra variables in env are passed
+    to every service, so the same configuration knobs as in Helm apply.
+    """
+
+    def __init__(self, workers=2, gateway_workers=2, gateway_threads=8, postgres='embedded',
+                 mongodb='mongomock', env=None, keep_logs=False):
+        self.workers = workers
+        self.gateway_workers = gateway_workers
+        self.gateway_threads = gateway_threads
+        self.postgres = postgres
+        self.mongodb = mongodb
+        self.extra_env = dict(env or {})
+        self.keep_logs = keep_logs
+        self.run_dir = None
+        self.urls = {}
+        self._processes = []
+        self._pg_server = None
+        self.pg_dir = None
+
+    @property
+    def gateway_url(self):
+        return self.urls['api-gateway']
+
+    def _base_env(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([SERVICES_DIR, STANDINS_DIR])
+        env.setdefault('TRACING_EXPORTER', 'none')
+        if self._pg_server is not None:
+            env.update({
+                # pgserver listens on a unix socket in its data directory
+                'DB_HOST': self.pg_dir,
+                'DB_PORT': '5432',
+                'DB_NAME': 'postgres',
+                'DB_USER': 'postgres',
+                'DB_PASSWORD': ''
+            })
+        env.update(self.extra_env)
+        return env
+
+    def _start_postgres(self):
+        if self.postgres != 'embedded':
+            return
+        try:
+            import pgserver
+        except ImportError:
+            raise StackError('pgserver is not installed; pip install -r benchmarks/requirements.txt '
+                             'or run with --postgres external and DB_* set')
+        self.pg_dir = os.path.join(self.run_dir, 'pgdata')
+        self._pg_server = pgserver.get_server(self.pg_dir, cleanup_mode='stop')
+
+    def _spawn(self, name, args, cwd, env):
+        log = open(os.path.join(self.run_dir, f'{name}.log'), 'w')
+        process = subprocess.Popen(args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self._processes.append((name, process, log))
+        return process
+
+    def _migrate(self, service, env):
+        result = subprocess.run([sys.executable, 'migrations.py'], cwd=os.path.join(SERVICES_DIR, service),
+                                env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise StackError(f'{service} migrations failed:\n{result.stdout}{result.stderr}')
+
+    def _gunicorn(self, service, port, env, app_module='app:app', workers=None, threads=None):
+        env = dict(env, PROMETHEUS_MULTIPROC_DIR=os.path.join(self.run_dir, f'prometheus-{service}'))
+        config = 'gunicorn.conf.py' if service == 'api-gateway' else 'python:common.gunicorn_conf'
+        args = [sys.executable, '-m', 'gunicorn', '--config', config, '--bind', f'127.0.0.1:{port}',
+                '--workers', str(workers or self.workers), '--timeout', '120']
+        if threads:
+            args += ['--threads', str(threads)]
+        if service != 'api-gateway':
+            args.append(app_module)
+        self._spawn(service, args, os.path.join(SERVICES_DIR, service), env)
+        self.urls[service] = f'http://127.0.0.1:{port}'
+
+    def _wait_healthy(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        for name, url in self.urls.items():
+            while True:
+                process = next(process for service, process, _ in self._processes if service == name)
+                if process.poll() is not None:
+                    raise StackError(f'{name} exited during startup:\n{self.log_tail(name)}')
+                try:
+                    if requests.get(f'{url}/health', timeout=2).status_code == 200:
+                        break
+                except requests.exceptions.RequestException:
+                    pass
+                if time.monotonic() > deadline:
+                    raise StackError(f'{name} did not become healthy:\n{self.log_tail(name)}')
+                time.sleep(0.2)
+
+    def log_tail(self, name, lines=30):
+        with open(os.path.join(self.run_dir, f'{name}.log')) as log:
+            return ''.join(log.readlines()[-lines:])
+
+    def start(self):
+        self.run_dir = tempfile.mkdtemp(prefix='bench-stack-')
+        try:
+            self._start_postgres()
+            env = self._base_env()
+            for service in ('user-service', 'order-service'):
+                self._migrate(service, env)
+            if self.mongodb != 'mongomock':
+                self._migrate('product-service', env)
+
+            ports = {service: free_port() for service in SERVICES}
+            self._gunicorn('user-service', ports['user-service'], env)
+            if self.mongodb == 'mongomock':
+                # One process owns the in-memory data; threads provide the concurrency
+                self._gunicorn('product-service', ports['product-service'], env,
+                               app_module='product_standin:app', workers=1, threads=self.workers * 4)
+            else:
+                self._gunicorn('product-service', ports['product-service'], env)
+            self._gunicorn('order-service', ports['order-service'],
+                           dict(env, PRODUCT_SERVICE_URL=self.urls['product-service']))
+            gateway_env = dict(
+                env,
+                USER_SERVICE_URL=self.urls['user-service'],
+                ORDER_SERVICE_URL=self.urls['order-service'],
+                PRODUCT_SERVICE_URL=self.urls['product-service'],
+                GUNICORN_WORKERS=str(self.gateway_workers),
+                GUNICORN_THREADS=str(self.gateway_threads)
+            )
+            self._gunicorn('api-gateway', ports['api-gateway'], gateway_env, workers=self.gateway_workers)
+            self._wait_healthy()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def stop(self):
+        for _, process, _ in self._processes:
+            if process.poll() is None:
+                process.terminate()
+        for _, process, log in self._processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+        self._processes = []
+        if self._pg_server is not None:
+            self._pg_server.cleanup()
+            self._pg_server = None
+        if self.run_dir and not self.keep_logs:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
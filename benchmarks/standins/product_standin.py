@@ -0,0 +1,27 @@
+"""
+Product service on an in-memory MongoDB stand-in
+Serves product-service/app.py with mongomock behind the pymongo interface; run it in one process
+"""
+
+import mongomock
+
+import app as product_service
+import migrations
+from common.migrations import MongoMigrator
+
+# Every pymongo client the service creates shares one in-memory server, so the
+# data lives exactly as long as this process; threads are fine, extra workers are not
+_server = mongomock.MongoClient()
+
+
+def _client(*args, **kwargs):
+    return _server
+
+
+product_service.MongoClient = _client
+# mongomock has no change streams, so /api/products/changes is not served here
+MongoMigrator(product_service.get_db(), migrations.COMPONENT, [
+    migration for migration in migrations.MIGRATIONS if migration.apply is not migrations.enable_change_streams
+]).migrate()
+
+app = product_service.app
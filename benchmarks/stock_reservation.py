@@ -0,0 +1,133 @@
+"""
+Stock reservation concurrency benchmark
+Bursts of concurrent reservations on one hot product; checks nothing is oversold or lost
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_local = threading.local()
+
+
+def session():
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def create_product(product_url, stock):
+    response = requests.post(f'{product_url}/api/products', json={
+        'name': f'bench-hot-sku-{uuid.uuid4().hex[:8]}', 'price': 9.99, 'stock': stock
+    }, timeout=10)
+    response.raise_for_status()
+    return response.json()['id']
+
+
+def current_stock(product_url, product_id):
+    response = requests.get(f'{product_url}/api/products/{product_id}', timeout=10)
+    response.raise_for_status()
+    return response.json()['stock']
+
+
+def reserve_call(product_url, product_id, quantity):
+    started = time.perf_counter()
+    response = session().post(f'{product_url}/api/products/{product_id}/reserve', json={
+        'quantity': quantity, 'reservation_id': uuid.uuid4().hex
+    }, timeout=30)
+    body = response.json() if response.status_code in (200, 201) else None
+    return response.status_code, time.perf_counter() - started, body
+
+
+def order_call(order_url, product_id, quantity):
+    started = time.perf_counter()
+    response = session().post(f'{order_url}/api/orders', json={
+        'user_id': 1, 'product_id': product_id, 'quantity': quantity
+    }, timeout=30)
+    return response.status_code, time.perf_counter() - started, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--product-url', default=os.getenv('PRODUCT_SERVICE_URL', 'http://localhost:8080'))
+    parser.add_argument('--order-url', help='place orders through order-service instead of reserving directly')
+    parser.add_argument('--stock', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--release', type=float, default=0.25,
+                        help='fraction of successful reservations to release afterwards')
+    args = parser.parse_args()
+
+    product_id = create_product(args.product_url, args.stock)
+    if args.order_url:
+        call, target = order_call, args.order_url
+    else:
+        call, target = reserve_call, args.product_url
+
+    print(f"{args.requests} requests for {args.quantity} unit(s) of product {product_id} "
+          f"(stock {args.stock}) at concurrency {args.concurrency}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda _: call(target, product_id, args.quantity), range(args.requests)
+        ))
+    elapsed = time.perf_counter() - started
+
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    reserved = [body for status, _, body in results if status in (200, 201)]
+    reserved_units = len([r for r in results if r[0] in (200, 201)]) * args.quantity
+    latencies = [latency * 1000 for _, latency, _ in results]
+
+    released_units = 0
+    to_release = [body for body in reserved if body][:int(len(reserved) * args.release)]
+    for body in to_release:
+        response = session().post(
+            f"{args.product_url}/api/products/reservations/{body['reservation_id']}/release", timeout=10
+        )
+        if response.status_code == 200:
+            released_units += body['quantity']
+        # A second release must not return the stock twice
+        session().post(f"{args.product_url}/api/products/reservations/{body['reservation_id']}/release", timeout=10)
+
+    final_stock = current_stock(args.product_url, product_id)
+    expected_stock = args.stock - reserved_units + released_units
+
+    print(f"statuses: {statuses}")
+    print(f"throughput: {args.requests / elapsed:.0f} req/s over {elapsed:.2f}s")
+    print(f"latency ms: p50 {statistics.median(latencies):.1f}  p95 {percentile(latencies, 95):.1f}  "
+          f"p99 {percentile(latencies, 99):.1f}  max {max(latencies):.1f}")
+    print(f"reserved {reserved_units} units, released {released_units}, "
+          f"final stock {final_stock} (expected {expected_stock})")
+
+    demand = args.requests * args.quantity
+    failures = []
+    if reserved_units > args.stock:
+        failures.append('oversold')
+    if final_stock != expected_stock:
+        failures.append('stock does not match reservations')
+    if demand >= args.stock and args.stock - reserved_units >= args.quantity:
+        failures.append('stock left unsold while requests were rejected')
+    if failures:
+        print(f"FAIL: {', '.join(failures)}")
+        return 1
+    print('PASS')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Worker lifecycle benchmark
+Startup time, first-request latency, worker memory and probe cost of user-service with and without preload and warm-up
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from stack import SERVICES_DIR, StackError, free_port
+
+SERVICE_DIR = os.path.join(SERVICES_DIR, 'user-service')
+
+MODES = (
+    ('import per worker', {'GUNICORN_PRELOAD': 'false', 'WORKER_WARM_UP': 'false'}),
+    ('preload + warm-up', {'GUNICORN_PRELOAD': 'true', 'WORKER_WARM_UP': 'true'}),
+)
+PROBES = ('/health', '/livez', '/readyz')
+
+
+def memory_kb(pid):
+    """(PSS, USS) of a process in kB, from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as rollup:
+        for line in rollup:
+            name, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                fields[name] = int(value.split()[0])
+    return fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def workers_of(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as children:
+        return [int(child) for child in children.read().split()]
+
+
+def wait_for(url, process, deadline):
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise StackError('user-service exited during startup')
+        try:
+            if requests.get(url, timeout=2, headers={'Connection': 'close'}).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.01)
+    raise StackError('user-service did not start')
+
+
+def probe_cost(url, path, calls):
+    """Median and p99 milliseconds of a probe on a keep-alive connection"""
+    session = requests.Session()
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        session.get(f'{url}{path}', timeout=5)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def run_mode(run_dir, env, args, label, extra_env):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    env = dict(env, PROMETHEUS_MULTIPROC_DIR=os.path.join(run_dir, 'prometheus'), **extra_env)
+    log = open(os.path.join(run_dir, 'user-service.log'), 'a')
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'python:common.gunicorn_conf',
+         '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers), '--timeout', '120', 'app:app'],
+        cwd=SERVICE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    try:
+        wait_for(f'{url}/livez', process, started + 60)
+        first_answer = time.monotonic() - started
+        # The first request needing the database, on a worker that has served nothing else
+        request_started = time.perf_counter()
+        requests.get(f'{url}/api/users?limit=10', timeout=5, headers={'Connection': 'close'})
+        first_query = (time.perf_counter() - request_started) * 1000
+        time.sleep(args.settle)
+        workers = workers_of(process.pid)
+        memory = [memory_kb(pid) for pid in workers]
+        pss = sum(kb for kb, _ in memory + [memory_kb(process.pid)]) / 1024
+        uss = statistics.mean(kb for _, kb in memory) / 1024
+        probes = [probe_cost(url, path, args.probes) for path in PROBES]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        log.close()
+    print(f"{label:20} {first_answer:>9.2f} {first_query:>10.1f} {pss:>9.1f} {uss:>9.1f}  "
+          + '  '.join(f'{median:>5.2f}/{p99:<5.2f}' for median, p99 in probes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--probes', type=int, default=500, help='requests per probe endpoint')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to let every worker boot')
+    args = parser.parse_args()
+
+    try:
+        import pgserver
+    except ImportError:
+        print('pgserver is not installed; pip install -r benchmarks/requirements.txt')
+        return 2
+
+    run_dir = tempfile.mkdtemp(prefix='bench-lifecycle-')
+    server = pgserver.get_server(os.path.join(run_dir, 'pgdata'), cleanup_mode='stop')
+    env = dict(os.environ, PYTHONPATH=SERVICES_DIR, TRACING_EXPORTER='none',
+               DB_HOST=os.path.join(run_dir, 'pgdata'), DB_PORT='5432', DB_NAME='postgres',
+               DB_USER='postgres', DB_PASSWORD='')
+    try:
+        result = subprocess.run([sys.executable, 'migrations.py'], cwd=SERVICE_DIR, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise StackError(f'migrations failed:\n{result.stderr}')
+
+        print(f"user-service, {args.workers} workers; probe columns are median/p99 ms over {args.probes} calls\n")
+        print(f"{'mode':20} {'startup s':>9} {'1st query':>10} {'PSS MiB':>9} {'USS MiB':>9}  "
+              + '  '.join(f'{path:11}' for path in PROBES))
+        for label, extra_env in MODES:
+            run_mode(run_dir, env, args, label, extra_env)
+    finally:
+        server.cleanup()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    print("\nstartup s: launch to the first /livez answer; 1st query: first /api/users on a new connection, ms;"
+          "\nPSS: master and workers together; USS: memory private to one worker")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
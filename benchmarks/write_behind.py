@@ -0,0 +1,269 @@
+"""
+Write-behind order ingestion check
+Measures order throughput with and without the write-behind queue, kills order-service mid-load and verifies
+recovery, then checks that concurrent retries with one idempotency key get one order on every worker
+"""
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import psycopg2
+import requests
+
+from stack import SERVICES_DIR, StackError, free_port
+
+SERVICE_DIR = os.path.join(SERVICES_DIR, 'order-service')
+
+
+class OrderService:
+    """order-service under gunicorn in its own process group, so it can be killed outright"""
+
+    def __init__(self, run_dir, env, workers, threads):
+        self.run_dir = run_dir
+        self.env = env
+        self.workers = workers
+        self.threads = threads
+        self.url = None
+        self._process = None
+        self._log = None
+
+    def start(self, extra_env):
+        port = free_port()
+        env = dict(self.env, PROMETHEUS_MULTIPROC_DIR=os.path.join(self.run_dir, 'prometheus'), **extra_env)
+        self._log = open(os.path.join(self.run_dir, 'order-service.log'), 'a')
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--config', 'python:common.gunicorn_conf',
+             '--bind', f'127.0.0.1:{port}', '--workers', str(self.workers), '--threads', str(self.threads),
+             '--timeout', '120', 'app:app'],
+            cwd=SERVICE_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT, start_new_session=True
+        )
+        self.url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise StackError('order-service exited during startup')
+            try:
+                if requests.get(f'{self.url}/health', timeout=2).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.2)
+        raise StackError('order-service did not become healthy')
+
+    def kill(self):
+        """SIGKILL the arbiter and every worker, as a node or OOM kill would"""
+        os.killpg(self._process.pid, signal.SIGKILL)
+        self._process.wait()
+        self._log.close()
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait(timeout=30)
+            self._log.close()
+
+
+def post_orders(url, count, concurrency, accepted, stop=None):
+    """POST orders with unique idempotency keys; accepted maps key -> id for 201/202 answers"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    keys = iter(range(count))
+
+    def worker():
+        session = requests.Session()
+        while stop is None or not stop.is_set():
+            with lock:
+                index = next(keys, None)
+            if index is None:
+                return
+            key = uuid.uuid4().hex
+            started = time.perf_counter()
+            try:
+                response = session.post(f'{url}/api/orders', headers={'Idempotency-Key': key}, json={
+                    'user_id': random.randint(1, 1000), 'product_id': f'p{index % 50}',
+                    'quantity': 1, 'total_amount': '9.99'
+                }, timeout=30)
+            except requests.exceptions.RequestException as e:
+                errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code in (201, 202):
+                    accepted[key] = response.json()['id']
+                else:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies, errors
+
+
+def stored_orders(db_config, keys):
+    """idempotency_key -> list of stored ids"""
+    stored = {}
+    with psycopg2.connect(**db_config) as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT idempotency_key, id FROM orders WHERE idempotency_key = ANY(%s)", (list(keys),))
+        for key, order_id in cursor.fetchall():
+            stored.setdefault(key, []).append(order_id)
+    conn.close()
+    return stored
+
+
+def throughput(service, args, extra_env, label):
+    service.start(extra_env)
+    try:
+        accepted = {}
+        seconds, latencies, errors = post_orders(service.url, args.orders, args.concurrency, accepted)
+    finally:
+        service.stop()
+    latencies.sort()
+    print(f"{label:14} {len(accepted) / seconds:>9.0f} {statistics.median(latencies) * 1000:>8.1f} "
+          f"{latencies[int(len(latencies) * 0.99) - 1] * 1000:>8.1f} {len(errors):>7}")
+
+
+def crash_round(service, args, journal_dir, db_config, round_number):
+    """Kill the service at a random point of a load run, restart it and check every accepted order"""
+    service.start({'ORDER_WRITE_BEHIND': 'true', 'WRITE_BEHIND_DIR': journal_dir})
+    accepted = {}
+    stop = threading.Event()
+    loader = threading.Thread(target=post_orders, args=(service.url, 10 ** 9, args.concurrency, accepted, stop))
+    loader.start()
+    time.sleep(random.uniform(0.5, 2.0))
+    service.kill()
+    stop.set()
+    loader.join()
+    journaled = len([name for name in os.listdir(journal_dir) if name.endswith('.log')])
+
+    service.start({'ORDER_WRITE_BEHIND': 'true', 'WRITE_BEHIND_DIR': journal_dir})
+    try:
+        deadline = time.monotonic() + 30
+        while any(name.endswith('.log') for name in os.listdir(journal_dir)):
+            if time.monotonic() > deadline:
+                raise StackError('journaled orders were not recovered within 30s')
+            requests.get(f'{service.url}/health', timeout=2)
+            time.sleep(0.2)
+    finally:
+        service.stop()
+
+    stored = stored_orders(db_config, accepted)
+    missing = [key for key in accepted if key not in stored]
+    duplicated = [key for key, ids in stored.items() if len(ids) > 1]
+    mismatched = [key for key, ids in stored.items() if accepted.get(key) not in ids]
+    print(f"round {round_number}: {len(accepted)} accepted, {journaled} segments left by the crash, "
+          f"{len(missing)} missing, {len(duplicated)} duplicated, {len(mismatched)} with another id")
+    return not (missing or duplicated or mismatched)
+
+
+def same_key_round(service, args, journal_dir, db_config):
+    """Send each key several times at once, so the copies land on different workers"""
+    service.start({'ORDER_WRITE_BEHIND': 'true', 'WRITE_BEHIND_DIR': journal_dir})
+    answers = {}
+    lock = threading.Lock()
+    errors = []
+
+    def send(key):
+        try:
+            # A new connection per request, so the copies of a key spread over the workers
+            response = requests.post(f'{service.url}/api/orders', json={
+                'user_id': 1, 'product_id': 'p1', 'quantity': 1, 'total_amount': '9.99'
+            }, headers={'Idempotency-Key': key, 'Connection': 'close'}, timeout=30)
+        except requests.exceptions.RequestException as e:
+            errors.append(str(e))
+            return
+        with lock:
+            if response.status_code in (200, 201, 202):
+                answers.setdefault(key, set()).add(response.json()['id'])
+            else:
+                errors.append(response.status_code)
+
+    try:
+        keys = [uuid.uuid4().hex for _ in range(args.same_keys)]
+        for key in keys:
+            threads = [threading.Thread(target=send, args=(key,)) for _ in range(args.same_key_copies)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Every worker flushes its journal well within a second
+        time.sleep(1)
+        unknown = [key for key, ids in answers.items()
+                   if requests.get(f'{service.url}/api/orders/{min(ids)}', timeout=5).status_code != 200]
+    finally:
+        service.stop()
+
+    stored = stored_orders(db_config, keys)
+    split = [key for key, ids in answers.items() if len(ids) > 1]
+    mismatched = [key for key, ids in answers.items() if stored.get(key) != list(ids)]
+    print(f"same key: {len(keys)} keys x {args.same_key_copies} concurrent requests, {len(errors)} errors, "
+          f"{len(split)} keys answered with several ids, {len(mismatched)} not stored under the answered id, "
+          f"{len(unknown)} answered ids not found")
+    return not (errors or split or mismatched or unknown)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--crash-rounds', type=int, default=3)
+    parser.add_argument('--same-keys', type=int, default=200)
+    parser.add_argument('--same-key-copies', type=int, default=4, help='concurrent requests per idempotency key')
+    args = parser.parse_args()
+
+    try:
+        import pgserver
+    except ImportError:
+        print('pgserver is not installed; pip install -r benchmarks/requirements.txt')
+        return 2
+
+    run_dir = tempfile.mkdtemp(prefix='bench-write-behind-')
+    server = pgserver.get_server(os.path.join(run_dir, 'pgdata'), cleanup_mode='stop')
+    db_config = {'host': os.path.join(run_dir, 'pgdata'), 'port': '5432', 'database': 'postgres',
+                 'user': 'postgres', 'password': ''}
+    env = dict(os.environ, PYTHONPATH=SERVICES_DIR, TRACING_EXPORTER='none', ORDER_RESERVE_STOCK='false',
+               DB_HOST=db_config['host'], DB_PORT='5432', DB_NAME='postgres', DB_USER='postgres', DB_PASSWORD='')
+    service = OrderService(run_dir, env, args.workers, args.threads)
+    try:
+        result = subprocess.run([sys.executable, 'migrations.py'], cwd=SERVICE_DIR, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise StackError(f'migrations failed:\n{result.stderr}')
+
+        print(f"{args.orders} orders, {args.concurrency} clients, {args.workers} workers x {args.threads} threads\n")
+        print(f"{'mode':14} {'orders/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        throughput(service, args, {}, 'synchronous')
+        journal_dir = os.path.join(run_dir, 'journal')
+        throughput(service, args, {'ORDER_WRITE_BEHIND': 'true', 'WRITE_BEHIND_DIR': journal_dir}, 'write-behind')
+
+        print()
+        ok = all(crash_round(service, args, journal_dir, db_config, number + 1)
+                 for number in range(args.crash_rounds))
+        ok = same_key_round(service, args, journal_dir, db_config) and ok
+    finally:
+        service.stop()
+        server.cleanup()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    print('\nevery accepted order was stored exactly once, under the id it was answered with' if ok
+          else '\nRECOVERY CHECK FAILED')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Admission control for the API Gateway
+Per-client token-bucket rate limits, a concurrency limit with load shedding and per-upstream caps
+"""
+
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated route=rate:burst pairs, in requests per second per client.
+# Routes are named as in GATEWAY_CACHE_TTLS; "*" limits a client across all routes
+GATEWAY_RATE_LIMITS = os.getenv('GATEWAY_RATE_LIMITS', '')
+GATEWAY_RATE_LIMIT_MAX_CLIENTS = int(os.getenv('GATEWAY_RATE_LIMIT_MAX_CLIENTS', '10000'))
+# redis://... to share buckets across workers and pods; otherwise each worker
+# process enforces the limits on its own share of the traffic
+GATEWAY_RATE_LIMIT_BACKEND = os.getenv('GATEWAY_RATE_LIMIT_BACKEND', '')
+# Header naming the client, e.g. an API key checked in front of the gateway;
+# without it clients are told apart by address
+GATEWAY_CLIENT_ID_HEADER = os.getenv('GATEWAY_CLIENT_ID_HEADER', '')
+# Proxies in front of the gateway that append to X-Forwarded-For (the ALB is one)
+GATEWAY_TRUSTED_PROXY_HOPS = int(os.getenv('GATEWAY_TRUSTED_PROXY_HOPS', '1'))
+
+# Concurrent /api requests per worker process; 0 disables the limit. Requests
+# over it wait in a queue of GATEWAY_MAX_QUEUE for up to GATEWAY_QUEUE_TIMEOUT
+GATEWAY_MAX_CONCURRENCY = int(os.getenv('GATEWAY_MAX_CONCURRENCY', '0'))
+GATEWAY_MAX_QUEUE = int(os.getenv('GATEWAY_MAX_QUEUE', '0'))
+GATEWAY_QUEUE_TIMEOUT = float(os.getenv('GATEWAY_QUEUE_TIMEOUT', '0.5'))
+GATEWAY_SHED_RETRY_AFTER = int(os.getenv('GATEWAY_SHED_RETRY_AFTER', '1'))
+
+# Concurrent calls per upstream per worker process; 0 disables the cap
+GATEWAY_UPSTREAM_MAX_CONCURRENCY = int(os.getenv('GATEWAY_UPSTREAM_MAX_CONCURRENCY', '0'))
+GATEWAY_UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('GATEWAY_UPSTREAM_QUEUE_TIMEOUT', '0.05'))
+
+# Refills a bucket for the time since its last request and takes a token, on
+# the Redis clock so that every pod sees the same time
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+def parse_rate_limits(value):
+    """Parse 'route=rate:burst,...' into {route: (rate, burst)}; burst defaults to rate"""
+    limits = {}
+    for pair in value.split(','):
+        if '=' not in pair:
+            continue
+        route, limit = pair.split('=', 1)
+        rate, _, burst = limit.partition(':')
+        limits[route.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+@functools.lru_cache(maxsize=256)
+def route_name(rule):
+    """Route name of a URL rule: /api/orders/<order_id> is 'orders/item'"""
+    return re.sub(r'<[^>]+>', 'item', rule[len('/api/'):]) if rule.startswith('/api/') else rule
+
+
+def client_id(headers, remote_addr, header=GATEWAY_CLIENT_ID_HEADER, hops=GATEWAY_TRUSTED_PROXY_HOPS):
+    """Identity a client is rate-limited under.
+
+    Entries left of the ones appended by trusted proxies are set by the
+    client itself, so the address is read that many hops from the right.
+    """
+    if header and headers.get(header):
+        return f'id:{headers[header]}'
+    if hops:
+        forwarded = [address.strip() for address in headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return remote_addr or 'unknown'
+
+
+class LocalBuckets:
+    """Token buckets held by this worker process, bounded as an LRU"""
+
+    def __init__(self, max_keys=GATEWAY_RATE_LIMIT_MAX_CLIENTS):
+        self.max_keys = max_keys
+        # key -> [tokens, last update]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def take(self, key, rate, burst):
+        """Take a token; returns 0 on success, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_keys:
+                    # The least recently seen client; its bucket starts full again
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBuckets:
+    """Token buckets shared by every gateway process through Redis"""
+
+    def __init__(self, url):
+        import redis
+        client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self._take = client.register_script(TAKE_TOKEN_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f'gateway:rate:{key}'], args=[rate, burst]))
+
+
+def create_bucket_backend(spec):
+    """Build the shared bucket store named by GATEWAY_RATE_LIMIT_BACKEND, if any"""
+    if not spec:
+        return None
+    if spec == 'local':
+        return LocalBuckets()
+    try:
+        return RedisBuckets(spec)
+    except ImportError:
+        logger.warning("redis package not installed, rate limiting with in-process buckets only")
+        return None
+
+
+class RateLimiter:
+    """Per-client token buckets for each limited route and across all routes.
+
+    Buckets live in the shared backend when there is one. If the backend
+    fails, this process falls back to its own buckets for that request, so
+    an outage loosens the limits instead of rejecting traffic.
+    """
+
+    def __init__(self, limits, backend=None, max_keys=GATEWAY_RATE_LIMIT_MAX_CLIENTS):
+        self.limits = limits
+        self.global_limit = limits.get('*')
+        self.local = LocalBuckets(max_keys)
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.counters = {'limited': 0, 'backend_errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _take(self, key, rate, burst):
+        if self.backend is not None:
+            try:
+                return self.backend.take(key, rate, burst)
+            except Exception as e:
+                self._count('backend_errors')
+                logger.warning(f"Rate limit backend unavailable: {str(e)}")
+        return self.local.take(key, rate, burst)
+
+    def check(self, client, route):
+        """Seconds the client has to wait before calling the route, 0 when admitted"""
+        # The route bucket goes first so a request it refuses costs no global token
+        limit = self.limits.get(route)
+        if limit is not None:
+            wait = self._take(f'{route}:{client}', *limit)
+            if wait:
+                self._count('limited')
+                return wait
+        if self.global_limit is not None:
+            wait = self._take(f'*:{client}', *self.global_limit)
+            if wait:
+                self._count('limited')
+                return wait
+        return 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.limits)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['limits'] = {route: {'rate': rate, 'burst': burst} for route, (rate, burst) in self.limits.items()}
+        stats['local_buckets'] = len(self.local)
+        stats['local_evictions'] = self.local.evictions
+        stats['shared_backend'] = self.backend is not None
+        return stats
+
+
+class ConcurrencyLimiter:
+    """Caps concurrent work, queueing a bounded number of waiters.
+
+    acquire() returns False instead of waiting once max_queue callers are
+    already queued, or after waiting queue_timeout seconds; the caller then
+    sheds the request rather than holding a thread for it.
+    """
+
+    def __init__(self, name, limit, max_queue=0, queue_timeout=0.0):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition(threading.Lock())
+        self.counters = {'admitted': 0, 'queued': 0, 'shed': 0, 'timed_out': 0}
+
+    def acquire(self):
+        """Take a slot; returns False when the caller should be turned away"""
+        with self._cond:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                self.counters['admitted'] += 1
+                return True
+            if self.waiting >= self.max_queue or self.queue_timeout <= 0:
+                self.counters['shed'] += 1
+                return False
+            self.waiting += 1
+            self.counters['queued'] += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters['timed_out'] += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.counters['admitted'] += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, limit=self.limit, in_flight=self.in_flight, waiting=self.waiting,
+                        max_queue=self.max_queue)
+
+
+def create_rate_limiter():
+    """Rate limiter configured from GATEWAY_RATE_LIMIT_* environment variables"""
+    return RateLimiter(parse_rate_limits(GATEWAY_RATE_LIMITS), create_bucket_backend(GATEWAY_RATE_LIMIT_BACKEND))
+
+
+def create_concurrency_limiter():
+    """Per-process limit on concurrent /api requests, or None when disabled"""
+    if GATEWAY_MAX_CONCURRENCY <= 0:
+        return None
+    return ConcurrencyLimiter('gateway', GATEWAY_MAX_CONCURRENCY, GATEWAY_MAX_QUEUE, GATEWAY_QUEUE_TIMEOUT)
+
+
+def create_upstream_limiter(name):
+    """Per-process cap on concurrent calls to one upstream, or None when disabled"""
+    if GATEWAY_UPSTREAM_MAX_CONCURRENCY <= 0:
+        return None
+    # As many callers again may wait briefly for a slot to free up
+    return ConcurrencyLimiter(name, GATEWAY_UPSTREAM_MAX_CONCURRENCY, GATEWAY_UPSTREAM_MAX_CONCURRENCY,
+                              GATEWAY_UPSTREAM_QUEUE_TIMEOUT)
@@ -0,0 +1,105 @@
+"""
+Response aggregation for the API Gateway
+Joins orders with their users and products using concurrent batch lookups
+"""
+
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common.serialization import loads
+
+GATEWAY_FANOUT_WORKERS = int(os.getenv('GATEWAY_FANOUT_WORKERS', '32'))
+# Ids per ?ids= lookup; must not exceed the services' MAX_PAGE_SIZE
+GATEWAY_BATCH_SIZE = int(os.getenv('GATEWAY_BATCH_SIZE', '100'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Shared thread pool for fan-out calls, created on first use per process"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=GATEWAY_FANOUT_WORKERS, thread_name_prefix='fanout'
+                )
+    return _executor
+
+
+def fetch_json(client, path):
+    """GET a path from an upstream and return (status, decoded body)"""
+    try:
+        response = client.request('GET', path)
+    except requests.exceptions.RequestException as e:
+        return 503, {'error': str(e)}
+    try:
+        return response.status_code, loads(response.content) if response.content else None
+    except ValueError:
+        return 502, {'error': 'Invalid JSON from upstream'}
+    finally:
+        response.close()
+
+
+def fetch_batch(client, service, ids):
+    """Look up ids with one ?ids= call; returns {id: (status, body)}"""
+    status, body = fetch_json(client, f"/api/{service}?ids={','.join(str(value) for value in ids)}")
+    if status != 200:
+        return {value: (status, body) for value in ids}
+    documents = body.get(service) if isinstance(body, dict) else None
+    if not isinstance(documents, list) or len(documents) != len(ids):
+        return {value: (502, {'error': 'Invalid batch response from upstream'}) for value in ids}
+    not_found = (404, {'error': f'{service[:-1].capitalize()} not found'})
+    return {
+        value: (200, document) if document is not None else not_found
+        for value, document in zip(ids, documents)
+    }
+
+
+def expand_orders(orders, upstreams):
+    """Attach 'user' and 'product' documents to each order in place.
+
+    Distinct users and products are looked up in batches of
+    GATEWAY_BATCH_SIZE ids, and all batches run concurrently. Failed
+    lookups leave the field as None and are listed in the returned errors.
+    """
+    executor = get_executor()
+    wanted = {'users': {}, 'products': {}}
+    for order in orders:
+        for service, field in (('users', 'user_id'), ('products', 'product_id')):
+            value = order.get(field)
+            if value is not None:
+                wanted[service][value] = None
+
+    futures = []
+    for service, ids in wanted.items():
+        ids = list(ids)
+        for start in range(0, len(ids), GATEWAY_BATCH_SIZE):
+            # Each batch runs in a copy of the request's trace context
+            futures.append((service, executor.submit(
+                contextvars.copy_context().run, fetch_batch, upstreams[service], service, ids[start:start + GATEWAY_BATCH_SIZE]
+            )))
+
+    results = {}
+    for service, future in futures:
+        for value, result in future.result().items():
+            results[(service, value)] = result
+    errors = []
+    for order in orders:
+        for service, field, target in (('users', 'user_id', 'user'), ('products', 'product_id', 'product')):
+            value = order.get(field)
+            status, body = results.get((service, value), (404, None))
+            if status == 200:
+                order[target] = body
+                continue
+            order[target] = None
+            error = {'order_id': order.get('id'), 'resource': target, 'id': value, 'status': status}
+            if isinstance(body, dict) and 'error' in body:
+                error['error'] = body['error']
+            errors.append(error)
+    return errors
@@ -3,24 +3,249 @@ API Gateway Service
 Routes requests to appropriate microservices
 """
 
-from flask import Flask, jsonify, request
-from flask_cors import CORS
+from flask import Response, g, jsonify, request
+from werkzeug.http import unquote_etag
 import requests
 import os
+import math
 import logging
+import contextvars
 from datetime import datetime
+from urllib.parse import urlencode
+
+from admission import (
+    GATEWAY_SHED_RETRY_AFTER,
+    client_id,
+    create_concurrency_limiter,
+    create_rate_limiter,
+    route_name
+)
+from aggregate import expand_orders, fetch_json, get_executor
+from cache import CachedResponse, create_response_cache, make_etag
+from common import compression, lifecycle
+from common.metrics import GATEWAY_REJECTED
+from common.pagination import PaginationError, decode_cursor, encode_cursor
+from resilience import CircuitOpenError, ResilientUpstream, UpstreamSaturatedError
+from singleflight import SingleFlight
+from upstream import UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT, UpstreamClient
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+app = lifecycle.create_app(__name__, 'api-gateway')
 
 # Service URLs from environment variables
 USER_SERVICE_URL = os.getenv('USER_SERVICE_URL', 'http://user-service:8080')
 ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order-service:8080')
 PRODUCT_SERVICE_URL = os.getenv('PRODUCT_SERVICE_URL', 'http://product-service:8080')
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Upstream response headers passed on to the client along with the body
+RELAYED_HEADERS = ('ETag', 'Cache-Control')
+STREAM_CHUNK_SIZE = 64 * 1024
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# Writes that change other resources too; placing an order reserves product stock
+WRITE_INVALIDATES = {'orders': ('products',)}
+
+# Services with a /changes feed, and the entity name their events carry
+CHANGE_FEEDS = {'users': 'user', 'orders': 'order', 'products': 'product'}
+
+# Pooled keep-alive clients, one per upstream service, each behind a circuit
+# breaker with budgeted retries
+UPSTREAMS = {
+    'users': ResilientUpstream(UpstreamClient('users', USER_SERVICE_URL)),
+    'orders': ResilientUpstream(UpstreamClient('orders', ORDER_SERVICE_URL)),
+    'products': ResilientUpstream(UpstreamClient('products', PRODUCT_SERVICE_URL))
+}
+
+def warm_upstreams():
+    """Connect to every upstream, so a new worker's first requests skip the handshakes"""
+    for name, upstream in UPSTREAMS.items():
+        try:
+            upstream.client.warm_up()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not warm up upstream {name}: {str(e)}")
+
+# The gateway is ready whenever it runs: an upstream outage is answered by the
+# circuit breakers, and failing readiness for it would take every pod out at once
+lifecycle.on_worker_start(warm_upstreams)
+
+response_cache = create_response_cache()
+
+# Identical concurrent GETs share one upstream call; replace inflight.key_func
+# to change what counts as identical
+inflight = SingleFlight(wait_timeout=UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT)
+
+# Per-client rate limits and the per-worker concurrency limit for /api requests;
+# probes, metrics and stats are never limited
+rate_limiter = create_rate_limiter()
+concurrency_limiter = create_concurrency_limiter()
+
+def rejected(status, message, retry_after, reason):
+    """Fast refusal with a Retry-After hint, sent before any upstream call"""
+    GATEWAY_REJECTED.labels(reason).inc()
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(math.ceil(retry_after), 1))
+    return response
+
+@app.before_request
+def admit_request():
+    """Apply rate limits, then wait for a concurrency slot or shed the request"""
+    rule = request.url_rule
+    if rule is None or not rule.rule.startswith('/api/') or request.method == 'OPTIONS':
+        return None
+    if rate_limiter.enabled:
+        wait = rate_limiter.check(client_id(request.headers, request.remote_addr), route_name(rule.rule))
+        if wait:
+            return rejected(429, 'Rate limit exceeded', wait, 'rate_limited')
+    if concurrency_limiter is not None:
+        if not concurrency_limiter.acquire():
+            return rejected(503, 'Gateway overloaded', GATEWAY_SHED_RETRY_AFTER, 'shed')
+        g.admission_slot = True
+    return None
+
+@app.teardown_request
+def release_admission(error=None):
+    if g.pop('admission_slot', False):
+        concurrency_limiter.release()
+
+def forward_request(client, path, conditional=False):
+    """Forward the current request to an upstream client"""
+    method = request.method
+    if request.query_string:
+        path = f'{path}?{request.query_string.decode()}'
+    if method in ('POST', 'PUT'):
+        headers = {}
+        if 'Idempotency-Key' in request.headers:
+            headers['Idempotency-Key'] = request.headers['Idempotency-Key']
+        return client.request(method, path, json=request.get_json(), headers=headers, stream=True)
+    headers = {}
+    if conditional and 'If-None-Match' in request.headers:
+        # Only for calls made for this client alone; a 304 is relayed as is
+        headers['If-None-Match'] = request.headers['If-None-Match']
+    return client.request(method, path, headers=headers, stream=True)
+
+def stream_body(response, decode=True):
+    """Yield an upstream body in chunks, releasing the connection at the end"""
+    try:
+        if decode:
+            yield from response.iter_content(STREAM_CHUNK_SIZE)
+        else:
+            yield from response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+    finally:
+        response.close()
+
+def raw_body(response):
+    """Read an upstream body as sent, without decoding its Content-Encoding"""
+    body = response.raw.read(decode_content=False)
+    # Fully read, so the connection can go back to the pool
+    response.raw.release_conn()
+    return body
+
+def passthrough(response):
+    """Relay an upstream response, still compressed if the client accepts its encoding"""
+    content_type = response.headers.get('Content-Type', 'application/json')
+    encoding = response.headers.get('Content-Encoding')
+    relay_encoded = encoding is not None and compression.accepts(request.headers.get('Accept-Encoding', ''), encoding)
+    if content_type.startswith(NDJSON_MIMETYPE):
+        # Exports are unbounded, so relay them chunk by chunk
+        body = stream_body(response, decode=not relay_encoded)
+    else:
+        body = raw_body(response) if relay_encoded else response.content
+    relayed = Response(body, status=response.status_code, content_type=content_type)
+    for header in RELAYED_HEADERS:
+        if header in response.headers:
+            relayed.headers[header] = response.headers[header]
+    if relay_encoded:
+        relayed.headers['Content-Encoding'] = encoding
+        relayed.vary.add('Accept-Encoding')
+    elif 'ETag' in response.headers:
+        etag, weak = unquote_etag(response.headers['ETag'])
+        relayed.set_etag(compression.base_etag(etag), weak)
+    return relayed
+
+def upstream_unavailable(service, label, error):
+    """503 response for a failed or short-circuited upstream call"""
+    logger.error(f"Error proxying to {label.lower()} service: {str(error)}")
+    response = jsonify({'error': f'{label} service unavailable'})
+    response.status_code = 503
+    if isinstance(error, CircuitOpenError):
+        response.headers['Retry-After'] = str(max(math.ceil(UPSTREAMS[service].breaker.retry_after()), 1))
+    elif isinstance(error, UpstreamSaturatedError):
+        response.headers['Retry-After'] = str(GATEWAY_SHED_RETRY_AFTER)
+    return response
+
+def cached_response(entry, cache_status=None):
+    """Serve a materialized response, answering a matching If-None-Match with 304"""
+    matched = compression.matching_etag(entry.etag) if entry.status == 200 else None
+    if matched is not None:
+        response_cache.record_not_modified()
+        response = compression.not_modified(matched)
+    elif entry.encoding is None:
+        response = Response(entry.body, status=entry.status, content_type=entry.content_type)
+        response.set_etag(entry.etag)
+    elif compression.accepts(request.headers.get('Accept-Encoding', ''), entry.encoding):
+        response = Response(entry.body, status=entry.status, content_type=entry.content_type)
+        response.headers['Content-Encoding'] = entry.encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(entry.etag)
+    else:
+        # Decoded here and encoded again in whatever the client accepts
+        body = compression.decompress(entry.body, entry.encoding)
+        response = Response(body, status=entry.status, content_type=entry.content_type)
+        response.set_etag(compression.base_etag(entry.etag))
+    if cache_status:
+        response.headers['X-Cache'] = cache_status
+    return response
+
+def proxy_to(service, route, path):
+    """Forward the current request, serving GETs from the cache or a shared in-flight call"""
+    client = UPSTREAMS[service]
+    if request.method in WRITE_METHODS:
+        response = forward_request(client, path)
+        response_cache.invalidate(service)
+        for dependent in WRITE_INVALIDATES.get(service, ()):
+            response_cache.invalidate(dependent)
+        return passthrough(response)
+    
+    coalesce_key = inflight.key(request)
+    ttl = response_cache.ttl_for(route) if request.method == 'GET' else 0
+    generation = response_cache.generation(service) if ttl else None
+    if coalesce_key is None and generation is None:
+        return passthrough(forward_request(client, path, conditional=True))
+    
+    cache_key = None
+    if generation is not None:
+        cache_key = response_cache.key(service, generation, request.full_path)
+        entry = response_cache.get(cache_key)
+        if entry is not None:
+            return cached_response(entry, 'HIT')
+    
+    def fetch():
+        response = forward_request(client, path)
+        content_type = response.headers.get('Content-Type', 'application/json')
+        if coalesce_key is None and content_type.startswith(NDJSON_MIMETYPE):
+            return response
+        encoding = response.headers.get('Content-Encoding')
+        body = raw_body(response) if encoding else response.content
+        if 'ETag' in response.headers:
+            etag = unquote_etag(response.headers['ETag'])[0]
+        else:
+            etag = f'{make_etag(body)}-{encoding}' if encoding else make_etag(body)
+        entry = CachedResponse(response.status_code, content_type, etag, body, encoding)
+        if (cache_key is not None and response.status_code == 200
+                and 'no-store' not in response.headers.get('Cache-Control', '')):
+            response_cache.set(cache_key, entry, ttl)
+        return entry
+    
+    result, shared = inflight.do(coalesce_key, fetch)
+    if not isinstance(result, CachedResponse):
+        return passthrough(result)
+    if shared:
+        return cached_response(result, 'COALESCED')
+    return cached_response(result, 'MISS' if cache_key else None)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -44,83 +269,160 @@ def index():
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
+@app.route('/stats/upstreams', methods=['GET'])
+def upstream_stats():
+    """Connection pool, circuit breaker and retry statistics for each upstream"""
+    return jsonify({
+        'pid': os.getpid(),
+        'upstreams': {name: client.stats() for name, client in UPSTREAMS.items()},
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    """Response cache and request coalescing statistics for this worker process"""
+    return jsonify({
+        'pid': os.getpid(),
+        'cache': response_cache.stats(),
+        'coalescing': inflight.stats(),
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    """Rate limiter and concurrency limiter statistics for this worker process"""
+    return jsonify({
+        'pid': os.getpid(),
+        'rate_limits': rate_limiter.stats(),
+        'concurrency': concurrency_limiter.stats() if concurrency_limiter is not None else None,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
 @app.route('/api/users', methods=['GET', 'POST'])
 @app.route('/api/users/<user_id>', methods=['GET', 'PUT', 'DELETE'])
+@app.route('/api/users/bulk', methods=['POST'], defaults={'user_id': 'bulk'})
 def users_proxy(user_id=None):
     """Proxy requests to User Service"""
     try:
-        method = request.method
-        url = f'{USER_SERVICE_URL}/api/users'
+        path = '/api/users'
+        route = 'users'
         if user_id:
-            url = f'{url}/{user_id}'
+            path = f'{path}/{user_id}'
+            route = 'users/item'
         
-        if method == 'GET':
-            response = requests.get(url, timeout=5)
-        elif method == 'POST':
-            response = requests.post(url, json=request.get_json(), timeout=5)
-        elif method == 'PUT':
-            response = requests.put(url, json=request.get_json(), timeout=5)
-        elif method == 'DELETE':
-            response = requests.delete(url, timeout=5)
-        else:
-            return jsonify({'error': 'Method not allowed'}), 405
-        
-        return jsonify(response.json()), response.status_code
+        return proxy_to('users', route, path)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error proxying to user service: {str(e)}")
-        return jsonify({'error': 'User service unavailable'}), 503
+        return upstream_unavailable('users', 'User', e)
 
 @app.route('/api/orders', methods=['GET', 'POST'])
 @app.route('/api/orders/<order_id>', methods=['GET', 'PUT', 'DELETE'])
+@app.route('/api/orders/bulk', methods=['POST'], defaults={'order_id': 'bulk'})
 def orders_proxy(order_id=None):
     """Proxy requests to Order Service"""
     try:
-        method = request.method
-        url = f'{ORDER_SERVICE_URL}/api/orders'
+        path = '/api/orders'
+        route = 'orders'
         if order_id:
-            url = f'{url}/{order_id}'
-        
-        if method == 'GET':
-            response = requests.get(url, timeout=5)
-        elif method == 'POST':
-            response = requests.post(url, json=request.get_json(), timeout=5)
-        elif method == 'PUT':
-            response = requests.put(url, json=request.get_json(), timeout=5)
-        elif method == 'DELETE':
-            response = requests.delete(url, timeout=5)
-        else:
-            return jsonify({'error': 'Method not allowed'}), 405
+            path = f'{path}/{order_id}'
+            route = 'orders/item'
         
-        return jsonify(response.json()), response.status_code
+        return proxy_to('orders', route, path)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error proxying to order service: {str(e)}")
-        return jsonify({'error': 'Order service unavailable'}), 503
+        return upstream_unavailable('orders', 'Order', e)
+
+@app.route('/api/orders/<int:order_id>/expanded', methods=['GET'])
+def order_expanded(order_id):
+    """Order joined with its user and product in one response"""
+    status, order = fetch_json(UPSTREAMS['orders'], f'/api/orders/{order_id}')
+    if status != 200:
+        if status == 503:
+            return jsonify({'error': 'Order service unavailable'}), 503
+        return jsonify(order), status
+    
+    errors = expand_orders([order], UPSTREAMS)
+    order['errors'] = errors
+    return jsonify(order), 200
+
+@app.route('/api/orders/expanded', methods=['GET'])
+def orders_expanded():
+    """Page of orders, each joined with its user and product"""
+    path = '/api/orders'
+    if request.query_string:
+        path = f'{path}?{request.query_string.decode()}'
+    status, page = fetch_json(UPSTREAMS['orders'], path)
+    if status != 200:
+        if status == 503:
+            return jsonify({'error': 'Order service unavailable'}), 503
+        return jsonify(page), status
+    
+    page['errors'] = expand_orders(page.get('orders', []), UPSTREAMS)
+    return jsonify(page), 200
+
+@app.route('/api/changes', methods=['GET'])
+def changes():
+    """Change events of every service after a combined since cursor.
+
+    The cursor holds one position per service. A service that fails keeps
+    its old position and is listed in errors, so the next call retries it.
+    """
+    try:
+        positions = dict.fromkeys(CHANGE_FEEDS)
+        if request.args.get('since'):
+            since = decode_cursor(request.args['since'], 1)[0]
+            if (not isinstance(since, dict) or set(since) - set(CHANGE_FEEDS)
+                    or not all(value is None or isinstance(value, str) for value in since.values())):
+                raise PaginationError('Invalid cursor')
+            positions.update(since)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    futures = {}
+    for service in CHANGE_FEEDS:
+        params = {'since': positions[service]} if positions.get(service) else {}
+        if request.args.get('limit'):
+            params['limit'] = request.args['limit']
+        path = f'/api/{service}/changes'
+        if params:
+            path = f'{path}?{urlencode(params)}'
+        futures[service] = get_executor().submit(contextvars.copy_context().run, fetch_json, UPSTREAMS[service], path)
+    
+    events = []
+    errors = []
+    for service, future in futures.items():
+        status, body = future.result()
+        if status == 200:
+            events.extend(dict(event, entity=CHANGE_FEEDS[service]) for event in body['events'])
+            positions[service] = body['next_cursor']
+            continue
+        if status in (400, 410):
+            # The consumer has to resync this service from a full read
+            return jsonify(dict(body or {}, service=service)), status
+        errors.append({'service': service, 'status': status, 'error': (body or {}).get('error')})
+    
+    response = jsonify({
+        'events': events,
+        'count': len(events),
+        'next_cursor': encode_cursor(positions),
+        'errors': errors
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 200
 
 @app.route('/api/products', methods=['GET', 'POST'])
 @app.route('/api/products/<product_id>', methods=['GET', 'PUT', 'DELETE'])
+@app.route('/api/products/bulk', methods=['POST'], defaults={'product_id': 'bulk'})
 def products_proxy(product_id=None):
     """Proxy requests to Product Service"""
     try:
-        method = request.method
-        url = f'{PRODUCT_SERVICE_URL}/api/products'
+        path = '/api/products'
+        route = 'products'
         if product_id:
-            url = f'{url}/{product_id}'
-        
-        if method == 'GET':
-            response = requests.get(url, timeout=5)
-        elif method == 'POST':
-            response = requests.post(url, json=request.get_json(), timeout=5)
-        elif method == 'PUT':
-            response = requests.put(url, json=request.get_json(), timeout=5)
-        elif method == 'DELETE':
-            response = requests.delete(url, timeout=5)
-        else:
-            return jsonify({'error': 'Method not allowed'}), 405
+            path = f'{path}/{product_id}'
+            route = 'products/item'
         
-        return jsonify(response.json()), response.status_code
+        return proxy_to('products', route, path)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error proxying to product service: {str(e)}")
-        return jsonify({'error': 'Product service unavailable'}), 503
+        return upstream_unavailable('products', 'Product', e)
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
@@ -0,0 +1,382 @@
+"""
+API Gateway Service (async mode)
+ASGI application that streams upstream responses straight through
+
+A reduced gateway: no response cache, request coalescing, circuit breakers,
+retries, admission control or gateway-side compression, and no expanded or
+combined change feed routes. Those are served by the Flask app in sync mode.
+"""
+
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from common import tracing
+from common.serialization import dumps
+from common.metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, UPSTREAM_LATENCY, registry
+from upstream import (
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_POOL_MAXSIZE,
+    UPSTREAM_READ_TIMEOUT
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which floods the access log
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Service URLs from environment variables
+USER_SERVICE_URL = os.getenv('USER_SERVICE_URL', 'http://user-service:8080')
+ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order-service:8080')
+PRODUCT_SERVICE_URL = os.getenv('PRODUCT_SERVICE_URL', 'http://product-service:8080')
+
+# Async mode can hold many more in-flight requests per worker than sync mode
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', str(UPSTREAM_POOL_MAXSIZE * 10)))
+ASYNC_MAX_KEEPALIVE = int(os.getenv('ASYNC_MAX_KEEPALIVE', str(UPSTREAM_POOL_MAXSIZE)))
+
+SERVICES = {
+    'users': (USER_SERVICE_URL, 'User'),
+    'orders': (ORDER_SERVICE_URL, 'Order'),
+    'products': (PRODUCT_SERVICE_URL, 'Product')
+}
+
+ROUTE_PATTERN = re.compile(r'^/api/(users|orders|products)(?:/([^/]+))?/?$')
+COLLECTION_METHODS = ('GET', 'POST')
+ITEM_METHODS = ('GET', 'PUT', 'DELETE')
+BULK_METHODS = ('POST',)
+
+# Hop-by-hop headers must not be forwarded by a proxy (RFC 9110 section 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host'
+}
+# The ASGI server sets its own Date and Server headers
+RESPONSE_SKIP_HEADERS = HOP_BY_HOP_HEADERS | {'date', 'server'}
+
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+FIXED_ROUTES = ('/', '/health', '/livez', '/readyz', '/metrics', '/stats/upstreams')
+# Served by the gateway itself in sync mode only; answered with 501 here
+SYNC_ONLY_ROUTE_PATTERN = re.compile(r'^/api/(?:orders/(?:[^/]+/)?expanded|changes)/?$|^/stats/(?:cache|admission)$')
+# Protections async mode does not apply; a deployment that configures one
+# must not run without it unnoticed
+SYNC_ONLY_SETTINGS = ('GATEWAY_RATE_LIMITS', 'GATEWAY_MAX_CONCURRENCY', 'GATEWAY_UPSTREAM_MAX_CONCURRENCY')
+
+
+
+def check_settings(environ=os.environ):
+    """Refuse to start with settings that only sync mode applies"""
+    configured = [name for name in SYNC_ONLY_SETTINGS if environ.get(name, '').strip() not in ('', '0')]
+    if configured:
+        raise RuntimeError(f"Async mode does not apply {', '.join(configured)}; unset them or use GATEWAY_MODE=sync")
+
+
+check_settings()
+
+clients = {}
+tracer = tracing.configure('api-gateway')
+
+
+def create_clients():
+    """Create one pooled async client per upstream service"""
+    limits = httpx.Limits(
+        max_connections=ASYNC_MAX_CONNECTIONS,
+        max_keepalive_connections=ASYNC_MAX_KEEPALIVE
+    )
+    timeout = httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+    for name, (base_url, _) in SERVICES.items():
+        clients[name] = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout)
+
+
+async def close_clients():
+    """Close all upstream clients"""
+    for client in clients.values():
+        await client.aclose()
+    clients.clear()
+
+
+def pool_stats(client):
+    """Return connection pool statistics for an async client"""
+    pool = client._transport._pool
+    connections = pool.connections
+    idle = sum(1 for conn in connections if conn.is_idle())
+    return {
+        'base_url': str(client.base_url),
+        'max_connections': ASYNC_MAX_CONNECTIONS,
+        'max_keepalive': ASYNC_MAX_KEEPALIVE,
+        'in_use': len(connections) - idle,
+        'idle': idle,
+        'waiting': sum(1 for req in getattr(pool, '_requests', []) if req.connection is None)
+    }
+
+
+async def send_json(send, payload, status=200):
+    """Send a complete JSON response"""
+    body = dumps(payload)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode())
+        ] + CORS_HEADERS
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_preflight(scope, send):
+    """Answer a CORS preflight request"""
+    request_headers = dict(scope['headers'])
+    headers = CORS_HEADERS + [
+        (b'access-control-allow-methods', b'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'),
+        (b'content-length', b'0')
+    ]
+    if b'access-control-request-headers' in request_headers:
+        headers.append((b'access-control-allow-headers', request_headers[b'access-control-request-headers']))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def request_body(receive):
+    """Yield the incoming request body chunk by chunk"""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunk = message.get('body', b'')
+        if chunk:
+            yield chunk
+        more_body = message.get('more_body', False)
+
+
+async def proxy(scope, receive, send, service):
+    """Stream a request to an upstream and its response back to the client"""
+    _, label = SERVICES[service]
+    client = clients[service]
+    method = scope['method']
+    headers = [
+        (name, value) for name, value in scope['headers']
+        if name.decode('latin-1').lower() not in HOP_BY_HOP_HEADERS
+        and (tracer is None or name.lower() != b'traceparent')
+    ]
+    content = request_body(receive) if method in ('POST', 'PUT') else None
+    target = (scope.get('raw_path') or scope['path'].encode()).decode('latin-1')
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    if query_string:
+        target = f'{target}?{query_string}'
+    span = tracer.start_span(f'{method} {service}', 'client') if tracing.current_span() else None
+    if span is not None:
+        # The client span replaces the caller's traceparent as the upstream's parent
+        headers.append((b'traceparent', span.traceparent().encode()))
+        span.set_attribute('upstream', service)
+    upstream_request = client.build_request(method, target, headers=headers, content=content)
+    started = time.perf_counter()
+    try:
+        response = await client.send(upstream_request, stream=True)
+    except httpx.RequestError as e:
+        UPSTREAM_LATENCY.labels(service, method, 'error').observe(time.perf_counter() - started)
+        if span is not None:
+            span.record_error(e)
+            span.end()
+        logger.error(f"Error proxying to {label.lower()} service: {str(e)}")
+        await send_json(send, {'error': f'{label} service unavailable'}, 503)
+        return
+    UPSTREAM_LATENCY.labels(service, method, str(response.status_code)).observe(time.perf_counter() - started)
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+        span.end()
+
+    try:
+        response_headers = [
+            (name, value) for name, value in response.headers.raw
+            if name.decode('latin-1').lower() not in RESPONSE_SKIP_HEADERS
+        ] + CORS_HEADERS
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers
+        })
+        async for chunk in response.aiter_raw():
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except httpx.RequestError as e:
+        # Headers are already sent, so the only option is to cut the stream
+        logger.error(f"Upstream {label.lower()} service failed mid-stream: {str(e)}")
+        raise
+    finally:
+        await response.aclose()
+
+
+async def lifespan(receive, send):
+    """Manage upstream clients across the server lifespan"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            create_clients()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def route_label(path):
+    """Metrics route label matching the Flask app's URL rules"""
+    if path in FIXED_ROUTES:
+        return path
+    if SYNC_ONLY_ROUTE_PATTERN.match(path):
+        return 'sync_only'
+    match = ROUTE_PATTERN.match(path)
+    if not match:
+        return 'unmatched'
+    service, resource_id = match.groups()
+    if resource_id is None:
+        return f'/api/{service}'
+    if resource_id == 'bulk':
+        return f'/api/{service}/bulk'
+    return f'/api/{service}/<{service[:-1]}_id>'
+
+
+async def app(scope, receive, send):
+    """ASGI entry point; records request metrics and the server span around handle()"""
+    if scope['type'] != 'http':
+        await handle(scope, receive, send)
+        return
+
+    started = time.perf_counter()
+    observed = []
+    route = route_label(scope['path'])
+    server = None
+    if tracer is not None:
+        traceparent = next((value for name, value in scope['headers'] if name.lower() == b'traceparent'), b'')
+        server = tracer.start_remote(f"{scope['method']} {route}", traceparent.decode('latin-1'), {
+            'http.method': scope['method'],
+            'http.target': scope['path']
+        })
+
+    async def send_and_observe(message):
+        # Latency is taken when the response starts, as in the Flask app
+        if message['type'] == 'http.response.start' and not observed:
+            observed.append(True)
+            REQUEST_LATENCY.labels(scope['method'], route, str(message['status'])).observe(
+                time.perf_counter() - started
+            )
+            if server is not None:
+                server.set_attribute('http.status_code', message['status'])
+                # Upstreams tag their responses with the same trace id
+                message = dict(message, headers=[
+                    (name, value) for name, value in message.get('headers', []) if name.lower() != b'x-trace-id'
+                ] + [(b'x-trace-id', server.trace_id.encode())])
+        await send(message)
+
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        if server is None:
+            await handle(scope, receive, send_and_observe)
+        else:
+            with tracing.activate(server):
+                await handle(scope, receive, send_and_observe)
+    except Exception as e:
+        if server is not None:
+            server.record_error(e)
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        if server is not None:
+            server.end()
+
+
+async def handle(scope, receive, send):
+    """Route a request to the built-in endpoints or an upstream"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if not clients:
+        create_clients()
+
+    path = scope['path']
+    method = scope['method']
+
+    if method == 'OPTIONS':
+        await send_preflight(scope, send)
+        return
+
+    if path == '/health' and method == 'GET':
+        await send_json(send, {
+            'status': 'healthy',
+            'service': 'api-gateway',
+            'mode': 'async',
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        return
+
+    if path in ('/livez', '/readyz') and method == 'GET':
+        # As in sync mode, readiness does not depend on the upstreams
+        await send_json(send, {
+            'status': 'alive' if path == '/livez' else 'ready',
+            'service': 'api-gateway',
+            'mode': 'async'
+        })
+        return
+
+    if path == '/' and method == 'GET':
+        await send_json(send, {
+            'message': 'API Gateway - Microservices Platform',
+            'version': '1.0.0',
+            'services': {
+                name: f'{base_url}/api/{name}' for name, (base_url, _) in SERVICES.items()
+            },
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        return
+
+    if path == '/stats/upstreams' and method == 'GET':
+        await send_json(send, {
+            'pid': os.getpid(),
+            'upstreams': {name: pool_stats(client) for name, client in clients.items()},
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        return
+
+    if SYNC_ONLY_ROUTE_PATTERN.match(path):
+        await send_json(send, {'error': 'Not available in async mode; run the gateway with GATEWAY_MODE=sync'}, 501)
+        return
+
+    if path == '/metrics' and method == 'GET':
+        body = generate_latest(registry())
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', CONTENT_TYPE_LATEST.encode()),
+                (b'content-length', str(len(body)).encode())
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        return
+
+    match = ROUTE_PATTERN.match(path)
+    if not match:
+        await send_json(send, {'error': 'Not found'}, 404)
+        return
+
+    service, resource_id = match.groups()
+    if resource_id == 'bulk':
+        allowed = BULK_METHODS
+    elif resource_id:
+        allowed = ITEM_METHODS
+    else:
+        allowed = COLLECTION_METHODS
+    if method not in allowed:
+        await send_json(send, {'error': 'Method not allowed'}, 405)
+        return
+
+    await proxy(scope, receive, send, service)
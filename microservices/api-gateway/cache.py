@@ -0,0 +1,314 @@
+"""
+Response cache for the API Gateway
+In-process LRU with an optional shared backend and generation-based invalidation
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration from environment variables
+GATEWAY_CACHE_ENABLED = os.getenv('GATEWAY_CACHE_ENABLED', 'true').lower() == 'true'
+GATEWAY_CACHE_MAX_ENTRIES = int(os.getenv('GATEWAY_CACHE_MAX_ENTRIES', '1000'))
+GATEWAY_CACHE_MAX_BYTES = int(os.getenv('GATEWAY_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Comma-separated route=seconds pairs; routes not listed are not cached
+GATEWAY_CACHE_TTLS = os.getenv('GATEWAY_CACHE_TTLS', 'products=30,products/item=60')
+# redis://... for a cache shared by all gateway pods, "local" for an in-process stand-in
+GATEWAY_CACHE_BACKEND = os.getenv('GATEWAY_CACHE_BACKEND', '')
+# Without a shared backend a write invalidates only the worker that proxied it,
+# and every other worker and pod serves its stale entries until they expire.
+# Routes are then cached for at most this many seconds; 0 turns caching off
+GATEWAY_CACHE_LOCAL_MAX_TTL = float(os.getenv('GATEWAY_CACHE_LOCAL_MAX_TTL', '0'))
+
+
+def parse_ttls(value):
+    """Parse 'route=seconds,...' into a dict"""
+    ttls = {}
+    for pair in value.split(','):
+        if '=' not in pair:
+            continue
+        route, seconds = pair.split('=', 1)
+        ttls[route.strip()] = float(seconds)
+    return ttls
+
+
+def make_etag(body):
+    """Strong (unquoted) ETag derived from the response body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class CachedResponse:
+    """An upstream response held in the cache, with its body as the upstream encoded it"""
+
+    __slots__ = ('status', 'content_type', 'etag', 'body', 'encoding')
+
+    def __init__(self, status, content_type, etag, body, encoding=None):
+        self.status = status
+        self.content_type = content_type
+        self.etag = etag
+        self.body = body
+        self.encoding = encoding
+
+    def size(self):
+        return len(self.body)
+
+    def dumps(self):
+        header = json.dumps([self.status, self.content_type, self.etag, self.encoding]).encode()
+        return header + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, data):
+        header, body = data.split(b'\n', 1)
+        # Entries written before bodies were kept encoded have no encoding
+        status, content_type, etag, *encoding = json.loads(header)
+        return cls(status, content_type, etag, body, encoding[0] if encoding else None)
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by entry count and total body bytes"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = value.size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= value.size()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+class LocalBackend:
+    """In-process stand-in for the shared backend, for tests and local runs"""
+
+    # Each worker process has its own, so invalidations do not reach the others
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+
+    def incr(self, key):
+        with self._lock:
+            _, value = self._data.get(key, (None, b'0'))
+            value = str(int(value) + 1).encode()
+            self._data[key] = (None, value)
+            return int(value)
+
+
+class RedisBackend:
+    """Shared cache backend on Redis (e.g. ElastiCache)"""
+
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl):
+        self._client.set(key, value, px=int(ttl * 1000))
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+
+def create_backend(spec):
+    """Build the shared backend named by GATEWAY_CACHE_BACKEND, if any"""
+    if not spec:
+        return None
+    if spec == 'local':
+        return LocalBackend()
+    try:
+        return RedisBackend(spec)
+    except ImportError:
+        logger.warning("redis package not installed, using the in-process cache only")
+        return None
+
+
+class ResponseCache:
+    """Two-tier GET response cache keyed by resource generation.
+
+    Each resource (users, orders, products) has a generation number that is
+    bumped whenever the gateway proxies a write to it. Entries are stored
+    under the generation current when the upstream call started, so a write
+    makes every older entry unreachable without scanning for it.
+
+    Generations are only seen by every worker through a shared backend;
+    without one, TTLs are capped at local_max_ttl, the staleness accepted.
+    """
+
+    def __init__(self, ttls, max_entries, max_bytes, backend=None, enabled=True,
+                 local_max_ttl=GATEWAY_CACHE_LOCAL_MAX_TTL):
+        self.ttls = ttls
+        self.enabled = enabled
+        self.local = LRUCache(max_entries, max_bytes)
+        self.backend = backend
+        self.shared = backend is not None and backend.shared
+        self.local_max_ttl = local_max_ttl
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0,
+            'not_modified': 0, 'backend_errors': 0
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def ttl_for(self, route):
+        """Seconds to cache a route for, or 0 when it is not cached"""
+        if not self.enabled:
+            return 0
+        ttl = self.ttls.get(route, 0)
+        if not self.shared:
+            return min(ttl, self.local_max_ttl)
+        return ttl
+
+    def generation(self, resource):
+        """Current generation of a resource, or None if it cannot be read"""
+        if self.backend is not None:
+            try:
+                value = self.backend.get(f'gateway:gen:{resource}')
+                return int(value) if value else 0
+            except Exception as e:
+                self._count('backend_errors')
+                logger.warning(f"Cache backend unavailable: {str(e)}")
+                return None
+        with self._lock:
+            return self._generations.get(resource, 0)
+
+    def key(self, resource, generation, request_key):
+        return f'gateway:resp:{resource}:{generation}:{request_key}'
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.backend is not None:
+            try:
+                data = self.backend.get(key)
+                if data is not None:
+                    entry = CachedResponse.loads(data)
+            except Exception as e:
+                self._count('backend_errors')
+                logger.warning(f"Cache backend unavailable: {str(e)}")
+        self._count('hits' if entry is not None else 'misses')
+        return entry
+
+    def set(self, key, entry, ttl):
+        self.local.set(key, entry, ttl)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, entry.dumps(), ttl)
+            except Exception as e:
+                self._count('backend_errors')
+                logger.warning(f"Cache backend unavailable: {str(e)}")
+        self._count('stores')
+
+    def invalidate(self, resource):
+        """Make every cached response for a resource unreachable"""
+        with self._lock:
+            self._generations[resource] = self._generations.get(resource, 0) + 1
+        if self.backend is not None:
+            try:
+                self.backend.incr(f'gateway:gen:{resource}')
+            except Exception as e:
+                self._count('backend_errors')
+                logger.warning(f"Cache backend unavailable: {str(e)}")
+        self._count('invalidations')
+
+    def record_not_modified(self):
+        self._count('not_modified')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['generations'] = dict(self._generations)
+        stats.update(self.local.stats())
+        # What is actually cached: without a shared backend TTLs are capped,
+        # down to nothing with the default cap of 0
+        ttls = {route: self.ttl_for(route) for route in self.ttls}
+        stats['enabled'] = any(ttls.values())
+        stats['shared_backend'] = type(self.backend).__name__ if self.backend else None
+        stats['ttls'] = ttls
+        stats['configured_ttls'] = self.ttls
+        stats['local_max_ttl'] = None if self.shared else self.local_max_ttl
+        return stats
+
+
+def create_response_cache():
+    """Build the gateway response cache from environment configuration"""
+    cache = ResponseCache(
+        parse_ttls(GATEWAY_CACHE_TTLS),
+        GATEWAY_CACHE_MAX_ENTRIES,
+        GATEWAY_CACHE_MAX_BYTES,
+        backend=create_backend(GATEWAY_CACHE_BACKEND),
+        enabled=GATEWAY_CACHE_ENABLED
+    )
+    if cache.enabled and cache.ttls and not cache.shared:
+        logger.info(f"No shared cache backend; response cache TTLs capped at {cache.local_max_ttl}s")
+    return cache
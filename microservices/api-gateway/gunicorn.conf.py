@@ -0,0 +1,30 @@
+"""
+Gunicorn configuration for the API Gateway
+GATEWAY_MODE=sync serves the Flask app, GATEWAY_MODE=async the ASGI app
+"""
+
+import os
+
+from common.gunicorn_conf import (  # noqa: F401
+    child_exit,
+    graceful_timeout,
+    on_starting,
+    post_worker_init,
+    preload_app,
+    when_ready
+)
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+timeout = 120
+accesslog = '-'
+errorlog = '-'
+
+if os.getenv('GATEWAY_MODE', 'sync') == 'async':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'asgi:app'
+else:
+    # Threads let concurrent identical GETs within a worker share one upstream call
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', '8'))
+    wsgi_app = 'app:app'
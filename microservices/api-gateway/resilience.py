@@ -0,0 +1,345 @@
+"""
+Upstream resilience for the API Gateway
+Circuit breaker, retry budget, concurrency cap and hedged GETs around each upstream client
+"""
+
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from admission import create_upstream_limiter
+from common.metrics import UPSTREAM_CIRCUIT_OPEN, UPSTREAM_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker configuration
+GATEWAY_BREAKER_FAILURE_THRESHOLD = int(os.getenv('GATEWAY_BREAKER_FAILURE_THRESHOLD', '5'))
+GATEWAY_BREAKER_OPEN_SECONDS = float(os.getenv('GATEWAY_BREAKER_OPEN_SECONDS', '10'))
+GATEWAY_BREAKER_HALF_OPEN_CALLS = int(os.getenv('GATEWAY_BREAKER_HALF_OPEN_CALLS', '1'))
+
+# Retry configuration; retries are limited to idempotent methods
+GATEWAY_RETRY_MAX_ATTEMPTS = int(os.getenv('GATEWAY_RETRY_MAX_ATTEMPTS', '2'))
+GATEWAY_RETRY_BACKOFF = float(os.getenv('GATEWAY_RETRY_BACKOFF', '0.05'))
+GATEWAY_RETRY_BUDGET_RATIO = float(os.getenv('GATEWAY_RETRY_BUDGET_RATIO', '0.1'))
+GATEWAY_RETRY_MIN_PER_SECOND = float(os.getenv('GATEWAY_RETRY_MIN_PER_SECOND', '1'))
+
+# Hedging configuration; a second GET is sent once the first is slower than
+# the given percentile of recent latencies
+GATEWAY_HEDGE_ENABLED = os.getenv('GATEWAY_HEDGE_ENABLED', 'false').lower() == 'true'
+GATEWAY_HEDGE_PERCENTILE = float(os.getenv('GATEWAY_HEDGE_PERCENTILE', '95'))
+GATEWAY_HEDGE_MIN_SAMPLES = int(os.getenv('GATEWAY_HEDGE_MIN_SAMPLES', '50'))
+GATEWAY_HEDGE_WORKERS = int(os.getenv('GATEWAY_HEDGE_WORKERS', '32'))
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRYABLE_STATUS = (502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+
+class UpstreamSaturatedError(requests.exceptions.RequestException):
+    """Raised instead of calling an upstream that has its cap of calls in flight"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a half-open probe phase"""
+
+    def __init__(self, name, failure_threshold=GATEWAY_BREAKER_FAILURE_THRESHOLD,
+                 open_seconds=GATEWAY_BREAKER_OPEN_SECONDS,
+                 half_open_calls=GATEWAY_BREAKER_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.transitions = {}
+        self.rejected = 0
+
+    def _transition(self, state):
+        key = f'{self.state}->{state}'
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        logger.warning(f"Circuit for {self.name} upstream {self.state} -> {state}")
+        self.state = state
+        UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(1 if state == OPEN else 0)
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._probes = 0
+        self._failures = 0
+
+    def allow(self):
+        """Return True if a call may go to the upstream now"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED)
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._transition(OPEN)
+                return
+            self._failures += 1
+            if self.state == CLOSED and self._failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+    def retry_after(self):
+        """Seconds until an open circuit lets a probe through"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0
+            return max(self.open_seconds - (time.monotonic() - self._opened_at), 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'rejected': self.rejected,
+                'transitions': dict(self.transitions)
+            }
+
+
+class RetryBudget:
+    """Caps retries (and hedges) to a fraction of regular traffic.
+
+    Every request deposits `ratio` tokens and every retry withdraws one, with
+    a floor of `min_per_second` retries so an idle upstream can still retry.
+    """
+
+    def __init__(self, ratio=GATEWAY_RETRY_BUDGET_RATIO, min_per_second=GATEWAY_RETRY_MIN_PER_SECOND):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max(10.0, min_per_second * 10)
+        self._tokens = self.max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.denied = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for a retry; returns False when the budget is spent"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.granted += 1
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {
+                'tokens': round(self._tokens, 2),
+                'granted': self.granted,
+                'denied': self.denied
+            }
+
+
+class LatencyTracker:
+    """Recent successful call latencies for percentile-based hedging"""
+
+    def __init__(self, size=500, recompute_every=25):
+        self._samples = deque(maxlen=size)
+        self._recompute_every = recompute_every
+        self._since_recompute = 0
+        self._cached = {}
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._since_recompute += 1
+            if self._since_recompute >= self._recompute_every:
+                self._cached = {}
+                self._since_recompute = 0
+
+    def percentile(self, pct, min_samples):
+        """Latency at the given percentile, or None without enough samples"""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            if pct not in self._cached:
+                ordered = sorted(self._samples)
+                index = min(int(len(ordered) * pct / 100), len(ordered) - 1)
+                self._cached[pct] = ordered[index]
+            return self._cached[pct]
+
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=GATEWAY_HEDGE_WORKERS, thread_name_prefix='hedge'
+                )
+    return _hedge_executor
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class ResilientUpstream:
+    """Wraps an UpstreamClient with a circuit breaker, concurrency cap, retries and hedging"""
+
+    def __init__(self, client, breaker=None, budget=None, max_attempts=GATEWAY_RETRY_MAX_ATTEMPTS,
+                 hedge=GATEWAY_HEDGE_ENABLED, limiter=None):
+        self.client = client
+        self.name = client.name
+        self.breaker = breaker or CircuitBreaker(client.name)
+        self.budget = budget or RetryBudget()
+        self.limiter = limiter or create_upstream_limiter(client.name)
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.counters = {'retries': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    @property
+    def timeout(self):
+        return self.client.timeout
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _attempt(self, method, path, kwargs):
+        """One call through the cap and the breaker; 5xx gateway errors count as failures"""
+        # The slot covers the wait for response headers, where a slow upstream
+        # holds threads; it is taken first so a refused call uses no breaker probe
+        if self.limiter is not None and not self.limiter.acquire():
+            UPSTREAM_REJECTED.labels(self.name).inc()
+            raise UpstreamSaturatedError(f'Too many calls in flight to {self.name} upstream')
+        try:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f'Circuit open for {self.name} upstream')
+            started = time.monotonic()
+            try:
+                response = self.client.request(method, path, **kwargs)
+            except requests.exceptions.RequestException:
+                self.breaker.record_failure()
+                raise
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+        if response.status_code in RETRYABLE_STATUS:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+            self.latency.record(time.monotonic() - started)
+        return response
+
+    def _hedged_attempt(self, method, path, kwargs):
+        """Send a second GET if the first outlives the latency percentile"""
+        threshold = self.latency.percentile(GATEWAY_HEDGE_PERCENTILE, GATEWAY_HEDGE_MIN_SAMPLES)
+        if threshold is None:
+            return self._attempt(method, path, kwargs)
+        executor = _get_hedge_executor()
+        # Hedge threads run in the caller's trace context
+        first = executor.submit(contextvars.copy_context().run, self._attempt, method, path, kwargs)
+        done, _ = wait([first], timeout=threshold)
+        if done or not self.budget.withdraw():
+            return first.result()
+
+        self._count('hedges')
+        second = executor.submit(contextvars.copy_context().run, self._attempt, method, path, kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count('hedge_wins')
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def request(self, method, path, **kwargs):
+        """Send a request with breaker, retry budget and optional hedging"""
+        self.budget.deposit()
+        idempotent = method in IDEMPOTENT_METHODS
+        attempts = self.max_attempts if idempotent else 1
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if self.hedge and method == 'GET':
+                    response = self._hedged_attempt(method, path, kwargs)
+                else:
+                    response = self._attempt(method, path, kwargs)
+            except (CircuitOpenError, UpstreamSaturatedError):
+                raise
+            except requests.exceptions.RequestException:
+                if attempt >= attempts or not self.budget.withdraw():
+                    raise
+                self._count('retries')
+                time.sleep(random.uniform(0, GATEWAY_RETRY_BACKOFF * attempt))
+                continue
+            if (response.status_code in RETRYABLE_STATUS and attempt < attempts
+                    and self.budget.withdraw()):
+                response.close()
+                self._count('retries')
+                time.sleep(random.uniform(0, GATEWAY_RETRY_BACKOFF * attempt))
+                continue
+            return response
+
+    def stats(self):
+        stats = self.client.stats()
+        with self._lock:
+            stats.update(self.counters)
+        stats['circuit'] = self.breaker.stats()
+        stats['retry_budget'] = self.budget.stats()
+        stats['concurrency'] = self.limiter.stats() if self.limiter is not None else None
+        stats['hedging'] = self.hedge
+        return stats
@@ -0,0 +1,100 @@
+"""
+Request coalescing for the API Gateway
+Concurrent identical calls share a single upstream request and its result
+"""
+
+import os
+import threading
+
+# Request headers that make otherwise identical GETs distinct
+GATEWAY_COALESCE_VARY_HEADERS = [
+    header.strip() for header in
+    os.getenv('GATEWAY_COALESCE_VARY_HEADERS', 'Authorization,Accept').split(',')
+    if header.strip()
+]
+GATEWAY_COALESCE_ENABLED = os.getenv('GATEWAY_COALESCE_ENABLED', 'true').lower() == 'true'
+# Paths whose responses are streamed and therefore never shared
+GATEWAY_COALESCE_EXCLUDE_SUFFIXES = ('/export',)
+
+
+def default_key(request):
+    """Coalescing key for a Flask request, or None if it must not be shared"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if request.path.endswith(GATEWAY_COALESCE_EXCLUDE_SUFFIXES):
+        return None
+    vary = tuple(request.headers.get(header, '') for header in GATEWAY_COALESCE_VARY_HEADERS)
+    return (request.method, request.full_path, vary)
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls that share a key"""
+
+    def __init__(self, key_func=default_key, enabled=GATEWAY_COALESCE_ENABLED, wait_timeout=None):
+        self.key_func = key_func
+        self.enabled = enabled
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'shared': 0, 'wait_timeouts': 0}
+
+    def key(self, request):
+        """Key for a request under the configured key function"""
+        if not self.enabled:
+            return None
+        return self.key_func(request)
+
+    def do(self, key, func):
+        """Run func once for all concurrent callers with the same key.
+
+        Returns (result, shared). Errors raised by the leading call are
+        re-raised in every caller that waited on it. A caller that waits
+        longer than wait_timeout runs func itself.
+        """
+        if key is None:
+            return func(), False
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.counters['leaders'] += 1
+            else:
+                self.counters['shared'] += 1
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                with self._lock:
+                    self.counters['wait_timeouts'] += 1
+                return func(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = len(self._calls)
+        stats['enabled'] = self.enabled
+        return stats
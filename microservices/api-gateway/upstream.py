@@ -0,0 +1,175 @@
+"""
+Upstream HTTP clients for the API Gateway
+Pooled keep-alive sessions, one per backing microservice
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from common import tracing
+from common.metrics import UPSTREAM_LATENCY
+
+# Pool configuration from environment variables
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', '4'))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', '20'))
+UPSTREAM_POOL_BLOCK = os.getenv('UPSTREAM_POOL_BLOCK', 'true').lower() == 'true'
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '2'))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '5'))
+# Encodings the services may compress responses in; bodies in an encoding the
+# client accepts as well are relayed without being decoded
+UPSTREAM_ACCEPT_ENCODING = os.getenv('UPSTREAM_ACCEPT_ENCODING', 'gzip')
+
+
+class _TrackedPoolMixin:
+    """Counts checkouts and waits on a urllib3 connection pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+
+    def _get_conn(self, timeout=None):
+        # An empty queue means every allowed connection is checked out
+        if self.block and self.pool is not None and self.pool.empty():
+            with self._stats_lock:
+                self.waits += 1
+        conn = super()._get_conn(timeout=timeout)
+        with self._stats_lock:
+            self.in_use += 1
+        return conn
+
+    def _put_conn(self, conn):
+        with self._stats_lock:
+            self.in_use = max(self.in_use - 1, 0)
+        super()._put_conn(conn)
+
+    def idle(self):
+        """Number of open connections sitting in the pool"""
+        if self.pool is None:
+            return 0
+        return sum(1 for conn in list(self.pool.queue) if conn is not None)
+
+
+class TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class TrackedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pool manager builds tracked connection pools"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TrackedHTTPConnectionPool,
+            'https': TrackedHTTPSConnectionPool,
+        }
+
+    def host_pools(self):
+        """Return the live connection pools keyed by host"""
+        pools = self.poolmanager.pools
+        with pools.lock:
+            return list(pools._container.values())
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client for a single upstream service"""
+
+    def __init__(self, name, base_url,
+                 pool_connections=UPSTREAM_POOL_CONNECTIONS,
+                 pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+                 pool_block=UPSTREAM_POOL_BLOCK,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._adapter = None
+
+    def _get_session(self):
+        """Return the session for this process, rebuilding it after a fork"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    adapter = TrackedHTTPAdapter(
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize,
+                        pool_block=self.pool_block,
+                        max_retries=0
+                    )
+                    session = requests.Session()
+                    session.headers['Accept-Encoding'] = UPSTREAM_ACCEPT_ENCODING
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._adapter = adapter
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def request(self, method, path, **kwargs):
+        """Send a request to the upstream and return the response"""
+        kwargs.setdefault('timeout', self.timeout)
+        url = f'{self.base_url}{path}'
+        with tracing.span(f'{method} {self.name}', 'client', upstream=self.name) as span:
+            if tracing.current_span() is not None:
+                # Unsampled traces propagate too, so upstreams honour the decision
+                kwargs['headers'] = tracing.inject(dict(kwargs.get('headers') or {}))
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                response = self._get_session().request(method, url, **kwargs)
+                status = str(response.status_code)
+                return response
+            finally:
+                UPSTREAM_LATENCY.labels(self.name, method, status).observe(time.perf_counter() - started)
+                if span is not None:
+                    span.set_attribute('http.url', url)
+                    span.set_attribute('http.status_code', status)
+
+    def warm_up(self, path='/livez'):
+        """Open this process's session and a first keep-alive connection to the upstream"""
+        self.request('GET', path, timeout=(self.timeout[0], self.timeout[0])).close()
+
+    def stats(self):
+        """Return connection pool statistics for this upstream"""
+        self._get_session()
+        in_use = idle = waits = 0
+        for pool in self._adapter.host_pools():
+            in_use += pool.in_use
+            idle += pool.idle()
+            waits += pool.waits
+        return {
+            'base_url': self.base_url,
+            'pool_maxsize': self.pool_maxsize,
+            'pool_block': self.pool_block,
+            'connect_timeout': self.timeout[0],
+            'read_timeout': self.timeout[1],
+            'in_use': in_use,
+            'idle': idle,
+            'waits': waits
+        }
+
+    def close(self):
+        """Close all pooled connections"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._adapter = None
+            self._pid = None
@@ -0,0 +1,50 @@
+"""
+Bulk write helpers
+Request parsing and per-item result reporting for the /bulk endpoints
+"""
+
+import os
+
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', '1000'))
+
+
+class BulkRequestError(ValueError):
+    """Raised when a bulk request body is not a usable array of items"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_bulk_items(data):
+    """Return the list of items from a bulk request body.
+
+    Accepts either a bare JSON array or an object with an 'items' array.
+    """
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list):
+        raise BulkRequestError('Request body must be a JSON array of items')
+    if not data:
+        raise BulkRequestError('At least one item is required')
+    if len(data) > BULK_MAX_ITEMS:
+        raise BulkRequestError(f'At most {BULK_MAX_ITEMS} items are allowed per request', 413)
+    return data
+
+
+def item_error(index, message, status=400):
+    """Result entry for an item that was not written"""
+    return {'index': index, 'status': status, 'error': message}
+
+
+def item_created(index, key, document):
+    """Result entry for an item that was written"""
+    return {'index': index, 'status': 201, key: document}
+
+
+def bulk_summary(results):
+    """Return the response body and HTTP status for a list of item results"""
+    results = sorted(results, key=lambda result: result['index'])
+    created = sum(1 for result in results if result['status'] == 201)
+    failed = len(results) - created
+    return {'results': results, 'created': created, 'failed': failed}, 201 if failed == 0 else 207
@@ -0,0 +1,138 @@
+"""
+Change events
+Transactional outbox for the Postgres-backed services and the cursor-based change feed read from it
+"""
+
+import os
+import threading
+import time
+from datetime import timedelta
+
+from psycopg2.extras import execute_values
+
+from common.migrations import sql
+from common.pagination import PaginationError, decode_cursor, encode_cursor, parse_timestamp
+from common.serialization import dumps
+
+CHANGES_RETENTION_HOURS = float(os.getenv('CHANGES_RETENTION_HOURS', '72'))
+# How often each worker deletes events older than the retention
+CHANGES_PURGE_INTERVAL = float(os.getenv('CHANGES_PURGE_INTERVAL', '300'))
+CHANGES_PURGE_BATCH = 10000
+
+# The services share one database, so both create the table; events are
+# ordered by the id of the writing transaction, then by insertion order
+CREATE_CHANGE_EVENTS = sql("""
+    CREATE TABLE IF NOT EXISTS change_events (
+        id BIGSERIAL PRIMARY KEY,
+        txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+        entity VARCHAR(32) NOT NULL,
+        entity_id VARCHAR(64) NOT NULL,
+        operation VARCHAR(16) NOT NULL,
+        document JSONB,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""", """
+    CREATE INDEX IF NOT EXISTS idx_change_events_entity_txid_id ON change_events (entity, txid, id)
+""", """
+    CREATE INDEX IF NOT EXISTS idx_change_events_created_at ON change_events (created_at)
+""")
+
+
+class ChangeCursorError(PaginationError):
+    """A since cursor that cannot be served; status 410 means resync from a full read"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def record_changes(cursor, entity, operation, documents):
+    """Add change events for documents in the caller's transaction"""
+    if not documents:
+        return
+    execute_values(cursor, """
+        INSERT INTO change_events (entity, entity_id, operation, document)
+        VALUES %s
+    """, [(entity, str(document['id']), operation, dumps(document).decode()) for document in documents],
+        template='(%s, %s, %s, %s::jsonb)', page_size=len(documents))
+
+
+def read_changes(conn, entity, since, limit):
+    """Return (events, next_cursor) for events of an entity after a cursor.
+
+    Without since, no events are returned and the cursor marks the current
+    position: take it before loading the full state, then poll with it.
+
+    Only events of transactions older than every running transaction are
+    returned. Ids are assigned before commit, so a later id can become
+    visible first; the transaction horizon makes sure a cursor never moves
+    past an event that is still to be committed.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text, LOCALTIMESTAMP")
+    horizon, now = cursor.fetchone()
+    if not since:
+        cursor.close()
+        return [], encode_cursor(horizon, 0, now)
+
+    txid, last_id, as_of = decode_cursor(since, 3)
+    try:
+        txid, last_id = str(int(txid)), int(last_id)
+        as_of = parse_timestamp(as_of, 'since')
+    except (TypeError, ValueError, AttributeError):
+        raise ChangeCursorError('Invalid cursor')
+    if as_of < now - timedelta(hours=CHANGES_RETENTION_HOURS):
+        raise ChangeCursorError('Cursor is older than the change retention; reload the full state', 410)
+
+    cursor.execute("""
+        SELECT txid::text, id, entity_id, operation, document, created_at
+        FROM change_events
+        WHERE entity = %s AND (txid, id) > (%s::xid8, %s) AND txid < %s::xid8
+        ORDER BY txid, id
+        LIMIT %s
+    """, (entity, txid, last_id, horizon, limit))
+    rows = cursor.fetchall()
+    cursor.close()
+
+    events = [
+        {'id': entity_id, 'operation': operation, 'document': document, 'changed_at': created_at}
+        for _, _, entity_id, operation, document, created_at in rows
+    ]
+    if len(rows) < limit:
+        # Everything before the horizon has been read
+        return events, encode_cursor(horizon, 0, now)
+    last = rows[-1]
+    return events, encode_cursor(last[0], last[1], last[5])
+
+
+_purge_lock = threading.Lock()
+_next_purge = 0.0
+
+
+def purge_changes(db_pool):
+    """Delete expired events, at most once per CHANGES_PURGE_INTERVAL per process"""
+    global _next_purge
+    if time.monotonic() < _next_purge or not _purge_lock.acquire(blocking=False):
+        return 0
+    try:
+        _next_purge = time.monotonic() + CHANGES_PURGE_INTERVAL
+        deleted = 0
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            while True:
+                # One transaction per batch keeps row locks short
+                cursor.execute("""
+                    DELETE FROM change_events WHERE id IN (
+                        SELECT id FROM change_events
+                        WHERE created_at < LOCALTIMESTAMP - %s * INTERVAL '1 hour'
+                        LIMIT %s
+                    )
+                """, (CHANGES_RETENTION_HOURS, CHANGES_PURGE_BATCH))
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < CHANGES_PURGE_BATCH:
+                    break
+            cursor.close()
+        return deleted
+    finally:
+        _purge_lock.release()
@@ -0,0 +1,261 @@
+"""
+Response compression and conditional GETs
+Negotiated gzip/brotli/zstd encoding, strong ETags and 304 answers for every service
+"""
+
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+# Smaller bodies fit in a packet or two; compressing them only costs CPU
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+# Server preference among the encodings a client accepts equally
+COMPRESSION_ENCODINGS = os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip')
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv('COMPRESSION_ZSTD_LEVEL', '3'))
+# Compressed bodies kept by ETag, so a response that has not changed is compressed once
+COMPRESSION_CACHE_BYTES = int(os.getenv('COMPRESSION_CACHE_BYTES', str(8 * 1024 * 1024)))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+ETAG_METHODS = ('GET', 'HEAD')
+
+_MODULES = {'gzip': zlib, 'br': brotli, 'zstd': zstandard}
+AVAILABLE_ENCODINGS = tuple(
+    encoding for encoding in (item.strip() for item in COMPRESSION_ENCODINGS.split(','))
+    if _MODULES.get(encoding) is not None
+)
+_SUFFIXES = tuple(f'-{encoding}' for encoding in _MODULES)
+
+
+@lru_cache(maxsize=256)
+def _weights(accept_encoding):
+    """{encoding: q} for an Accept-Encoding header value"""
+    weights = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip()] = weight
+    return weights
+
+
+def accepts(accept_encoding, encoding):
+    """Whether an Accept-Encoding header value allows an encoding"""
+    weights = _weights(accept_encoding)
+    return weights.get(encoding, weights.get('*', 0.0)) > 0
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding):
+    """Encoding to use for an Accept-Encoding header value, or None for identity"""
+    weights = _weights(accept_encoding)
+    best, best_weight = None, 0.0
+    for encoding in AVAILABLE_ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(body, encoding):
+    """Compress a whole body"""
+    if encoding == 'gzip':
+        # wbits=31 writes a gzip header; its mtime is zero, so output is reproducible
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(body)
+
+
+def decompress(body, encoding):
+    """Decode a body compressed with one of the supported encodings"""
+    if encoding == 'gzip':
+        return zlib.decompress(body, 47)
+    if encoding == 'br':
+        return brotli.decompress(body)
+    if encoding == 'zstd':
+        # Streamed frames carry no content size, which decompress() requires
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError(f'Unsupported content encoding: {encoding}')
+
+
+def _stream_compressor(encoding):
+    """(compress_chunk, finish) for an incremental body; every chunk is flushed to the client"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        return (lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        return (lambda chunk: compressor.process(chunk) + compressor.flush()), compressor.finish
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+    return ((lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)),
+            compressor.flush)
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed body chunk by chunk, closing the source when done"""
+    compress_chunk, finish = _stream_compressor(encoding)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compress_chunk(chunk)
+        yield finish()
+    finally:
+        # Exports hold a pooled connection until their generator is closed
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class CompressedBodies:
+    """LRU of compressed bodies keyed by (ETag, encoding), bounded by total bytes"""
+
+    def __init__(self, max_bytes=COMPRESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = body
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, oldest = self._entries.popitem(last=False)
+                self._bytes -= len(oldest)
+
+
+compressed_bodies = CompressedBodies()
+
+
+def content_etag(body):
+    """Strong ETag derived from a response body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def version_etag(*parts):
+    """Strong ETag derived from what a response is built from, e.g. row ids and versions"""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def base_etag(etag):
+    """An ETag without the encoding suffix added when its body was compressed"""
+    for suffix in _SUFFIXES:
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def matching_etag(etag):
+    """The If-None-Match tag naming any encoding of etag, or None"""
+    candidates = request.if_none_match
+    if not candidates:
+        return None
+    if candidates.star_tag:
+        return etag
+    base = base_etag(etag)
+    for candidate in candidates.as_set(include_weak=True):
+        if base_etag(candidate) == base:
+            return candidate
+    return None
+
+
+def not_modified(etag):
+    """304 response for a conditional GET whose representation has not changed"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def conditional(etag):
+    """304 response if the request already holds etag, otherwise None"""
+    matched = matching_etag(etag)
+    return not_modified(matched) if matched is not None else None
+
+
+def compress_response(response):
+    """Encode a response body for the client, streamed or not"""
+    if (response.status_code < 200 or response.status_code in (204, 304) or request.method == 'HEAD'
+            or 'Content-Encoding' in response.headers or not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not COMPRESSION_ENABLED or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+    encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESSION_MIN_BYTES:
+            return response
+        etag, weak = response.get_etag()
+        key = (etag, encoding) if etag and not weak else None
+        compressed = compressed_bodies.get(key) if key else None
+        if compressed is None:
+            compressed = compress(body, encoding)
+            if key:
+                compressed_bodies.set(key, compressed)
+        response.set_data(compressed)
+        if etag:
+            # A strong ETag names one byte sequence, so each encoding gets its own
+            response.set_etag(f'{etag}-{encoding}', weak)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    """Tag GET responses with ETags, answer matching conditional GETs with 304 and compress the rest"""
+
+    @app.after_request
+    def _finish_response(response):
+        if (request.method in ETAG_METHODS and response.status_code == 200 and not response.is_streamed
+                and 'ETag' not in response.headers
+                and 'no-store' not in response.headers.get('Cache-Control', '')):
+            etag = content_etag(response.get_data())
+            matched = matching_etag(etag)
+            response.set_etag(matched or etag)
+            if matched is not None:
+                # The body is dropped when the response is sent
+                response.status_code = 304
+                response.vary.add('Accept-Encoding')
+                return response
+        return compress_response(response)
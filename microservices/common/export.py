@@ -0,0 +1,43 @@
+"""
+Streaming NDJSON exports
+Constant-memory bulk reads from server-side database cursors
+"""
+
+import os
+
+from common.serialization import dumps, row_mapper
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def stream_query(pool, name, query, params, columns, fields, batch_size=EXPORT_BATCH_SIZE):
+    """Yield NDJSON chunks for a query read through a named server-side cursor.
+
+    The pooled connection stays checked out until the stream is exhausted or
+    closed, and only one batch of rows is held in memory at a time.
+    """
+    to_document = row_mapper(columns, fields)
+    with pool.connection() as conn:
+        with conn.cursor(name=name) as cursor:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield b''.join(dumps(to_document(row)) + b'\n' for row in rows)
+
+
+def stream_documents(cursor, transform, batch_size=EXPORT_BATCH_SIZE):
+    """Yield NDJSON chunks for documents from a MongoDB cursor"""
+    try:
+        batch = []
+        for document in cursor.batch_size(batch_size):
+            batch.append(dumps(transform(document)) + b'\n')
+            if len(batch) >= batch_size:
+                yield b''.join(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch)
+    finally:
+        cursor.close()
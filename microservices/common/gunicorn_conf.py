@@ -0,0 +1,47 @@
+"""
+Shared gunicorn server hooks
+Loaded with `--config python:common.gunicorn_conf`; command-line flags still apply
+"""
+
+import gc
+import os
+import signal
+
+from common import lifecycle
+from common.metrics import clear_multiproc_dir, mark_process_dead
+
+# Import the app once in the master and fork workers from it: workers start
+# without re-importing, and share the imported code and data copy-on-write
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+# Time in-flight requests get to finish after SIGTERM; keep it below the pod's
+# terminationGracePeriodSeconds minus its preStop delay
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '25'))
+
+
+def on_starting(server):
+    clear_multiproc_dir()
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # Move everything imported so far out of the collector's reach, so
+        # collections in a worker do not write to, and so copy, shared pages
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is loaded, before it accepts connections
+    lifecycle.warm_up()
+    handle_exit = worker.handle_exit
+
+    def drain(sig, frame):
+        lifecycle.begin_drain()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, drain)
+    # signal() makes SIGTERM interrupt system calls again; gunicorn turns that off
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
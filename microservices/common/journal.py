@@ -0,0 +1,247 @@
+"""
+Durable local journal
+Append-only segment files with batched fsync, used as a write-behind queue
+"""
+
+import fcntl
+import os
+import threading
+import time
+import uuid
+import zlib
+
+from common.serialization import dumps, loads
+
+# fdatasync skips the inode timestamp update; the file size is still synced
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class JournalError(Exception):
+    """A record could not be made durable"""
+
+
+def _sync_directory(directory):
+    """Make created, renamed or deleted entries of a directory durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_record(record):
+    """One journal line: CRC-32 of the JSON payload, a space, the payload"""
+    payload = dumps(record)
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def read_records(segment):
+    """Records of an open segment file, up to the first torn or corrupt line"""
+    records = []
+    for line in segment:
+        if not line.endswith(b'\n'):
+            break
+        checksum, _, payload = line[:-1].partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                break
+            records.append(loads(payload))
+        except ValueError:
+            break
+    return records
+
+
+class Segment:
+    """A closed segment file and its records, locked until it is discarded"""
+
+    __slots__ = ('path', 'records', '_file')
+
+    def __init__(self, path, records, file):
+        self.path = path
+        self.records = records
+        self._file = file
+
+    def discard(self):
+        """Delete the segment once its records are stored elsewhere"""
+        os.unlink(self.path)
+        _sync_directory(os.path.dirname(self.path))
+        self._file.close()
+
+    def release(self):
+        """Unlock the segment without deleting it, leaving it to be recovered"""
+        self._file.close()
+
+
+class Journal:
+    """Append-only log of JSON records in a directory, written by one process.
+
+    append() returns once the record is on disk. Appenders that arrive while
+    an fsync is running share the next one, so under concurrency one fsync
+    covers many records; sync_delay waits a little longer for more to join.
+    rotate() closes the active segment and hands it to the consumer, which
+    discards it once the records are stored elsewhere.
+
+    Every segment is flock()ed by the process that owns it. The lock goes
+    away with the process, however it exits, so orphans() can claim the
+    segments of a crashed process from any other process sharing the
+    directory.
+    """
+
+    def __init__(self, directory, prefix='segment', sync_delay=0.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.sync_delay = sync_delay
+        # Lock order: _sync_lock, then _lock
+        self._sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._pid = None
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._records = []
+        self._written = 0
+        self._synced = 0
+        self._syncs = 0
+        self._failed = None
+
+    def _check_fork(self):
+        """A forked child starts its own segments; the parent keeps its lock"""
+        if self._pid != os.getpid():
+            if self._file is not None:
+                self._file.close()
+            self._reset_state()
+
+    def _open_segment(self):
+        # Created under a temporary name and locked before it becomes visible
+        # to orphans() under its final name
+        name = f'{self.prefix}-{uuid.uuid4().hex}'
+        temporary = os.path.join(self.directory, f'.{name}.tmp')
+        path = os.path.join(self.directory, f'{name}.log')
+        segment = open(temporary, 'xb', buffering=0)
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        os.rename(temporary, path)
+        _sync_directory(self.directory)
+        self._file, self._path, self._size = segment, path, 0
+
+    def append(self, record):
+        """Write a record and return once it is durable"""
+        line = encode_record(record)
+        with self._lock:
+            self._check_fork()
+            if self._failed is not None:
+                raise JournalError(f'Journal is unusable after an earlier error: {self._failed}')
+            try:
+                if self._file is None:
+                    self._open_segment()
+                # Unbuffered writes may be short; write the rest of the line
+                remaining = memoryview(line)
+                while remaining:
+                    written = self._file.write(remaining)
+                    if not written:
+                        raise OSError('journal write made no progress')
+                    remaining = remaining[written:]
+            except OSError as e:
+                if self._file is not None:
+                    # Drop a partial line and write the next record where it
+                    # started, so later records stay readable
+                    try:
+                        self._file.truncate(self._size)
+                        self._file.seek(self._size)
+                    except OSError as cleanup:
+                        # Records after the partial line would be lost on replay
+                        self._failed = cleanup
+                raise JournalError(f'Could not write journal record: {str(e)}')
+            self._size += len(line)
+            self._records.append(record)
+            self._written += 1
+            sequence = self._written
+        self._sync(sequence)
+
+    def _sync(self, sequence):
+        with self._sync_lock:
+            if self._synced >= sequence:
+                return
+            if self.sync_delay:
+                time.sleep(self.sync_delay)
+            with self._lock:
+                target = self._written
+                fd = self._file.fileno()
+            self._datasync(fd)
+            self._synced = target
+            self._syncs += 1
+
+    def _datasync(self, fd):
+        try:
+            _datasync(fd)
+        except OSError as e:
+            # After a failed fsync the kernel may have dropped the dirty pages,
+            # so a later successful fsync would not prove anything
+            self._failed = e
+            raise JournalError(f'Could not sync journal: {str(e)}')
+
+    def rotate(self):
+        """Close the active segment and return it, or None if it holds no records"""
+        with self._sync_lock, self._lock:
+            self._check_fork()
+            if not self._records:
+                return None
+            self._datasync(self._file.fileno())
+            self._synced = self._written
+            segment = Segment(self._path, self._records, self._file)
+            self._file, self._path, self._size, self._records = None, None, 0, []
+        return segment
+
+    def orphans(self):
+        """Claim the segments of processes that have exited, oldest first"""
+        claimed = []
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(f'.{self.prefix}-') or name.startswith(f'{self.prefix}-'):
+                try:
+                    entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+                except FileNotFoundError:
+                    continue
+        for _, name in sorted(entries):
+            path = os.path.join(self.directory, name)
+            try:
+                segment = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                segment.close()
+                continue
+            if os.fstat(segment.fileno()).st_nlink == 0:
+                # Claimed and discarded by another process after listdir()
+                segment.close()
+                continue
+            if name.endswith('.tmp'):
+                # Left by a crash before the segment was named; never written
+                os.unlink(path)
+                segment.close()
+                continue
+            claimed.append(Segment(path, read_records(segment), segment))
+        return claimed
+
+    @property
+    def failed(self):
+        """Whether an fsync error has made the journal unusable in this process"""
+        return self._failed is not None
+
+    def stats(self):
+        """Counters for the active segment of this process"""
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'active_records': len(self._records),
+                'active_bytes': self._size,
+                'appended': self._written,
+                'syncs': self._syncs,
+                'failed': str(self._failed) if self._failed is not None else None
+            }
@@ -0,0 +1,138 @@
+"""
+Service lifecycle
+App creation, per-worker warm-up, liveness/readiness probes and drain on shutdown
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask, jsonify
+from flask_cors import CORS
+
+from common import compression, metrics, serialization, tracing
+
+logger = logging.getLogger(__name__)
+
+# Warm connection pools in each worker before it takes traffic
+WORKER_WARM_UP = os.getenv('WORKER_WARM_UP', 'true').lower() == 'true'
+# Readiness results are reused for this long, so a probe every few seconds
+# from kubelet, the load balancer and Docker costs one dependency check
+READINESS_CACHE_SECONDS = float(os.getenv('READINESS_CACHE_SECONDS', '5'))
+
+_warm_ups = []
+_readiness_checks = {}
+_liveness_checks = {}
+_readiness = {'ready': False, 'checks': {}, 'checked_at': None}
+_readiness_lock = threading.Lock()
+_draining = threading.Event()
+
+
+def create_app(import_name, service):
+    """Flask app with the middleware and probe endpoints every service shares"""
+    app = Flask(import_name)
+    CORS(app)
+    metrics.init_app(app)
+    tracing.init_app(app, service)
+    serialization.init_app(app)
+    compression.init_app(app)
+    init_app(app, service)
+    return app
+
+
+def on_worker_start(func):
+    """Register a callable that opens connections in a new worker; usable as a decorator"""
+    _warm_ups.append(func)
+    return func
+
+
+def readiness_check(name, func):
+    """Register a dependency check for /readyz; it raises when the dependency is unusable"""
+    _readiness_checks[name] = func
+    return func
+
+
+def liveness_check(name, func):
+    """Register a check of in-process state for /livez; no I/O, raises when only a restart helps"""
+    _liveness_checks[name] = func
+    return func
+
+
+def warm_up():
+    """Run the warm-ups registered by the app; called once in each worker after fork"""
+    if not WORKER_WARM_UP:
+        return
+    for func in _warm_ups:
+        started = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            # The worker still starts; /readyz reports the dependency until it recovers
+            logger.warning(f"Warm-up {func.__name__} failed: {str(e)}")
+        else:
+            logger.info(f"Warm-up {func.__name__} took {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+def begin_drain():
+    """Fail readiness from now on; in-flight requests still complete"""
+    _draining.set()
+
+
+def draining():
+    return _draining.is_set()
+
+
+def check_readiness():
+    """Run the readiness checks at most once per READINESS_CACHE_SECONDS"""
+    now = time.monotonic()
+    checked_at = _readiness['checked_at']
+    if checked_at is not None and now - checked_at < READINESS_CACHE_SECONDS:
+        return _readiness
+    if not _readiness_lock.acquire(blocking=checked_at is None):
+        # Another thread is checking; a slow dependency must not pile up probes
+        return _readiness
+    try:
+        results = {}
+        for name, func in _readiness_checks.items():
+            try:
+                func()
+                results[name] = 'ok'
+            except Exception as e:
+                results[name] = str(e)
+        _readiness.update(ready=all(result == 'ok' for result in results.values()), checks=results,
+                          checked_at=time.monotonic())
+    finally:
+        _readiness_lock.release()
+    return _readiness
+
+
+def init_app(app, service):
+    """Register /livez and /readyz"""
+
+    @app.route('/livez', methods=['GET'])
+    def livez():
+        """Liveness: the worker answers requests; touches no dependency"""
+        for name, func in _liveness_checks.items():
+            try:
+                func()
+            except Exception as e:
+                return jsonify({'status': 'dead', 'service': service, 'checks': {name: str(e)}}), 503
+        return jsonify({'status': 'alive', 'service': service}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        """Readiness: dependencies reachable and the worker not draining"""
+        readiness = check_readiness()
+        ready = readiness['ready'] and not draining()
+        response = jsonify({
+            'status': 'ready' if ready else 'unready',
+            'service': service,
+            'draining': draining(),
+            'checks': readiness['checks'],
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        response.status_code = 200 if ready else 503
+        response.headers['Cache-Control'] = 'no-store'
+        return response
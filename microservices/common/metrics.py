@@ -0,0 +1,132 @@
+"""
+Prometheus metrics
+Request, database, pool and upstream instrumentation shared by every service
+"""
+
+import os
+import shutil
+import time
+
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+# Set for gunicorn: every worker writes its samples to files in this directory
+# and /metrics merges them, so a scrape sees the whole pod rather than one worker
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency until the response is returned',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'HTTP requests being handled', multiprocess_mode='livesum'
+)
+DB_QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'Database statement or command latency',
+    ['operation'], buckets=LATENCY_BUCKETS
+)
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Database pool connections by state', ['state'], multiprocess_mode='livesum'
+)
+DB_POOL_WAIT = Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a pooled connection', buckets=LATENCY_BUCKETS
+)
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts', 'Checkouts that gave up waiting for a pooled connection'
+)
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds', 'Gateway upstream call latency until response headers',
+    ['upstream', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    'upstream_circuit_open', 'Whether any worker has the upstream circuit open', ['upstream'],
+    multiprocess_mode='livemax'
+)
+UPSTREAM_REJECTED = Counter(
+    'upstream_rejected_calls', 'Upstream calls refused by the per-upstream concurrency cap', ['upstream']
+)
+GATEWAY_REJECTED = Counter(
+    'gateway_rejected_requests', 'Requests the gateway refused by rate limit or load shedding', ['reason']
+)
+
+SQL_OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def sql_operation(query):
+    """Low-cardinality label for a SQL statement: its leading keyword"""
+    if isinstance(query, bytes):
+        query = query[:64].decode('ascii', 'ignore')
+    # Statements written as indented triple-quoted strings start with whitespace
+    words = str(query)[:64].lstrip()[:16].split(None, 1)
+    operation = words[0].upper() if words else ''
+    return operation if operation in SQL_OPERATIONS else 'OTHER'
+
+
+def registry():
+    """Registry to expose: merged across workers in multiprocess mode"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    merged = CollectorRegistry()
+    multiprocess.MultiProcessCollector(merged)
+    return merged
+
+
+def init_app(app):
+    """Record request metrics for a Flask app and serve them at /metrics"""
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            REQUESTS_IN_FLIGHT.dec()
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(
+                time.perf_counter() - started
+            )
+        return response
+
+    @app.teardown_request
+    def _finish_request(error=None):
+        # after_request is skipped when the response itself could not be built
+        if g.pop('metrics_started', None) is not None:
+            REQUESTS_IN_FLIGHT.dec()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus metrics for every worker in this pod"""
+        return Response(generate_latest(registry()), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def clear_multiproc_dir():
+    """Remove samples left by a previous server run; call before workers start"""
+    if PROMETHEUS_MULTIPROC_DIR and os.path.isdir(PROMETHEUS_MULTIPROC_DIR):
+        for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+            path = os.path.join(PROMETHEUS_MULTIPROC_DIR, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def mark_process_dead(pid):
+    """Drop live gauges of an exited worker"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, PROMETHEUS_MULTIPROC_DIR)
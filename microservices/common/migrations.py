@@ -0,0 +1,196 @@
+"""
+Versioned schema migrations
+Ordered, idempotent schema and index changes applied once per deploy
+"""
+
+import logging
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = 'schema_migrations'
+
+
+class Migration:
+    """One schema change; apply receives a cursor (Postgres) or a database (MongoDB).
+
+    Non-transactional migrations run in autocommit mode, which Postgres
+    requires for CREATE INDEX CONCURRENTLY.
+    """
+
+    def __init__(self, version, description, apply, transactional=True):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.transactional = transactional
+
+
+def sql(*statements):
+    """Migration body that executes the given SQL statements in order"""
+    def apply(cursor):
+        for statement in statements:
+            cursor.execute(statement)
+    return apply
+
+
+def create_index_concurrently(name, table, columns, unique=False):
+    """Migration body that builds an index without blocking writes.
+
+    A concurrent build that failed part-way leaves an invalid index behind,
+    which IF NOT EXISTS would skip, so any invalid index is dropped first.
+    """
+    def apply(cursor):
+        cursor.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cursor.fetchone():
+            logger.warning(f"Dropping invalid index {name} left by an earlier failed build")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        cursor.execute(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})")
+    return apply
+
+
+def latest_version(migrations):
+    return max((migration.version for migration in migrations), default=0)
+
+
+def _check_order(migrations):
+    versions = [migration.version for migration in migrations]
+    if versions != sorted(set(versions)):
+        raise ValueError('Migration versions must be unique and ascending')
+
+
+class PostgresMigrator:
+    """Applies a component's migrations to Postgres under an advisory lock.
+
+    Several services may share one database, so applied versions are
+    recorded per component. One advisory lock serializes every runner on
+    the database, so overlapping deploys apply each migration exactly once.
+    """
+
+    def __init__(self, db_config, component, migrations):
+        _check_order(migrations)
+        self.db_config = db_config
+        self.component = component
+        self.migrations = migrations
+
+    def _ensure_table(self, cursor):
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                component VARCHAR(100) NOT NULL,
+                version INTEGER NOT NULL,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                duration_ms INTEGER,
+                PRIMARY KEY (component, version)
+            )
+        """)
+
+    def _applied(self, cursor):
+        cursor.execute(
+            f"SELECT version FROM {MIGRATIONS_TABLE} WHERE component = %s", (self.component,)
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+    def current_version(self, conn):
+        """Highest applied version for this component, using an existing connection"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT to_regclass(%s)", (MIGRATIONS_TABLE,))
+            if cursor.fetchone()[0] is None:
+                return 0
+            cursor.execute(
+                f"SELECT COALESCE(MAX(version), 0) FROM {MIGRATIONS_TABLE} WHERE component = %s",
+                (self.component,)
+            )
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def migrate(self):
+        """Apply pending migrations in order and return the resulting version"""
+        conn = psycopg2.connect(**self.db_config)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (MIGRATIONS_TABLE,))
+            self._ensure_table(cursor)
+            applied = self._applied(cursor)
+            for migration in self.migrations:
+                if migration.version in applied:
+                    continue
+                logger.info(f"Applying {self.component} migration {migration.version}: {migration.description}")
+                started = time.monotonic()
+                if migration.transactional:
+                    cursor.execute("BEGIN")
+                try:
+                    migration.apply(cursor)
+                    cursor.execute(
+                        f"INSERT INTO {MIGRATIONS_TABLE} (component, version, description, duration_ms) "
+                        "VALUES (%s, %s, %s, %s)",
+                        (self.component, migration.version, migration.description,
+                         int((time.monotonic() - started) * 1000))
+                    )
+                    if migration.transactional:
+                        cursor.execute("COMMIT")
+                except Exception:
+                    if migration.transactional:
+                        cursor.execute("ROLLBACK")
+                    raise
+            return self.current_version(conn)
+        finally:
+            try:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (MIGRATIONS_TABLE,))
+            finally:
+                cursor.close()
+                conn.close()
+
+
+class MongoMigrator:
+    """Applies a component's migrations to MongoDB.
+
+    Migrations must be idempotent (create_index with an unchanged spec is a
+    no-op), so two overlapping runners are harmless; versions are recorded
+    with upserts.
+    """
+
+    def __init__(self, db, component, migrations):
+        _check_order(migrations)
+        self.db = db
+        self.component = component
+        self.migrations = migrations
+
+    def current_version(self):
+        latest = self.db[MIGRATIONS_TABLE].find_one(
+            {'component': self.component}, sort=[('version', -1)]
+        )
+        return latest['version'] if latest else 0
+
+    def migrate(self):
+        """Apply pending migrations in order and return the resulting version"""
+        collection = self.db[MIGRATIONS_TABLE]
+        applied = {doc['version'] for doc in collection.find({'component': self.component}, {'version': 1})}
+        for migration in self.migrations:
+            if migration.version in applied:
+                continue
+            logger.info(f"Applying {self.component} migration {migration.version}: {migration.description}")
+            started = time.monotonic()
+            migration.apply(self.db)
+            collection.update_one(
+                {'_id': f'{self.component}:{migration.version}'},
+                {'$setOnInsert': {
+                    'component': self.component,
+                    'version': migration.version,
+                    'description': migration.description,
+                    'applied_at': datetime.utcnow(),
+                    'duration_ms': int((time.monotonic() - started) * 1000)
+                }},
+                upsert=True
+            )
+        return self.current_version()
@@ -0,0 +1,135 @@
+"""
+Keyset pagination helpers
+Parsing of limit/after/fields/filter query parameters and opaque page cursors
+"""
+
+import base64
+import binascii
+import json
+import os
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '500'))
+
+
+class PaginationError(ValueError):
+    """Raised for malformed pagination, projection or filter parameters"""
+
+
+def parse_limit(value):
+    """Return the page size, bounded by MAX_PAGE_SIZE"""
+    if value is None or value == '':
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1:
+        raise PaginationError('limit must be at least 1')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def parse_fields(value, allowed):
+    """Return the requested fields in request order, or all allowed fields"""
+    if not value:
+        return tuple(allowed)
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if not field or field in fields:
+            continue
+        if field not in allowed:
+            raise PaginationError(f'Unknown field: {field}')
+        fields.append(field)
+    if not fields:
+        raise PaginationError('fields must name at least one field')
+    return tuple(fields)
+
+
+def parse_ids(value, cast=str):
+    """Parse a comma-separated ids parameter, bounded by MAX_PAGE_SIZE"""
+    ids = [item.strip() for item in value.split(',') if item.strip()]
+    if not ids:
+        raise PaginationError('ids must list at least one id')
+    if len(ids) > MAX_PAGE_SIZE:
+        raise PaginationError(f'At most {MAX_PAGE_SIZE} ids are allowed per request')
+    try:
+        return [cast(item) for item in ids]
+    except ValueError:
+        raise PaginationError('ids contains an invalid id')
+
+
+def parse_int(value, name):
+    """Parse an integer filter parameter"""
+    try:
+        return int(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be an integer')
+
+
+def parse_float(value, name):
+    """Parse a numeric filter parameter"""
+    try:
+        parsed = float(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be a number')
+    if parsed != parsed or parsed in (float('inf'), float('-inf')):
+        raise PaginationError(f'{name} must be a finite number')
+    return parsed
+
+
+def parse_timestamp(value, name):
+    """Parse an ISO 8601 filter parameter into a naive UTC datetime"""
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise PaginationError(f'{name} must be an ISO 8601 timestamp')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def select_columns(fields, keys):
+    """Columns to select: the requested fields plus the keyset columns"""
+    return tuple(fields) + tuple(key for key in keys if key not in fields)
+
+
+def encode_cursor(*values):
+    """Encode keyset values into an opaque URL-safe cursor"""
+    raw = json.dumps([json_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Decode a cursor produced by encode_cursor into its keyset values"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise PaginationError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise PaginationError('Invalid cursor')
+    return values
+
+
+def decode_time_cursor(token):
+    """Decode a (created_at, id) cursor into a naive UTC datetime and an integer id"""
+    created_at, row_id = decode_cursor(token, 2)
+    if not isinstance(created_at, str) or not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise PaginationError('Invalid cursor')
+    try:
+        created_at = parse_timestamp(created_at, 'cursor')
+    except PaginationError:
+        raise PaginationError('Invalid cursor')
+    return [created_at, row_id]
+
+
+def json_value(value):
+    """Convert database values to JSON-compatible ones"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
@@ -0,0 +1,303 @@
+"""
+PostgreSQL connection pool
+Bounded, thread-safe and fork-aware pool shared by the Postgres-backed services
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from common import tracing
+from common.metrics import (
+    DB_POOL_CONNECTIONS,
+    DB_POOL_TIMEOUTS,
+    DB_POOL_WAIT,
+    DB_QUERY_LATENCY,
+    sql_operation
+)
+
+# Pool configuration from environment variables
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_WAIT_TIMEOUT = float(os.getenv('DB_POOL_WAIT_TIMEOUT', '5'))
+DB_POOL_VALIDATE_IDLE = float(os.getenv('DB_POOL_VALIDATE_IDLE', '30'))
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the wait timeout"""
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records statement latency by leading SQL keyword and traces statements"""
+
+    def execute(self, query, vars=None):
+        operation = sql_operation(query)
+        with tracing.span(f'db {operation}', 'client') as span:
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                DB_QUERY_LATENCY.labels(operation).observe(time.perf_counter() - started)
+                if span is not None:
+                    span.set_attribute('db.statement', _statement(query))
+                    span.set_attribute('db.rows', self.rowcount)
+
+    def executemany(self, query, vars_list):
+        operation = sql_operation(query)
+        with tracing.span(f'db {operation}', 'client') as span:
+            started = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                DB_QUERY_LATENCY.labels(operation).observe(time.perf_counter() - started)
+                if span is not None:
+                    span.set_attribute('db.statement', _statement(query))
+
+    def fetchall(self):
+        # Rows are converted to Python values here, not in execute()
+        with tracing.span('db fetch') as span:
+            rows = super().fetchall()
+            if span is not None:
+                span.set_attribute('db.rows', len(rows))
+            return rows
+
+
+def _statement(query, max_length=1000):
+    """Statement text for a span; parameters are never recorded"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = str(query)
+    return query if len(query) <= max_length else query[:max_length] + '...'
+
+
+class _PooledConnection:
+    """A raw connection plus the bookkeeping the pool needs"""
+
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class PostgresPool:
+    """Bounded pool of psycopg2 connections for a single worker process"""
+
+    def __init__(self, db_config, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, wait_timeout=DB_POOL_WAIT_TIMEOUT,
+                 validate_idle=DB_POOL_VALIDATE_IDLE):
+        if minconn > maxconn:
+            raise ValueError('minconn must not exceed maxconn')
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        self.validate_idle = validate_idle
+        self._cond = threading.Condition(threading.Lock())
+        self._inherited = []
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._closed = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def _check_fork(self):
+        """Forget connections inherited from a parent process.
+
+        Closing an inherited connection would terminate the parent's session
+        on the shared socket, so the objects are kept referenced but unused.
+        """
+        if self._pid != os.getpid():
+            self._inherited.extend(pooled.conn for pooled in self._idle)
+            self._reset_state()
+
+    def _connect(self):
+        with tracing.span('db connect', 'client', host=self.db_config.get('host')):
+            conn = psycopg2.connect(cursor_factory=TimedCursor, **self.db_config)
+        with self._cond:
+            self._created += 1
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._closed += 1
+
+    def _is_usable(self, pooled):
+        """Check an idle connection before handing it out"""
+        conn = pooled.conn
+        if conn.closed:
+            return False
+        if self.max_lifetime and time.monotonic() - pooled.created_at > self.max_lifetime:
+            return False
+        if time.monotonic() - pooled.last_used > self.validate_idle:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        """Check out a connection, waiting up to wait_timeout for one"""
+        with tracing.span('db checkout') as span:
+            pooled, waited = self._checkout()
+            if span is not None:
+                span.set_attribute('db.pool.waited', waited)
+            return pooled
+
+    def _checkout(self):
+        deadline = None
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    pooled = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    self._in_use += 1
+                    pooled = None
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.wait_timeout
+                    self._waits += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    DB_POOL_TIMEOUTS.inc()
+                    raise PoolTimeout(
+                        f'No database connection available within {self.wait_timeout}s'
+                    )
+                self._waiting += 1
+                started = time.monotonic()
+                self._cond.wait(remaining)
+                self._waiting -= 1
+                self._wait_time += time.monotonic() - started
+            if deadline is not None:
+                DB_POOL_WAIT.observe(self.wait_timeout - (deadline - time.monotonic()))
+            self._publish()
+
+        if pooled is not None and not self._is_usable(pooled):
+            self._discard(pooled)
+            pooled = None
+        if pooled is None:
+            try:
+                pooled = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return pooled, deadline is not None
+
+    def putconn(self, pooled, discard=False):
+        """Return a connection to the pool"""
+        if self._pid != os.getpid():
+            return
+        conn = pooled.conn
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._discard(pooled)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._publish()
+                self._cond.notify()
+            return
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append(pooled)
+            self._publish()
+            self._cond.notify()
+
+    def _publish(self):
+        """Update the pool gauges; called with the lock held"""
+        DB_POOL_CONNECTIONS.labels('in_use').set(self._in_use)
+        DB_POOL_CONNECTIONS.labels('idle').set(len(self._idle))
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and returns it"""
+        pooled = self.getconn()
+        discard = False
+        try:
+            yield pooled.conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(pooled, discard=discard)
+
+    def fill(self):
+        """Open connections until the pool holds at least minconn"""
+        opened = []
+        with self._cond:
+            self._check_fork()
+            missing = max(self.minconn - self._size, 0)
+            self._size += missing
+        try:
+            for _ in range(missing):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self._size -= missing - len(opened)
+                self._idle.extend(opened)
+                self._cond.notify_all()
+        return len(opened)
+
+    def closeall(self):
+        """Close every idle connection owned by this process"""
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            self._discard(pooled)
+
+    def stats(self):
+        """Return pool usage counters for this process"""
+        with self._cond:
+            self._check_fork()
+            return {
+                'pid': self._pid,
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'waits': self._waits,
+                'wait_time_seconds': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'closed': self._closed
+            }
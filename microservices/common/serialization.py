@@ -0,0 +1,102 @@
+"""
+JSON serialization
+orjson-backed Flask JSON provider and precompiled row-to-document mappers
+"""
+
+import json
+import os
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from bson import ObjectId
+except ImportError:
+    ObjectId = None
+
+# "stdlib" forces the json module, e.g. to compare output with the fast path
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson')
+USE_ORJSON = orjson is not None and JSON_BACKEND == 'orjson'
+
+
+def json_default(value):
+    """Encode values the JSON backend has no native support for"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID) or (ObjectId is not None and isinstance(value, ObjectId)):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+_stdlib_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=json_default)
+
+
+def stdlib_dumps(obj):
+    """Serialize obj to compact UTF-8 JSON bytes with the json module"""
+    return _stdlib_encoder.encode(obj).encode()
+
+
+if USE_ORJSON:
+    def dumps(obj):
+        """Serialize obj to compact UTF-8 JSON bytes"""
+        # orjson writes datetimes natively in the same isoformat() form
+        return orjson.dumps(obj, default=json_default)
+
+    loads = orjson.loads
+else:
+    dumps = stdlib_dumps
+    loads = json.loads
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider that encodes datetimes, Decimals and ObjectIds itself.
+
+    Handlers can pass database values straight to jsonify; responses are
+    built from bytes without an intermediate str.
+    """
+
+    mimetype = 'application/json'
+    encode = staticmethod(dumps)
+
+    def dumps(self, obj, **kwargs):
+        return self.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj), mimetype=self.mimetype)
+
+
+def init_app(app):
+    """Use the fast JSON provider for jsonify and request.get_json"""
+    app.json = FastJSONProvider(app)
+
+
+@lru_cache(maxsize=256)
+def _compile_mapper(columns, fields):
+    positions = {column: index for index, column in enumerate(columns)}
+    # Fields are validated against each service's allow-list before they get here
+    items = ', '.join(f'{field!r}: row[{positions[field]}]' for field in fields)
+    return eval(f'lambda row: {{{items}}}')
+
+
+def row_mapper(columns, fields):
+    """Return a function mapping a result row to a document of the requested fields.
+
+    The function is compiled once per (columns, fields) pair into a single
+    dict display. Values are left as the driver returned them, for the
+    JSON provider to encode.
+    """
+    return _compile_mapper(tuple(columns), tuple(fields))
@@ -0,0 +1,256 @@
+"""
+Distributed tracing
+W3C traceparent propagation, sampled spans and pluggable span exporters
+"""
+
+import contextvars
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# none disables tracing; memory and file are built in; anything else is a
+# "module:factory" path whose factory returns an object with export(span)
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'none')
+TRACING_FILE = os.getenv('TRACING_FILE', '/tmp/traces.jsonl')
+# Share of new traces to record; requests that arrive with a traceparent
+# follow the caller's decision so a trace is never recorded piecemeal
+TRACING_SAMPLE_RATIO = float(os.getenv('TRACING_SAMPLE_RATIO', '0.05'))
+TRACING_MEMORY_MAX_SPANS = int(os.getenv('TRACING_MEMORY_MAX_SPANS', '10000'))
+
+TRACEPARENT_HEADER = 'traceparent'
+TRACE_ID_HEADER = 'X-Trace-Id'
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'kind', 'sampled',
+                 'attributes', 'error', 'start', '_started')
+
+    def __init__(self, tracer, trace_id, parent_id, name, kind, sampled, attributes=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes = dict(attributes) if sampled and attributes else {}
+        self.error = None
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key, value):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def record_error(self, error):
+        if self.sampled:
+            self.error = f'{type(error).__name__}: {error}'
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.sampled and self.tracer is not None:
+            self.tracer.export(self, time.perf_counter() - self._started)
+
+    def to_dict(self, duration):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'service': self.tracer.service,
+            'start': self.start,
+            'duration_ms': round(duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class InMemoryExporter:
+    """Keeps the most recent spans in process, for tests and local runs"""
+
+    def __init__(self, max_spans=TRACING_MEMORY_MAX_SPANS):
+        self._spans = deque(maxlen=max_spans)
+
+    def export(self, span):
+        self._spans.append(span)
+
+    def spans(self, trace_id=None):
+        return [span for span in list(self._spans) if trace_id is None or span['trace_id'] == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class FileExporter:
+    """Appends spans as JSON lines; every worker process opens its own handle"""
+
+    def __init__(self, path=TRACING_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def export(self, span):
+        line = json.dumps(span, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                self._file = open(self.path, 'a', buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line)
+
+
+def create_exporter(spec):
+    """Build the exporter named by TRACING_EXPORTER, or None to disable tracing"""
+    if not spec or spec == 'none':
+        return None
+    if spec == 'memory':
+        return InMemoryExporter()
+    if spec == 'file':
+        return FileExporter()
+    module_name, _, factory = spec.partition(':')
+    return getattr(importlib.import_module(module_name), factory)()
+
+
+class Tracer:
+    """Creates spans for one service and hands sampled ones to an exporter"""
+
+    def __init__(self, service, exporter, sample_ratio=TRACING_SAMPLE_RATIO):
+        self.service = service
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.export_errors = 0
+
+    def start_span(self, name, kind='internal', parent=None, attributes=None):
+        """Start a span under parent (default: the current span) without activating it"""
+        parent = parent if parent is not None else _current.get()
+        if parent is None:
+            trace_id = '%032x' % random.getrandbits(128)
+            return Span(self, trace_id, None, name, kind, random.random() < self.sample_ratio, attributes)
+        return Span(self, parent.trace_id, parent.span_id, name, kind, parent.sampled, attributes)
+
+    def start_remote(self, name, traceparent, attributes=None):
+        """Start a server span continuing the caller's trace, if it sent one"""
+        match = TRACEPARENT_PATTERN.match(traceparent or '')
+        if not match or match.group(1) == '0' * 32:
+            return self.start_span(name, 'server', parent=None, attributes=attributes)
+        trace_id, parent_id, flags = match.groups()
+        return Span(self, trace_id, parent_id, name, 'server', bool(int(flags, 16) & 1), attributes)
+
+    def export(self, span, duration):
+        try:
+            self.exporter.export(span.to_dict(duration))
+        except Exception as e:
+            self.export_errors += 1
+            logger.warning(f"Span export failed: {str(e)}")
+
+
+_tracer = None
+
+
+def configure(service, exporter=None, sample_ratio=TRACING_SAMPLE_RATIO):
+    """Install the process-wide tracer; returns None when tracing is disabled"""
+    global _tracer
+    exporter = exporter if exporter is not None else create_exporter(TRACING_EXPORTER)
+    _tracer = Tracer(service, exporter, sample_ratio) if exporter is not None else None
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def activate(span):
+    """Make span the current span for the duration of the block"""
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """Trace a block as a child of the current span; a no-op outside a trace"""
+    parent = _current.get()
+    if _tracer is None or parent is None or not parent.sampled:
+        yield None
+        return
+    child = _tracer.start_span(name, kind, parent, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def inject(headers):
+    """Add the current trace context to outgoing request headers"""
+    current = _current.get()
+    if current is not None:
+        headers[TRACEPARENT_HEADER] = current.traceparent()
+    return headers
+
+
+def init_app(app, service, exporter=None):
+    """Trace every request to a Flask app as a server span"""
+    from flask import g, request
+
+    tracer = configure(service, exporter)
+    if tracer is None:
+        return None
+
+    @app.before_request
+    def _start_trace():
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        server = tracer.start_remote(f'{request.method} {rule}', request.headers.get(TRACEPARENT_HEADER), {
+            'http.method': request.method,
+            'http.target': request.full_path.rstrip('?')
+        })
+        g.trace_span = server
+        g.trace_token = _current.set(server)
+
+    @app.after_request
+    def _tag_response(response):
+        server = g.get('trace_span')
+        if server is not None:
+            server.set_attribute('http.status_code', response.status_code)
+            response.headers[TRACE_ID_HEADER] = server.trace_id
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        server = g.pop('trace_span', None)
+        if server is None:
+            return
+        if error is not None:
+            server.record_error(error)
+        _current.reset(g.pop('trace_token'))
+        server.end()
+
+    return tracer
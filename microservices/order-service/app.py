@@ -4,17 +4,44 @@ Order processing and management microservice
 """
 
 import os
-import psycopg2
-from flask import Flask, jsonify, request
-from flask_cors import CORS
+from psycopg2.extras import execute_values
+from flask import Response, jsonify, request
 import logging
+import uuid
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from common import compression, lifecycle, tracing
+from common.bulk import (
+    BulkRequestError,
+    bulk_summary,
+    item_created,
+    item_error,
+    parse_bulk_items
+)
+from common.changes import ChangeCursorError, purge_changes, read_changes, record_changes
+from common.export import NDJSON_MIMETYPE, stream_query
+from common.pagination import (
+    PaginationError,
+    decode_time_cursor,
+    encode_cursor,
+    parse_fields,
+    parse_int,
+    parse_limit,
+    parse_timestamp,
+    select_columns
+)
+from common.migrations import PostgresMigrator, latest_version
+from common.pgpool import PostgresPool
+from common.serialization import row_mapper
+from ingest import DuplicateOrder, IngestUnavailable, WriteBehindQueue
+from inventory import InventoryError, release, reserve, valid_product_id
+from migrations import COMPONENT, MIGRATIONS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+app = lifecycle.create_app(__name__, 'order-service')
 
 # Database configuration
 DB_CONFIG = {
@@ -25,47 +52,68 @@ DB_CONFIG = {
     'port': os.getenv('DB_PORT', '5432')
 }
 
+ORDER_FIELDS = ('id', 'user_id', 'product_id', 'quantity', 'total_amount', 'status', 'created_at', 'updated_at')
+# Maps a full orders row, as selected or returned by every write, to its document
+order_document = row_mapper(ORDER_FIELDS, ORDER_FIELDS)
+ORDER_STATUS_MAX_LENGTH = 50
+PRODUCT_ID_MAX_LENGTH = 64
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+# total_amount is DECIMAL(10, 2)
+TOTAL_AMOUNT_LIMIT = Decimal('100000000')
+
+# Reserve stock in product-service and price orders from it; when disabled,
+# orders are stored with the client-supplied total_amount as before
+ORDER_RESERVE_STOCK = os.getenv('ORDER_RESERVE_STOCK', 'true').lower() == 'true'
+
+# Accept orders into a local journal and commit them to Postgres in batches;
+# POST /api/orders then answers 202 before the order is stored
+ORDER_WRITE_BEHIND = os.getenv('ORDER_WRITE_BEHIND', 'false').lower() == 'true'
+
+# Reservation ids for idempotency keys, so a retried order reuses its reservation
+RESERVATION_NAMESPACE = uuid.UUID('6f1d4c0e-93a5-4b8e-9a51-0c7d2e8f4b16')
+
+# Connection pool, one per worker process
+db_pool = PostgresPool(DB_CONFIG)
+
+write_behind = WriteBehindQueue(db_pool) if ORDER_WRITE_BEHIND else None
+
+if write_behind is not None:
+    @app.before_request
+    def start_write_behind():
+        """Start the flusher, which also replays orders journaled by dead workers"""
+        write_behind.ensure_started()
+
+    def check_journal():
+        """A failed journal stays failed until the worker restarts"""
+        if write_behind.journal.failed:
+            raise RuntimeError('order journal failed; restart to recover it')
+
+    # Replays orphaned journals as soon as a worker starts, not on its first request
+    lifecycle.on_worker_start(write_behind.ensure_started)
+    lifecycle.liveness_check('journal', check_journal)
+
 def get_db_connection():
-    """Create and return database connection"""
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        raise
+    """Check out a pooled database connection for use in a with block"""
+    return db_pool.connection()
 
-def init_database():
-    """Initialize database tables"""
-    try:
-        conn = get_db_connection()
+def check_database():
+    """Round trip to Postgres on a pooled connection"""
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                product_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL DEFAULT 1,
-                total_amount DECIMAL(10, 2) NOT NULL,
-                status VARCHAR(50) DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        conn.commit()
+        cursor.execute('SELECT 1')
         cursor.close()
-        conn.close()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Database initialization error: {str(e)}")
+
+# Each worker opens its DB_POOL_MIN connections before taking traffic
+lifecycle.on_worker_start(db_pool.fill)
+lifecycle.readiness_check('database', check_database)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     try:
-        conn = get_db_connection()
-        conn.close()
+        check_database()
+        if write_behind is not None and write_behind.journal.failed:
+            raise RuntimeError('order journal failed; restart to recover it')
         return jsonify({
             'status': 'healthy',
             'service': 'order-service',
@@ -81,38 +129,142 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat()
         }), 503
 
+@app.route('/stats/schema', methods=['GET'])
+def schema_stats():
+    """Applied schema version against the version this build expects"""
+    try:
+        with get_db_connection() as conn:
+            applied = PostgresMigrator(DB_CONFIG, COMPONENT, MIGRATIONS).current_version(conn)
+        expected = latest_version(MIGRATIONS)
+        return jsonify({
+            'component': COMPONENT,
+            'applied_version': applied,
+            'expected_version': expected,
+            'up_to_date': applied >= expected
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stats/db-pool', methods=['GET'])
+def db_pool_stats():
+    """Connection pool statistics for this worker process"""
+    return jsonify(db_pool.stats()), 200
+
+@app.route('/stats/write-behind', methods=['GET'])
+def write_behind_stats():
+    """Write-behind queue statistics for this worker process"""
+    if write_behind is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(write_behind.stats(), enabled=True)), 200
+
+def order_filters(args):
+    """SQL conditions and parameters for the order filter query parameters.
+
+    Equality filters lead the (user_id|status|product_id, created_at, id)
+    indexes, so a filtered page is still a single backward index scan.
+    """
+    conditions = []
+    params = []
+    if args.get('user_id'):
+        conditions.append("user_id = %s")
+        params.append(parse_int(args['user_id'], 'user_id'))
+    if args.get('product_id'):
+        if len(args['product_id']) > PRODUCT_ID_MAX_LENGTH:
+            raise PaginationError('product_id is too long')
+        conditions.append("product_id = %s")
+        params.append(args['product_id'])
+    if args.get('status'):
+        if len(args['status']) > ORDER_STATUS_MAX_LENGTH:
+            raise PaginationError('status is too long')
+        conditions.append("status = %s")
+        params.append(args['status'])
+    if args.get('created_after'):
+        conditions.append("created_at >= %s")
+        params.append(parse_timestamp(args['created_after'], 'created_after'))
+    if args.get('created_before'):
+        conditions.append("created_at < %s")
+        params.append(parse_timestamp(args['created_before'], 'created_before'))
+    return conditions, params
+
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
-    """Get all orders"""
+    """Get a page of orders, newest first, optionally filtered"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, user_id, product_id, quantity, total_amount, status, created_at, updated_at FROM orders ORDER BY created_at DESC")
-        orders = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        limit = parse_limit(request.args.get('limit'))
+        fields = parse_fields(request.args.get('fields'), ORDER_FIELDS)
+        after = request.args.get('after')
+        columns = select_columns(fields, ('created_at', 'id'))
+        conditions, params = order_filters(request.args)
         
-        result = []
-        for order in orders:
-            result.append({
-                'id': order[0],
-                'user_id': order[1],
-                'product_id': order[2],
-                'quantity': order[3],
-                'total_amount': float(order[4]),
-                'status': order[5],
-                'created_at': order[6].isoformat() if order[6] else None,
-                'updated_at': order[7].isoformat() if order[7] else None
-            })
+        # xmin is the row version: every update writes it anew
+        query = f"SELECT {', '.join(columns)}, xmin FROM orders"
+        if after:
+            conditions.append("(created_at, id) < (%s, %s)")
+            params.extend(decode_time_cursor(after))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+        params.append(limit + 1)
         
-        return jsonify({'orders': result, 'count': len(result)}), 200
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            orders = cursor.fetchall()
+            cursor.close()
+        
+        next_cursor = None
+        if len(orders) > limit:
+            orders = orders[:limit]
+            last = dict(zip(columns, orders[-1]))
+            next_cursor = encode_cursor(last['created_at'], last['id'])
+        
+        id_index = columns.index('id')
+        etag = compression.version_etag(columns, next_cursor, [(order[id_index], order[-1]) for order in orders])
+        unchanged = compression.conditional(etag)
+        if unchanged is not None:
+            return unchanged
+        
+        with tracing.span('serialize', rows=len(orders)):
+            to_document = row_mapper(columns, fields)
+            result = [to_document(order) for order in orders]
+            response = jsonify({'orders': result, 'count': len(result), 'next_cursor': next_cursor})
+            response.set_etag(etag)
+            return response, 200
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting orders: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/orders/export', methods=['GET'])
+def export_orders():
+    """Stream every order, optionally filtered, as newline-delimited JSON"""
+    try:
+        fields = parse_fields(request.args.get('fields'), ORDER_FIELDS)
+        conditions, params = order_filters(request.args)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    query = f"SELECT {', '.join(fields)} FROM orders"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    return Response(
+        stream_query(db_pool, 'orders_export', query, params, fields, fields),
+        mimetype=NDJSON_MIMETYPE
+    )
+
 @app.route('/api/orders', methods=['POST'])
 def create_order():
-    """Create a new order"""
+    """Create a new order, reserving its stock first.
+
+    The total is computed from the price product-service returns with the
+    reservation; a client-supplied total_amount is ignored. If the order
+    cannot be stored, the reservation is released again.
+
+    An Idempotency-Key header (or idempotency_key field) makes retries safe:
+    a repeated key returns the order created by the first request.
+    """
     try:
         data = request.get_json()
         user_id = data.get('user_id')
@@ -120,66 +272,302 @@ def create_order():
         quantity = data.get('quantity', 1)
         total_amount = data.get('total_amount')
         status = data.get('status', 'pending')
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        
+        if idempotency_key is not None:
+            if not isinstance(idempotency_key, str) or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return jsonify({'error': f'idempotency_key must be a string of at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'}), 400
+            existing = find_order_by_key(idempotency_key)
+            if existing is not None:
+                return existing
+        
+        if not ORDER_RESERVE_STOCK:
+            if not user_id or not product_id or not total_amount:
+                return jsonify({'error': 'user_id, product_id, and total_amount are required'}), 400
+            if write_behind is not None:
+                error = order_field_error(user_id, product_id, quantity, total_amount, status)
+                if error:
+                    return jsonify({'error': error}), 400
+            return store_order(user_id, product_id, quantity, total_amount, status, None, idempotency_key)
         
-        if not user_id or not product_id or not total_amount:
-            return jsonify({'error': 'user_id, product_id, and total_amount are required'}), 400
+        if not user_id or not product_id:
+            return jsonify({'error': 'user_id and product_id are required'}), 400
+        if not valid_product_id(product_id):
+            # It becomes part of the product-service URL the reservation is posted to
+            return jsonify({'error': 'product_id must be a 24-character hex ObjectId'}), 400
+        # Checked before stock is reserved, so Postgres cannot refuse the row afterwards
+        error = order_field_error(user_id, product_id, quantity, 0, status)
+        if error:
+            return jsonify({'error': error}), 400
         
-        conn = get_db_connection()
+        if idempotency_key is not None:
+            reservation_id = uuid.uuid5(RESERVATION_NAMESPACE, idempotency_key).hex
+        else:
+            reservation_id = uuid.uuid4().hex
+        try:
+            reservation = reserve(product_id, quantity, reservation_id)
+        except InventoryError as e:
+            return jsonify({'error': str(e)}), e.status
+        
+        total_amount = Decimal(str(reservation['unit_price'])) * quantity
+        try:
+            return store_order(user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key)
+        except Exception:
+            release(reservation_id)
+            raise
+    except Exception as e:
+        logger.error(f"Error creating order: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def positive_int4(value):
+    """Whether value is an integer that fits a positive Postgres integer column"""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 2 ** 31
+
+def order_field_error(user_id, product_id, quantity, total_amount, status):
+    """Validate what Postgres would otherwise reject after the order was accepted or its stock reserved"""
+    if not positive_int4(user_id):
+        return 'user_id must be a positive integer'
+    if not isinstance(product_id, str) or len(product_id) > PRODUCT_ID_MAX_LENGTH:
+        return f'product_id must be a string of at most {PRODUCT_ID_MAX_LENGTH} characters'
+    if not positive_int4(quantity):
+        return 'quantity must be a positive integer'
+    if not isinstance(status, str) or len(status) > ORDER_STATUS_MAX_LENGTH:
+        return f'status must be a string of at most {ORDER_STATUS_MAX_LENGTH} characters'
+    try:
+        if isinstance(total_amount, bool) or not abs(Decimal(str(total_amount))) < TOTAL_AMOUNT_LIMIT:
+            return 'total_amount is out of range'
+    except InvalidOperation:
+        return 'total_amount must be a number'
+    return None
+
+def store_order(user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key):
+    """Store an order now (201) or accept it into the write-behind queue (202)"""
+    if write_behind is None:
+        return insert_order(user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key)
+    
+    try:
+        order = write_behind.submit({
+            'user_id': user_id,
+            'product_id': product_id,
+            'quantity': quantity,
+            'total_amount': Decimal(str(total_amount)),
+            'status': status,
+            'reservation_id': reservation_id,
+            'idempotency_key': idempotency_key
+        })
+    except DuplicateOrder:
+        # A concurrent request with the same key won; its reservation is this one
+        existing = find_order_by_key(idempotency_key)
+        if existing is None:
+            return jsonify({'error': 'The order with this idempotency key was not stored; retry'}), 409
+        return existing
+    except IngestUnavailable as e:
+        logger.error(f"Order not accepted: {str(e)}")
+        if reservation_id and not e.journaled:
+            release(reservation_id)
+        return jsonify({'error': str(e)}), 503
+    
+    response = jsonify(order)
+    response.status_code = 202
+    response.headers['Location'] = f"/api/orders/{order['id']}"
+    return response
+
+def insert_order(user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key=None):
+    """Insert one order row and return the 201 response"""
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO orders (user_id, product_id, quantity, total_amount, status)
-            VALUES (%s, %s, %s, %s, %s)
+            INSERT INTO orders (user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (idempotency_key) DO NOTHING
             RETURNING id, user_id, product_id, quantity, total_amount, status, created_at, updated_at
-        """, (user_id, product_id, quantity, total_amount, status))
-        
+        """, (user_id, product_id, quantity, total_amount, status, reservation_id, idempotency_key))
+    
         order = cursor.fetchone()
+        if order is not None:
+            order = order_document(order)
+            record_changes(cursor, 'order', 'create', [order])
         conn.commit()
         cursor.close()
-        conn.close()
+    
+    if order is None:
+        # A concurrent request with the same key won; its reservation is this one
+        return find_order_by_key(idempotency_key)
+    return jsonify(order), 201
+
+def find_order_by_key(idempotency_key):
+    """Response for the order created with an idempotency key, or None"""
+    if write_behind is not None:
+        order = write_behind.pending_by_key(idempotency_key)
+        if order is not None:
+            return jsonify(order), 202
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, user_id, product_id, quantity, total_amount, status, created_at, updated_at FROM orders WHERE idempotency_key = %s", (idempotency_key,))
+        order = cursor.fetchone()
+        claimed = None
+        if order is None and write_behind is not None:
+            cursor.execute("SELECT order_id, user_id, product_id, quantity, total_amount, status, created_at, created_at FROM order_keys WHERE idempotency_key = %s", (idempotency_key,))
+            claimed = cursor.fetchone()
+        cursor.close()
+    
+    if claimed is not None:
+        # Accepted by another worker and not committed yet
+        return jsonify(order_document(claimed)), 202
+    if order is None:
+        return None
+    return jsonify(order_document(order)), 200
+
+@app.route('/api/orders/bulk', methods=['POST'])
+def create_orders_bulk():
+    """Create many orders with one multi-row INSERT.
+
+    Like POST /api/orders, each order's stock is reserved first and its total
+    computed from the reserved price; a client-supplied total_amount is then
+    ignored. Items whose reservation fails are reported individually, and
+    every reservation is released again if the insert fails.
+    """
+    try:
+        items = parse_bulk_items(request.get_json(silent=True))
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        if ORDER_RESERVE_STOCK:
+            if not isinstance(item, dict) or not item.get('user_id') or not item.get('product_id'):
+                results.append(item_error(index, 'user_id and product_id are required'))
+                continue
+            if not valid_product_id(item['product_id']):
+                results.append(item_error(index, 'product_id must be a 24-character hex ObjectId'))
+                continue
+        elif not isinstance(item, dict) or not item.get('user_id') or not item.get('product_id') or not item.get('total_amount'):
+            results.append(item_error(index, 'user_id, product_id, and total_amount are required'))
+            continue
+        row = (
+            index,
+            item['user_id'],
+            item['product_id'],
+            item.get('quantity', 1),
+            0 if ORDER_RESERVE_STOCK else item['total_amount'],
+            item.get('status', 'pending'),
+            None
+        )
+        error = order_field_error(*row[1:6])
+        if error:
+            results.append(item_error(index, error))
+            continue
+        rows.append(row)
+    
+    if rows and ORDER_RESERVE_STOCK:
+        rows = reserve_bulk_rows(rows, results)
+    
+    if rows:
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                orders = execute_values(cursor, """
+                    INSERT INTO orders (user_id, product_id, quantity, total_amount, status, reservation_id)
+                    VALUES %s
+                    RETURNING id, user_id, product_id, quantity, total_amount, status, created_at, updated_at
+                """, [row[1:] for row in rows], page_size=len(rows), fetch=True)
+                record_changes(cursor, 'order', 'create', [order_document(order) for order in orders])
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Error creating orders in bulk: {str(e)}")
+            for row in rows:
+                if row[6]:
+                    release(row[6])
+            results.extend(item_error(row[0], str(e), 500) for row in rows)
+            body, status = bulk_summary(results)
+            return jsonify(body), status
         
-        return jsonify({
-            'id': order[0],
-            'user_id': order[1],
-            'product_id': order[2],
-            'quantity': order[3],
-            'total_amount': float(order[4]),
-            'status': order[5],
-            'created_at': order[6].isoformat() if order[6] else None,
-            'updated_at': order[7].isoformat() if order[7] else None
-        }), 201
+        for row, order in zip(rows, orders):
+            results.append(item_created(row[0], 'order', order_document(order)))
+    
+    body, status = bulk_summary(results)
+    return jsonify(body), status
+
+def reserve_bulk_rows(rows, results):
+    """Reserve stock for each bulk row and price it from the reservation.
+
+    Returns the reserved rows; items that got no reservation are added to
+    results instead.
+    """
+    reserved = []
+    unavailable = None
+    for index, user_id, product_id, quantity, _, status, _ in rows:
+        if unavailable is not None:
+            # The remaining items would each wait out the same timeouts
+            results.append(item_error(index, str(unavailable), unavailable.status))
+            continue
+        reservation_id = uuid.uuid4().hex
+        try:
+            reservation = reserve(product_id, quantity, reservation_id)
+        except InventoryError as e:
+            if e.status == 503:
+                unavailable = e
+            results.append(item_error(index, str(e), e.status))
+            continue
+        total_amount = Decimal(str(reservation['unit_price'])) * quantity
+        if not total_amount < TOTAL_AMOUNT_LIMIT:
+            release(reservation_id)
+            results.append(item_error(index, 'total_amount is out of range'))
+            continue
+        reserved.append((index, user_id, product_id, quantity, total_amount, status, reservation_id))
+    return reserved
+
+@app.route('/api/orders/changes', methods=['GET'])
+def get_order_changes():
+    """Order change events after the since cursor, oldest first"""
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        with get_db_connection() as conn:
+            events, next_cursor = read_changes(conn, 'order', request.args.get('since'), limit)
+        purge_changes(db_pool)
+        response = jsonify({'events': events, 'count': len(events), 'next_cursor': next_cursor})
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
+    except ChangeCursorError as e:
+        return jsonify({'error': str(e)}), e.status
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Error creating order: {str(e)}")
+        logger.error(f"Error getting order changes: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
 def get_order(order_id):
     """Get a specific order"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, user_id, product_id, quantity, total_amount, status, created_at, updated_at FROM orders WHERE id = %s", (order_id,))
-        order = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, user_id, product_id, quantity, total_amount, status, created_at, updated_at FROM orders WHERE id = %s", (order_id,))
+            order = cursor.fetchone()
+            claimed = None
+            if not order and write_behind is not None and write_behind.pending(order_id) is None:
+                cursor.execute("SELECT order_id, user_id, product_id, quantity, total_amount, status, created_at, created_at FROM order_keys WHERE order_id = %s", (order_id,))
+                claimed = cursor.fetchone()
+            cursor.close()
         
         if not order:
+            pending = write_behind.pending(order_id) if write_behind is not None else None
+            if pending is not None:
+                # Accepted by this worker and not committed yet
+                return jsonify(pending), 202
+            if claimed is not None:
+                # Accepted with an idempotency key by another worker and not committed yet
+                return jsonify(order_document(claimed)), 202
             return jsonify({'error': 'Order not found'}), 404
         
-        return jsonify({
-            'id': order[0],
-            'user_id': order[1],
-            'product_id': order[2],
-            'quantity': order[3],
-            'total_amount': float(order[4]),
-            'status': order[5],
-            'created_at': order[6].isoformat() if order[6] else None,
-            'updated_at': order[7].isoformat() if order[7] else None
-        }), 200
+        return jsonify(order_document(order)), 200
     except Exception as e:
         logger.error(f"Error getting order: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    init_database()
     port = int(os.getenv('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
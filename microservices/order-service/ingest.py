@@ -0,0 +1,442 @@
+"""
+Write-behind order ingestion for the Order Service
+Orders are accepted into a local journal and group-committed to Postgres by a background flusher
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+import psycopg2
+from prometheus_client import Gauge, Histogram
+from psycopg2.extras import execute_values
+
+from common.changes import record_changes
+from common.journal import Journal, JournalError
+from common.metrics import LATENCY_BUCKETS
+from common.pgpool import PoolTimeout
+from common.serialization import row_mapper
+from inventory import InventoryError, release, reserve
+
+logger = logging.getLogger(__name__)
+
+# Mount a volume here that outlives the container; every worker of a pod shares it
+WRITE_BEHIND_DIR = os.getenv('WRITE_BEHIND_DIR', '/tmp/order-journal')
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '0.05'))
+# Extra wait before an fsync so that more concurrent orders share it
+WRITE_BEHIND_SYNC_DELAY = float(os.getenv('WRITE_BEHIND_SYNC_DELAY', '0'))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '50000'))
+WRITE_BEHIND_ID_BLOCK = int(os.getenv('WRITE_BEHIND_ID_BLOCK', '100'))
+WRITE_BEHIND_RECOVER_INTERVAL = float(os.getenv('WRITE_BEHIND_RECOVER_INTERVAL', '5'))
+WRITE_BEHIND_DRAIN_TIMEOUT = float(os.getenv('WRITE_BEHIND_DRAIN_TIMEOUT', '10'))
+WRITE_BEHIND_MAX_BACKOFF = 5.0
+
+WRITE_BEHIND_PENDING = Gauge(
+    'order_write_behind_pending', 'Accepted orders not yet committed to Postgres', multiprocess_mode='livesum'
+)
+WRITE_BEHIND_FLUSH = Histogram(
+    'order_write_behind_flush_seconds', 'Time to commit one batch of accepted orders', buckets=LATENCY_BUCKETS
+)
+WRITE_BEHIND_BATCH = Histogram(
+    'order_write_behind_batch_size', 'Orders committed per batch', buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+# Replays of a batch that was committed before a crash hit the primary key,
+# retried submissions hit idempotency_key; both are skipped
+INSERT_ORDERS = """
+    INSERT INTO orders (id, user_id, product_id, quantity, total_amount, status, reservation_id,
+                        idempotency_key, created_at, updated_at)
+    VALUES %s
+    ON CONFLICT DO NOTHING
+    RETURNING id, user_id, product_id, quantity, total_amount, status, created_at, updated_at
+"""
+INSERT_TEMPLATE = (
+    '(%(id)s, %(user_id)s, %(product_id)s, %(quantity)s, %(total_amount)s, %(status)s, %(reservation_id)s, '
+    '%(idempotency_key)s, %(created_at)s, %(created_at)s)'
+)
+# The first order to claim a key keeps it; Postgres, not a worker's memory,
+# decides which of two concurrent submissions with one key is the order
+CLAIM_KEYS = """
+    INSERT INTO order_keys (idempotency_key, order_id, user_id, product_id, quantity, total_amount, status, created_at)
+    VALUES %s
+    ON CONFLICT (idempotency_key) DO NOTHING
+"""
+CLAIM_TEMPLATE = (
+    '(%(idempotency_key)s, %(id)s, %(user_id)s, %(product_id)s, %(quantity)s, %(total_amount)s, %(status)s, '
+    '%(created_at)s)'
+)
+RETURNED_COLUMNS = ('id', 'user_id', 'product_id', 'quantity', 'total_amount', 'status', 'created_at', 'updated_at')
+inserted_document = row_mapper(RETURNED_COLUMNS, RETURNED_COLUMNS)
+
+
+class IngestUnavailable(Exception):
+    """The order was not accepted: the queue is full or the journal failed.
+
+    journaled is set when the order reached the journal regardless; it may
+    still be committed, so its reservation must be kept.
+    """
+
+    def __init__(self, message, journaled=False):
+        super().__init__(message)
+        self.journaled = journaled
+
+
+class DuplicateOrder(Exception):
+    """Another order, possibly accepted by another worker, holds the idempotency key"""
+
+    def __init__(self, order_id):
+        super().__init__(f'Idempotency key is held by order {order_id}')
+        self.order_id = order_id
+
+
+def claim_keys(cursor, records):
+    """Claim the idempotency keys of records for their ids; key -> id of the order holding it"""
+    keyed = [record for record in records if record.get('idempotency_key')]
+    if not keyed:
+        return {}
+    execute_values(cursor, CLAIM_KEYS, keyed, template=CLAIM_TEMPLATE, page_size=len(keyed))
+    cursor.execute(
+        "SELECT idempotency_key, order_id FROM order_keys WHERE idempotency_key = ANY(%s)",
+        ([record['idempotency_key'] for record in keyed],)
+    )
+    return dict(cursor.fetchall())
+
+
+def key_holders(cursor, records):
+    """Records that hold their idempotency key, or have none"""
+    holders = claim_keys(cursor, records)
+    return [record for record in records
+            if not record.get('idempotency_key') or holders[record['idempotency_key']] == record['id']]
+
+
+def release_keys(cursor, records):
+    """Give up the keys held by records that will not be stored, so a retry can claim them"""
+    keyed = [(record['idempotency_key'], record['id']) for record in records if record.get('idempotency_key')]
+    if keyed:
+        execute_values(cursor, "DELETE FROM order_keys WHERE (idempotency_key, order_id) IN (VALUES %s)", keyed)
+
+
+class IdAllocator:
+    """Order ids reserved from the orders sequence a block at a time"""
+
+    def __init__(self, db_pool, block_size=WRITE_BEHIND_ID_BLOCK):
+        self.db_pool = db_pool
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _refill(self):
+        with self.db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence('orders', 'id')) FROM generate_series(1, %s)",
+                (self.block_size,)
+            )
+            self._ids.extend(row[0] for row in cursor.fetchall())
+            cursor.close()
+
+    def next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Ids reserved by the parent are its own
+                self._ids.clear()
+                self._pid = os.getpid()
+            if not self._ids:
+                self._refill()
+            return self._ids.popleft()
+
+
+class WriteBehindQueue:
+    """Accepts orders into a journal and commits them to Postgres in batches.
+
+    submit() returns once the order is fsynced to the local journal, with an
+    id already reserved from the orders sequence. A flusher thread per worker
+    process rotates the journal segment every flush interval and inserts its
+    orders in one transaction; the segment is deleted only after the commit.
+    If the process dies in between, the segment is replayed by the next
+    worker that finds it, and the replay skips rows that were already
+    committed, so every accepted order is stored exactly once.
+
+    An idempotency key is claimed in Postgres once the order is journaled and
+    before submit() returns, so concurrent submissions with one key on
+    different workers get the same id; the journaled records that lost the
+    claim are dropped when their segment is committed.
+    """
+
+    def __init__(self, db_pool, directory=WRITE_BEHIND_DIR, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.db_pool = db_pool
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal = Journal(directory, prefix='orders', sync_delay=WRITE_BEHIND_SYNC_DELAY)
+        self.ids = IdAllocator(db_pool)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._pid = None
+        self._thread = None
+        self._reset_state()
+        atexit.register(self.drain)
+
+    def _reset_state(self):
+        self._pending = {}
+        self._keys = {}
+        self._committed = 0
+        self._duplicates = 0
+        self._recovered = 0
+        self._failures = 0
+        self._last_error = None
+        self._unreserved = 0
+
+    def ensure_started(self):
+        """Start this process's flusher; cheap to call on every request"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._reset_state()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='order-write-behind', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, order):
+        """Journal an order and return its document; the id is final.
+
+        Raises DuplicateOrder when another order holds the idempotency key.
+        """
+        self.ensure_started()
+        if len(self._pending) >= self.max_pending:
+            raise IngestUnavailable('Order queue is full')
+        try:
+            order_id = self.ids.next_id()
+        except (psycopg2.Error, PoolTimeout) as e:
+            raise IngestUnavailable(f'Could not allocate an order id: {str(e)}')
+        accepted_at = datetime.utcnow()
+        record = dict(order, id=order_id, total_amount=str(order['total_amount']),
+                      created_at=accepted_at.isoformat())
+        document = {
+            'id': order_id,
+            'user_id': order['user_id'],
+            'product_id': order['product_id'],
+            'quantity': order['quantity'],
+            'total_amount': Decimal(record['total_amount']),
+            'status': order['status'],
+            'created_at': accepted_at,
+            'updated_at': accepted_at
+        }
+        with self._lock:
+            self._pending[order_id] = document
+        try:
+            self.journal.append(record)
+        except JournalError as e:
+            self._forget([record])
+            raise IngestUnavailable(str(e))
+        WRITE_BEHIND_PENDING.inc()
+        key = order.get('idempotency_key')
+        if key:
+            # Claimed after the append: a crash in between leaves a record
+            # whose commit claims the key, never a key without its record
+            try:
+                with self.db_pool.connection() as conn:
+                    cursor = conn.cursor()
+                    holder = claim_keys(cursor, [record])[key]
+                    conn.commit()
+                    cursor.close()
+            except (psycopg2.Error, PoolTimeout) as e:
+                raise IngestUnavailable(f'Could not claim the idempotency key: {str(e)}', journaled=True)
+            if holder != order_id:
+                with self._lock:
+                    self._pending.pop(order_id, None)
+                raise DuplicateOrder(holder)
+            with self._lock:
+                self._keys[key] = order_id
+        return document
+
+    def pending(self, order_id):
+        """Document of an order this process accepted but has not committed yet"""
+        return self._pending.get(order_id)
+
+    def pending_by_key(self, idempotency_key):
+        order_id = self._keys.get(idempotency_key)
+        return self._pending.get(order_id) if order_id is not None else None
+
+    def _forget(self, records):
+        with self._lock:
+            for record in records:
+                self._pending.pop(record['id'], None)
+                if self._keys.get(record.get('idempotency_key')) == record['id']:
+                    del self._keys[record['idempotency_key']]
+
+    def _run(self):
+        next_recovery = 0.0
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            if time.monotonic() >= next_recovery:
+                self._recover()
+                next_recovery = time.monotonic() + WRITE_BEHIND_RECOVER_INTERVAL
+            self.flush()
+
+    def _recover(self):
+        """Replay segments left behind by workers that died before committing them"""
+        try:
+            segments = self.journal.orphans()
+        except OSError as e:
+            logger.error(f"Could not scan the order journal: {str(e)}")
+            return
+        for segment in segments:
+            if segment.records:
+                logger.warning(f"Replaying {len(segment.records)} journaled orders from {segment.path}")
+            if self._commit(segment):
+                self._recovered += len(segment.records)
+            else:
+                # Left for the next scan, by this or another worker
+                segment.release()
+
+    def flush(self):
+        """Commit everything journaled so far; True once it is stored"""
+        try:
+            segment = self.journal.rotate()
+        except JournalError as e:
+            logger.error(f"Could not rotate the order journal: {str(e)}")
+            return False
+        if segment is None:
+            return True
+        backoff = self.flush_interval
+        while not self._commit(segment, local=True):
+            if self._stopping.wait(backoff):
+                # Draining: keep the segment for recovery after the restart
+                segment.release()
+                return False
+            backoff = min(backoff * 2, WRITE_BEHIND_MAX_BACKOFF)
+        return True
+
+    def _confirm_reservations(self, records):
+        """Records whose stock is reserved, taking it again for reservations released since.
+
+        An order whose fsync failed was refused and its reservation released,
+        yet its record may still be in the segment. Reserving again is a no-op
+        for reservations that still hold stock; records whose stock is gone
+        are dropped. Raises InventoryError while product-service is down.
+        """
+        confirmed = []
+        for record in records:
+            if record.get('reservation_id'):
+                try:
+                    reserve(record['product_id'], record['quantity'], record['reservation_id'])
+                except InventoryError as e:
+                    if e.status == 503:
+                        raise
+                    logger.error(f"Dropping journaled order {record['id']}: {str(e)}")
+                    self._unreserved += 1
+                    continue
+            confirmed.append(record)
+        return confirmed
+
+    def _commit(self, segment, local=False):
+        if not segment.records:
+            segment.discard()
+            return True
+        records = segment.records
+        if not local or self.journal.failed:
+            # Replayed segments, and the segment a failed fsync was written to
+            try:
+                records = self._confirm_reservations(records)
+            except InventoryError as e:
+                self._failures += 1
+                self._last_error = str(e)
+                logger.error(f"Could not confirm reservations of journaled orders: {str(e)}")
+                return False
+        started = time.perf_counter()
+        try:
+            with self.db_pool.connection() as conn:
+                cursor = conn.cursor()
+                inserted, rejected = [], []
+                try:
+                    holders = key_holders(cursor, records)
+                    if holders:
+                        inserted = execute_values(cursor, INSERT_ORDERS, holders, template=INSERT_TEMPLATE,
+                                                  page_size=len(holders), fetch=True)
+                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    conn.rollback()
+                    logger.error(f"Order batch rejected, inserting one at a time: {str(e)}")
+                    inserted, rejected = self._insert_each(cursor, records)
+                kept = {record['id'] for record in records}
+                dropped = [record for record in segment.records if record['id'] not in kept]
+                release_keys(cursor, dropped + rejected)
+                record_changes(cursor, 'order', 'create', [inserted_document(row) for row in inserted])
+                conn.commit()
+                cursor.close()
+        except (psycopg2.Error, PoolTimeout) as e:
+            self._failures += 1
+            self._last_error = str(e)
+            logger.error(f"Could not commit {len(segment.records)} journaled orders: {str(e)}")
+            return False
+        WRITE_BEHIND_FLUSH.observe(time.perf_counter() - started)
+        WRITE_BEHIND_BATCH.observe(len(segment.records))
+        segment.discard()
+        for record in rejected:
+            if record.get('reservation_id'):
+                release(record['reservation_id'])
+        self._committed += len(inserted)
+        self._duplicates += len(records) - len(inserted) - len(rejected)
+        if local:
+            self._forget(segment.records)
+            WRITE_BEHIND_PENDING.dec(len(segment.records))
+        return True
+
+    def _insert_each(self, cursor, records):
+        """Insert records one by one, dropping those Postgres refuses"""
+        inserted = []
+        rejected = []
+        for record in records:
+            cursor.execute('SAVEPOINT journaled_order')
+            try:
+                if key_holders(cursor, [record]):
+                    inserted.extend(execute_values(cursor, INSERT_ORDERS, [record], template=INSERT_TEMPLATE,
+                                                   fetch=True))
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT journaled_order')
+                logger.error(f"Dropping journaled order {record['id']}: {str(e)}")
+                rejected.append(record)
+        return inserted, rejected
+
+    def drain(self, timeout=WRITE_BEHIND_DRAIN_TIMEOUT):
+        """Stop the flusher and commit what is left, giving up after timeout"""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        # Whatever cannot be committed now stays journaled and is recovered later
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                segment = self.journal.rotate()
+            except JournalError:
+                break
+            if segment is None:
+                break
+            if not self._commit(segment, local=True):
+                segment.release()
+                break
+
+    def stats(self):
+        """Queue counters for this worker process"""
+        return dict(
+            self.journal.stats(),
+            pending=len(self._pending),
+            committed=self._committed,
+            duplicates=self._duplicates,
+            recovered=self._recovered,
+            failures=self._failures,
+            unreserved=self._unreserved,
+            last_error=self._last_error
+        )
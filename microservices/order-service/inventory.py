@@ -0,0 +1,102 @@
+"""
+Inventory client for the Order Service
+Stock reservations against product-service, the source of truth for stock and price
+"""
+
+import logging
+import os
+import re
+import threading
+from urllib.parse import quote
+
+import requests
+
+from common import tracing
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_SERVICE_URL = os.getenv('PRODUCT_SERVICE_URL', 'http://product-service:8080')
+INVENTORY_CONNECT_TIMEOUT = float(os.getenv('INVENTORY_CONNECT_TIMEOUT', '1'))
+INVENTORY_READ_TIMEOUT = float(os.getenv('INVENTORY_READ_TIMEOUT', '3'))
+# Reserve and release are idempotent by reservation_id, so both may be retried
+INVENTORY_MAX_ATTEMPTS = int(os.getenv('INVENTORY_MAX_ATTEMPTS', '2'))
+
+# Products are stored under MongoDB ObjectIds, written as 24 hex digits
+PRODUCT_ID_PATTERN = re.compile(r'[0-9a-fA-F]{24}')
+
+
+class InventoryError(Exception):
+    """A reservation failed; status is the HTTP status to report to the client"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def valid_product_id(product_id):
+    """Whether product_id is an ObjectId string, the only form a product can have"""
+    return isinstance(product_id, str) and PRODUCT_ID_PATTERN.fullmatch(product_id) is not None
+
+
+_local = threading.local()
+
+
+def _session():
+    """One keep-alive session per thread and process"""
+    session = getattr(_local, 'session', None)
+    if session is None or _local.pid != os.getpid():
+        session = requests.Session()
+        _local.session = session
+        _local.pid = os.getpid()
+    return session
+
+
+def _post(path, payload):
+    error = None
+    for _ in range(INVENTORY_MAX_ATTEMPTS):
+        with tracing.span('POST products', 'client', path=path) as span:
+            try:
+                response = _session().post(
+                    f'{PRODUCT_SERVICE_URL}{path}', json=payload, headers=tracing.inject({}),
+                    timeout=(INVENTORY_CONNECT_TIMEOUT, INVENTORY_READ_TIMEOUT)
+                )
+            except requests.exceptions.RequestException as e:
+                error = e
+                if span is not None:
+                    span.record_error(e)
+                continue
+            if span is not None:
+                span.set_attribute('http.status_code', response.status_code)
+            return response
+    raise InventoryError(f'Product service unavailable: {str(error)}', 503)
+
+
+def reserve(product_id, quantity, reservation_id):
+    """Reserve stock and return the reservation, including the unit price"""
+    response = _post(f"/api/products/{quote(product_id, safe='')}/reserve",
+                     {'quantity': quantity, 'reservation_id': reservation_id})
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code in (200, 201):
+        # Anything but the reservation asked for, still holding its stock, is not one
+        if body.get('status') != 'reserved' or body.get('reservation_id') != reservation_id:
+            raise InventoryError('Product service returned an unexpected reservation', 503)
+        return body
+    if response.status_code in (400, 404, 409):
+        raise InventoryError(body.get('error', 'Reservation rejected'), response.status_code)
+    raise InventoryError(body.get('error', 'Product service error'), 503)
+
+
+def release(reservation_id):
+    """Compensate a reservation; failures are logged for reconciliation"""
+    try:
+        response = _post(f"/api/products/reservations/{quote(reservation_id, safe='')}/release", {})
+    except InventoryError as e:
+        logger.error(f"Could not release reservation {reservation_id}: {str(e)}")
+        return False
+    if response.status_code != 200:
+        logger.error(f"Could not release reservation {reservation_id}: HTTP {response.status_code}")
+        return False
+    return True
@@ -0,0 +1,91 @@
+"""
+Order Service schema migrations
+Run once per deploy with `python migrations.py`, before new pods start
+"""
+
+import logging
+import sys
+
+from common.changes import CREATE_CHANGE_EVENTS
+from common.migrations import Migration, PostgresMigrator, create_index_concurrently, sql
+
+COMPONENT = 'order-service'
+
+MIGRATIONS = [
+    Migration(1, 'create orders table', sql("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            total_amount DECIMAL(10, 2) NOT NULL,
+            status VARCHAR(50) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)),
+    # Serves the (created_at, id) keyset in get_orders and the export
+    Migration(2, 'index orders by created_at',
+              create_index_concurrently('idx_orders_created_at_id', 'orders', 'created_at, id'),
+              transactional=False),
+    # A user's orders, newest first
+    Migration(3, 'index orders by user_id and created_at',
+              create_index_concurrently('idx_orders_user_id_created_at', 'orders', 'user_id, created_at, id'),
+              transactional=False),
+    # Orders in a status, newest first; also serves status-only lookups
+    Migration(4, 'index orders by status and created_at',
+              create_index_concurrently('idx_orders_status_created_at', 'orders', 'status, created_at, id'),
+              transactional=False),
+    # Orders for a product, newest first
+    Migration(5, 'index orders by product_id and created_at',
+              create_index_concurrently('idx_orders_product_id_created_at', 'orders', 'product_id, created_at, id'),
+              transactional=False),
+    # Product ids are MongoDB ObjectIds; rewrites the table under an exclusive lock
+    Migration(6, 'store product_id as text',
+              sql("ALTER TABLE orders ALTER COLUMN product_id TYPE VARCHAR(64) USING product_id::text")),
+    Migration(7, 'add reservation_id to orders',
+              sql("ALTER TABLE orders ADD COLUMN IF NOT EXISTS reservation_id VARCHAR(64)")),
+    Migration(8, 'add idempotency_key to orders',
+              sql("ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(128)")),
+    # Makes retried order submissions and write-behind replays insert at most once
+    Migration(9, 'unique index on orders idempotency_key',
+              create_index_concurrently('idx_orders_idempotency_key', 'orders', 'idempotency_key', unique=True),
+              transactional=False),
+    # Outbox read by /api/orders/changes; shared with user-service
+    Migration(10, 'create change_events table', CREATE_CHANGE_EVENTS),
+    # Idempotency keys claimed by write-behind workers before they answer, so
+    # one key gets one order id across workers; seeded with the stored orders
+    Migration(11, 'create order_keys table', sql("""
+        CREATE TABLE IF NOT EXISTS order_keys (
+            idempotency_key VARCHAR(128) PRIMARY KEY,
+            order_id INTEGER NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            product_id VARCHAR(64) NOT NULL,
+            quantity INTEGER NOT NULL,
+            total_amount DECIMAL(10, 2) NOT NULL,
+            status VARCHAR(50),
+            created_at TIMESTAMP
+        )
+    """, """
+        INSERT INTO order_keys (idempotency_key, order_id, user_id, product_id, quantity, total_amount, status, created_at)
+        SELECT idempotency_key, id, user_id, product_id, quantity, total_amount, status, created_at
+        FROM orders WHERE idempotency_key IS NOT NULL
+        ON CONFLICT DO NOTHING
+    """)),
+]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    from app import DB_CONFIG
+    try:
+        version = PostgresMigrator(DB_CONFIG, COMPONENT, MIGRATIONS).migrate()
+    except Exception as e:
+        logging.error(f"Migration failed: {str(e)}")
+        return 1
+    logging.info(f"{COMPONENT} schema at version {version}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,18 +4,42 @@ Product catalog and inventory microservice using MongoDB
 """
 
 import os
-from flask import Flask, jsonify, request
-from flask_cors import CORS
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+import atexit
+import threading
+import time
+from flask import Response, jsonify, request
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import logging
 from datetime import datetime
 
+from common import lifecycle, metrics, tracing
+from common.bulk import (
+    BulkRequestError,
+    bulk_summary,
+    item_created,
+    item_error,
+    parse_bulk_items
+)
+from common.export import NDJSON_MIMETYPE, stream_documents
+from common.migrations import MongoMigrator, latest_version
+from common.pagination import (
+    PaginationError,
+    decode_cursor,
+    encode_cursor,
+    parse_fields,
+    parse_float,
+    parse_ids,
+    parse_limit
+)
+from migrations import COMPONENT, MIGRATIONS
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+app = lifecycle.create_app(__name__, 'product-service')
 
 # MongoDB configuration
 MONGODB_HOST = os.getenv('MONGODB_HOST', 'localhost')
@@ -24,75 +48,417 @@ MONGODB_DB = os.getenv('MONGODB_DB', 'products')
 MONGODB_USER = os.getenv('MONGODB_USER', 'admin')
 MONGODB_PASSWORD = os.getenv('MONGODB_PASSWORD', 'password')
 
+# MongoDB client pool configuration
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '20'))
+MONGODB_MIN_POOL_SIZE = int(os.getenv('MONGODB_MIN_POOL_SIZE', '0'))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000'))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000'))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv('MONGODB_SOCKET_TIMEOUT_MS', '10000'))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+MONGODB_HEALTH_TTL = float(os.getenv('MONGODB_HEALTH_TTL', '5'))
+
+PRODUCT_FIELDS = ('id', 'name', 'description', 'price', 'stock', 'created_at', 'updated_at')
+
+# Keyset sort orders for product listings; _id breaks ties so pages never overlap.
+# 'relevance' (text search only) pages by offset, as text scores have no index order.
+PRODUCT_SORTS = {
+    'newest': [('_id', DESCENDING)],
+    'price_asc': [('price', ASCENDING), ('_id', ASCENDING)],
+    'price_desc': [('price', DESCENDING), ('_id', DESCENDING)],
+    'name': [('name', ASCENDING), ('_id', ASCENDING)]
+}
+PRODUCT_SEARCH_MAX_LENGTH = 200
+RESERVATION_ID_MAX_LENGTH = 64
+
+# How long /api/products/changes waits on the change stream for more events
+CHANGES_MAX_AWAIT_MS = int(os.getenv('CHANGES_MAX_AWAIT_MS', '100'))
+CHANGE_OPERATIONS = {'insert': 'create', 'update': 'update', 'replace': 'update', 'delete': 'delete'}
+# ChangeStreamFatalError and ChangeStreamHistoryLost: the resume token has left the oplog
+CHANGE_STREAM_EXPIRED_CODES = (280, 286)
+
+class SpanListener:
+    """Turns pairs of pymongo start/end events into spans of the current trace.
+
+    pymongo publishes both events on the thread running the operation, so
+    the span is parented to that thread's current span. Events from its
+    background threads have no current span and are ignored.
+    """
+
+    def __init__(self):
+        self.spans = {}
+
+    def _start_span(self, key, name, **attributes):
+        tracer = tracing.get_tracer()
+        parent = tracing.current_span()
+        if tracer is not None and parent is not None and parent.sampled:
+            self.spans[key] = tracer.start_span(name, 'client', parent, attributes)
+
+    def _end_span(self, key, error=None):
+        span = self.spans.pop(key, None)
+        if span is not None:
+            if error is not None:
+                span.error = str(error)
+            span.end()
+
+class PoolStatsListener(SpanListener, monitoring.ConnectionPoolListener):
+    """Counts connection pool events reported by pymongo"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.counters = {'created': 0, 'closed': 0, 'in_use': 0, 'checkout_failed': 0, 'pool_cleared': 0}
+
+    def _add(self, key, amount=1):
+        with self.lock:
+            self.counters[key] += amount
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add('pool_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add('created')
+        self._start_span(('connect', event.connection_id), 'db connect')
+
+    def connection_ready(self, event):
+        self._end_span(('connect', event.connection_id))
+
+    def connection_closed(self, event):
+        self._add('closed')
+
+    def connection_check_out_started(self, event):
+        self._start_span(('checkout', threading.get_ident()), 'db checkout')
+
+    def connection_check_out_failed(self, event):
+        self._add('checkout_failed')
+        self._end_span(('checkout', threading.get_ident()), event.reason)
+
+    def connection_checked_out(self, event):
+        self._add('in_use')
+        self._publish()
+        self._end_span(('checkout', threading.get_ident()))
+
+    def connection_checked_in(self, event):
+        self._add('in_use', -1)
+        self._publish()
+
+    def _publish(self):
+        metrics.DB_POOL_CONNECTIONS.labels('in_use').set(self.counters['in_use'])
+        metrics.DB_POOL_CONNECTIONS.labels('open').set(self.counters['created'] - self.counters['closed'])
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class CommandMetricsListener(SpanListener, monitoring.CommandListener):
+    """Records MongoDB command latency by command name and traces commands"""
+
+    def started(self, event):
+        self._start_span((event.request_id, event.connection_id), f'db {event.command_name}',
+                         collection=event.command.get(event.command_name))
+
+    def succeeded(self, event):
+        metrics.DB_QUERY_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        self._end_span((event.request_id, event.connection_id))
+
+    def failed(self, event):
+        metrics.DB_QUERY_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        self._end_span((event.request_id, event.connection_id), event.failure)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_pool_listener = None
+_health = {'healthy': False, 'error': None, 'checked_at': None}
+
 def get_mongodb_client():
-    """Create and return MongoDB client"""
-    try:
-        connection_string = f"mongodb://{MONGODB_USER}:{MONGODB_PASSWORD}@{MONGODB_HOST}:{MONGODB_PORT}/{MONGODB_DB}?authSource=admin"
-        client = MongoClient(connection_string, serverSelectionTimeoutMS=5000)
-        # Test connection
-        client.admin.command('ping')
-        return client
-    except ConnectionFailure as e:
-        logger.error(f"MongoDB connection error: {str(e)}")
-        raise
+    """Return the process-wide MongoDB client, creating it on first use.
+
+    The client is created lazily so that each gunicorn worker builds its own
+    after fork; pymongo clients must not be shared across processes.
+    """
+    global _client, _client_pid, _pool_listener
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                connection_string = f"mongodb://{MONGODB_USER}:{MONGODB_PASSWORD}@{MONGODB_HOST}:{MONGODB_PORT}/{MONGODB_DB}?authSource=admin"
+                _pool_listener = PoolStatsListener()
+                _client = MongoClient(
+                    connection_string,
+                    maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                    minPoolSize=MONGODB_MIN_POOL_SIZE,
+                    maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+                    serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                    connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                    socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS,
+                    waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                    event_listeners=[_pool_listener, CommandMetricsListener()]
+                )
+                _client_pid = pid
+                _health.update(healthy=False, error=None, checked_at=None)
+    return _client
+
+def close_mongodb_client():
+    """Close the MongoDB client owned by this process"""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+            logger.info("MongoDB client closed")
+        _client = None
+        _client_pid = None
+
+atexit.register(close_mongodb_client)
 
 def get_db():
     """Get MongoDB database"""
     client = get_mongodb_client()
     return client[MONGODB_DB]
 
-def init_database():
-    """Initialize database collections"""
+def ping_database():
+    """Round trip to MongoDB, opening this worker's client and first connection if needed"""
+    get_mongodb_client().admin.command('ping')
+
+def check_database_health():
+    """Ping MongoDB at most once per MONGODB_HEALTH_TTL seconds"""
+    now = time.monotonic()
+    if _health['checked_at'] is not None and now - _health['checked_at'] < MONGODB_HEALTH_TTL:
+        return _health
     try:
-        db = get_db()
-        # Create products collection if it doesn't exist
-        if 'products' not in db.list_collection_names():
-            db.create_collection('products')
-            logger.info("Products collection created")
-        logger.info("Database initialized successfully")
+        ping_database()
+        _health.update(healthy=True, error=None, checked_at=now)
     except Exception as e:
-        logger.error(f"Database initialization error: {str(e)}")
+        logger.error(f"MongoDB connection error: {str(e)}")
+        _health.update(healthy=False, error=str(e), checked_at=now)
+    return _health
+
+lifecycle.on_worker_start(ping_database)
+lifecycle.readiness_check('database', ping_database)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    try:
-        client = get_mongodb_client()
-        client.admin.command('ping')
-        client.close()
+    health = check_database_health()
+    if health['healthy']:
         return jsonify({
             'status': 'healthy',
             'service': 'product-service',
             'database': 'connected',
             'timestamp': datetime.utcnow().isoformat()
         }), 200
-    except Exception as e:
+    return jsonify({
+        'status': 'unhealthy',
+        'service': 'product-service',
+        'database': 'disconnected',
+        'error': health['error'],
+        'timestamp': datetime.utcnow().isoformat()
+    }), 503
+
+@app.route('/stats/schema', methods=['GET'])
+def schema_stats():
+    """Applied schema version against the version this build expects"""
+    try:
+        applied = MongoMigrator(get_db(), COMPONENT, MIGRATIONS).current_version()
+        expected = latest_version(MIGRATIONS)
         return jsonify({
-            'status': 'unhealthy',
-            'service': 'product-service',
-            'database': 'disconnected',
-            'error': str(e),
-            'timestamp': datetime.utcnow().isoformat()
-        }), 503
+            'component': COMPONENT,
+            'applied_version': applied,
+            'expected_version': expected,
+            'up_to_date': applied >= expected
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stats/db-pool', methods=['GET'])
+def db_pool_stats():
+    """MongoDB connection pool statistics for this worker process"""
+    get_mongodb_client()
+    stats = _pool_listener.stats()
+    stats.update({
+        'pid': os.getpid(),
+        'min': MONGODB_MIN_POOL_SIZE,
+        'max': MONGODB_MAX_POOL_SIZE
+    })
+    return jsonify(stats), 200
+
+def get_products_by_ids(product_ids, fields):
+    """Products for the given ids in request order, with None for misses"""
+    object_ids = [ObjectId(product_id) for product_id in product_ids if ObjectId.is_valid(product_id)]
+    projection = None
+    if fields:
+        projection = {field: 1 for field in fields if field != 'id'}
+    
+    found = {}
+    if object_ids:
+        for product in get_db().products.find({'_id': {'$in': object_ids}}, projection):
+            product_id = str(product.pop('_id'))
+            if fields is None or 'id' in fields:
+                product['id'] = product_id
+            found[product_id] = product
+    
+    with tracing.span('serialize', rows=len(found)):
+        result = [found.get(product_id) for product_id in product_ids]
+        missing = [product_id for product_id in product_ids if product_id not in found]
+        return jsonify({'products': result, 'count': len(found), 'missing': missing}), 200
+
+def product_filters(args):
+    """Mongo query clauses for the product search and filter parameters"""
+    clauses = []
+    q = args.get('q', '').strip()
+    if q:
+        if len(q) > PRODUCT_SEARCH_MAX_LENGTH:
+            raise PaginationError('q is too long')
+        clauses.append({'$text': {'$search': q}})
+    price = {}
+    if args.get('min_price'):
+        price['$gte'] = parse_float(args['min_price'], 'min_price')
+    if args.get('max_price'):
+        price['$lte'] = parse_float(args['max_price'], 'max_price')
+    if price:
+        clauses.append({'price': price})
+    if args.get('in_stock', '').lower() in ('true', '1'):
+        clauses.append({'stock': {'$gt': 0}})
+    return clauses, bool(q)
+
+def keyset_value(value):
+    """Whether a cursor value is a plain sort key value, which Mongo cannot read as an operator"""
+    if value is None or isinstance(value, str):
+        return True
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 63
+    return isinstance(value, float) and value == value and value not in (float('inf'), float('-inf'))
+
+def after_clause(sort, after):
+    """Keyset condition for the page following the cursor under a sort order"""
+    values = decode_cursor(after, len(sort))
+    if not isinstance(values[-1], str) or not all(keyset_value(value) for value in values[:-1]):
+        raise PaginationError('Invalid cursor')
+    try:
+        last_id = ObjectId(values[-1])
+    except InvalidId:
+        raise PaginationError('Invalid cursor')
+    id_op = '$gt' if sort[-1][1] == ASCENDING else '$lt'
+    if len(sort) == 1:
+        return {'_id': {id_op: last_id}}
+    field, direction = sort[0]
+    op = '$gt' if direction == ASCENDING else '$lt'
+    return {'$or': [{field: {op: values[0]}}, {field: values[0], '_id': {id_op: last_id}}]}
+
+def to_product(product, fields):
+    """Replace _id with a string id, if requested"""
+    product_id = product.pop('_id')
+    if fields is None or 'id' in fields:
+        product['id'] = str(product_id)
+    return product
 
 @app.route('/api/products', methods=['GET'])
 def get_products():
-    """Get all products"""
+    """Get a page of products, or specific products with ids=.
+
+    Supports text search (q), min_price/max_price, in_stock and sort
+    (newest, price_asc, price_desc, name, or relevance when searching).
+    """
     try:
+        fields = None
+        if request.args.get('fields'):
+            fields = parse_fields(request.args.get('fields'), PRODUCT_FIELDS)
+        if 'ids' in request.args:
+            return get_products_by_ids(parse_ids(request.args['ids']), fields)
+        limit = parse_limit(request.args.get('limit'))
+        after = request.args.get('after')
+        clauses, searching = product_filters(request.args)
+        sort_name = request.args.get('sort') or ('relevance' if searching else 'newest')
+        if sort_name == 'relevance' and not searching:
+            raise PaginationError('sort=relevance requires q')
+        if sort_name != 'relevance' and sort_name not in PRODUCT_SORTS:
+            raise PaginationError(f'Unknown sort: {sort_name}')
+        
+        projection = None
+        if fields:
+            projection = {field: 1 for field in fields if field != 'id'}
+        offset = 0
+        if sort_name == 'relevance':
+            sort = [('score', {'$meta': 'textScore'}), ('_id', DESCENDING)]
+            projection = dict(projection or {}, score={'$meta': 'textScore'})
+            if after:
+                offset = decode_cursor(after, 1)[0]
+                if not isinstance(offset, int) or isinstance(offset, bool) or not 0 <= offset < 2 ** 63:
+                    raise PaginationError('Invalid cursor')
+        else:
+            sort = PRODUCT_SORTS[sort_name]
+            if after:
+                clauses.append(after_clause(sort, after))
+            if projection is not None:
+                # The cursor needs the sort key even when it was not requested
+                for field, _ in sort[:-1]:
+                    projection.setdefault(field, 1)
+        
+        query = {'$and': clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
         db = get_db()
-        products = list(db.products.find({}, {'_id': 0}))
+        cursor = db.products.find(query, projection).sort(sort).skip(offset).limit(limit + 1)
+        products = list(cursor)
         
-        # Convert ObjectId to string if present
-        for product in products:
-            if '_id' in product:
-                product['id'] = str(product['_id'])
-                del product['_id']
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            if sort_name == 'relevance':
+                next_cursor = encode_cursor(offset + limit)
+            else:
+                next_cursor = encode_cursor(*[last.get(field) for field, _ in sort[:-1]], str(last['_id']))
         
-        return jsonify({'products': products, 'count': len(products)}), 200
+        with tracing.span('serialize', rows=len(products)):
+            for product in products:
+                product.pop('score', None)
+                if fields is not None:
+                    for field, _ in sort[:-1]:
+                        if field not in fields:
+                            product.pop(field, None)
+                to_product(product, fields)
+            
+            return jsonify({'products': products, 'count': len(products), 'next_cursor': next_cursor}), 200
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting products: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/products/export', methods=['GET'])
+def export_products():
+    """Stream every product as newline-delimited JSON"""
+    try:
+        fields = None
+        if request.args.get('fields'):
+            fields = parse_fields(request.args.get('fields'), PRODUCT_FIELDS)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    projection = None
+    if fields:
+        projection = {field: 1 for field in fields if field != 'id'}
+    include_id = fields is None or 'id' in fields
+    
+    def to_document(product):
+        product_id = product.pop('_id')
+        if include_id:
+            product['id'] = str(product_id)
+        return product
+    
+    cursor = get_db().products.find({}, projection).sort('_id', ASCENDING)
+    return Response(stream_documents(cursor, to_document), mimetype=NDJSON_MIMETYPE)
+
 @app.route('/api/products', methods=['POST'])
 def create_product():
     """Create a new product"""
@@ -125,11 +491,62 @@ def create_product():
         logger.error(f"Error creating product: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/products/bulk', methods=['POST'])
+def create_products_bulk():
+    """Create many products with one unordered insert_many"""
+    try:
+        items = parse_bulk_items(request.get_json(silent=True))
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    results = []
+    indexes = []
+    products = []
+    now = datetime.utcnow().isoformat()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('name') or item.get('price') is None:
+            results.append(item_error(index, 'name and price are required'))
+            continue
+        try:
+            product = {
+                'name': item['name'],
+                'description': item.get('description', ''),
+                'price': float(item['price']),
+                'stock': int(item.get('stock', 0)),
+                'created_at': now,
+                'updated_at': now
+            }
+        except (TypeError, ValueError):
+            results.append(item_error(index, 'price and stock must be numbers'))
+            continue
+        indexes.append(index)
+        products.append(product)
+    
+    if products:
+        failed = {}
+        try:
+            get_db().products.insert_many(products, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = error.get('errmsg', 'Write failed')
+        except Exception as e:
+            logger.error(f"Error creating products in bulk: {str(e)}")
+            failed = {position: str(e) for position in range(len(products))}
+        
+        for position, (index, product) in enumerate(zip(indexes, products)):
+            if position in failed:
+                results.append(item_error(index, failed[position], 500))
+                continue
+            product['id'] = str(product.pop('_id'))
+            results.append(item_created(index, 'product', product))
+    
+    body, status = bulk_summary(results)
+    return jsonify(body), status
+
 @app.route('/api/products/<product_id>', methods=['GET'])
 def get_product(product_id):
     """Get a specific product"""
     try:
-        from bson import ObjectId
         db = get_db()
         product = db.products.find_one({'_id': ObjectId(product_id)}, {'_id': 0})
         
@@ -142,7 +559,180 @@ def get_product(product_id):
         logger.error(f"Error getting product: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def change_event(change):
+    """A change stream event in the shape of the Postgres services' change events"""
+    document = change.get('fullDocument')
+    if document is not None:
+        document = to_product(document, None)
+    return {
+        'id': str(change['documentKey']['_id']),
+        'operation': CHANGE_OPERATIONS[change['operationType']],
+        'document': document,
+        'changed_at': change['clusterTime'].as_datetime().replace(tzinfo=None)
+    }
+
+@app.route('/api/products/changes', methods=['GET'])
+def get_product_changes():
+    """Product change events after the since cursor, oldest first.
+
+    Served from a MongoDB change stream: each event comes from the oplog
+    entry of the write itself, so stock reservations are included and no
+    write can be missed. The cursor wraps the stream's resume token; without
+    since, the stream starts at the current position.
+    """
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        resume_after = None
+        if request.args.get('since'):
+            token = decode_cursor(request.args['since'], 1)[0]
+            if not isinstance(token, str):
+                raise PaginationError('Invalid cursor')
+            resume_after = {'_data': token}
+        
+        events = []
+        with get_db().products.watch(full_document='updateLookup', resume_after=resume_after,
+                                     max_await_time_ms=CHANGES_MAX_AWAIT_MS) as stream:
+            while len(events) < limit:
+                change = stream.try_next()
+                if change is None:
+                    break
+                if change['operationType'] in CHANGE_OPERATIONS:
+                    events.append(change_event(change))
+            next_cursor = encode_cursor(stream.resume_token['_data']) if stream.resume_token else request.args.get('since')
+        
+        response = jsonify({'events': events, 'count': len(events), 'next_cursor': next_cursor})
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    except OperationFailure as e:
+        if e.code in CHANGE_STREAM_EXPIRED_CODES:
+            return jsonify({'error': 'Cursor is older than the change stream history; reload the full state'}), 410
+        logger.error(f"Error getting product changes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    except Exception as e:
+        logger.error(f"Error getting product changes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def reservation_body(reservation):
+    return {
+        'reservation_id': reservation['_id'],
+        'product_id': reservation['product_id'],
+        'quantity': reservation['quantity'],
+        'unit_price': reservation['unit_price'],
+        'status': reservation['status']
+    }
+
+@app.route('/api/products/<product_id>/reserve', methods=['POST'])
+def reserve_stock(product_id):
+    """Atomically take stock for an order and return the authoritative price.
+
+    The conditional $inc only matches while enough stock remains, so
+    concurrent reservations of one product can never oversell it. Retrying
+    with the same reservation_id returns the original reservation while it
+    holds its stock; a released one takes the stock again.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        reservation_id = str(data.get('reservation_id') or ObjectId())
+        try:
+            quantity = int(data.get('quantity', 1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'quantity must be an integer'}), 400
+        if quantity < 1:
+            return jsonify({'error': 'quantity must be at least 1'}), 400
+        if len(reservation_id) > RESERVATION_ID_MAX_LENGTH:
+            return jsonify({'error': 'reservation_id is too long'}), 400
+        if not ObjectId.is_valid(product_id):
+            return jsonify({'error': 'Product not found'}), 404
+        
+        db = get_db()
+        existing = db.reservations.find_one({'_id': reservation_id})
+        if existing is not None:
+            if existing['status'] == 'reserved':
+                return jsonify(reservation_body(existing)), 200
+            if existing['product_id'] != product_id:
+                return jsonify({'error': 'reservation_id belongs to another product'}), 409
+        
+        product = db.products.find_one_and_update(
+            {'_id': ObjectId(product_id), 'stock': {'$gte': quantity}},
+            {'$inc': {'stock': -quantity}, '$set': {'updated_at': datetime.utcnow().isoformat()}},
+            projection={'price': 1, 'stock': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if product is None:
+            if db.products.count_documents({'_id': ObjectId(product_id)}, limit=1) == 0:
+                return jsonify({'error': 'Product not found'}), 404
+            return jsonify({'error': 'Insufficient stock'}), 409
+        
+        if existing is not None:
+            # Released because the order it was taken for was not stored; an
+            # idempotent retry of that order reserves the stock again
+            reservation = db.reservations.find_one_and_update(
+                {'_id': reservation_id, 'status': 'released'},
+                {'$set': {'status': 'reserved', 'quantity': quantity, 'unit_price': product['price'],
+                          'reserved_at': datetime.utcnow().isoformat()},
+                 '$unset': {'released_at': ''}},
+                return_document=ReturnDocument.AFTER
+            )
+            if reservation is None:
+                # A concurrent retry reserved it first; give our stock back
+                db.products.update_one({'_id': ObjectId(product_id)}, {'$inc': {'stock': quantity}})
+                return jsonify(reservation_body(db.reservations.find_one({'_id': reservation_id}))), 200
+            body = reservation_body(reservation)
+            body['remaining_stock'] = product['stock']
+            return jsonify(body), 201
+        
+        reservation = {
+            '_id': reservation_id,
+            'product_id': product_id,
+            'quantity': quantity,
+            'unit_price': product['price'],
+            'status': 'reserved',
+            'created_at': datetime.utcnow().isoformat()
+        }
+        try:
+            db.reservations.insert_one(reservation)
+        except DuplicateKeyError:
+            # A concurrent retry with the same reservation_id won; give our stock back
+            db.products.update_one({'_id': ObjectId(product_id)}, {'$inc': {'stock': quantity}})
+            return jsonify(reservation_body(db.reservations.find_one({'_id': reservation_id}))), 200
+        except Exception:
+            db.products.update_one({'_id': ObjectId(product_id)}, {'$inc': {'stock': quantity}})
+            raise
+        
+        body = reservation_body(reservation)
+        body['remaining_stock'] = product['stock']
+        return jsonify(body), 201
+    except Exception as e:
+        logger.error(f"Error reserving stock: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/products/reservations/<reservation_id>/release', methods=['POST'])
+def release_stock(reservation_id):
+    """Return a reservation's stock; releasing twice is a no-op"""
+    try:
+        db = get_db()
+        reservation = db.reservations.find_one_and_update(
+            {'_id': reservation_id, 'status': 'reserved'},
+            {'$set': {'status': 'released', 'released_at': datetime.utcnow().isoformat()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if reservation is None:
+            existing = db.reservations.find_one({'_id': reservation_id})
+            if existing is None:
+                return jsonify({'error': 'Reservation not found'}), 404
+            return jsonify(reservation_body(existing)), 200
+        
+        db.products.update_one(
+            {'_id': ObjectId(reservation['product_id'])},
+            {'$inc': {'stock': reservation['quantity']}, '$set': {'updated_at': datetime.utcnow().isoformat()}}
+        )
+        return jsonify(reservation_body(reservation)), 200
+    except Exception as e:
+        logger.error(f"Error releasing stock: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
-    init_database()
     port = int(os.getenv('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
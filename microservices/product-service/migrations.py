@@ -0,0 +1,77 @@
+"""
+Product Service schema migrations
+Run once per deploy with `python migrations.py`, before new pods start
+"""
+
+import logging
+import sys
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+from common.migrations import Migration, MongoMigrator
+
+COMPONENT = 'product-service'
+
+
+def create_products_collection(db):
+    if 'products' not in db.list_collection_names():
+        db.create_collection('products')
+
+
+def replace_name_index(db):
+    # (name, _id) serves sort=name with its _id tiebreak; the name-only index is its prefix
+    db.products.create_index([('name', ASCENDING), ('_id', ASCENDING)], name='idx_products_name_id')
+    if 'idx_products_name' in db.products.index_information():
+        db.products.drop_index('idx_products_name')
+
+
+def enable_change_streams(db):
+    # DocumentDB streams only the collections enabled here; MongoDB rejects the
+    # command and streams every collection of a replica set
+    try:
+        db.client.admin.command({
+            'modifyChangeStreams': 1, 'database': db.name, 'collections': ['products'], 'enable': True
+        })
+    except OperationFailure as e:
+        logging.info(f"modifyChangeStreams not applied: {str(e)}")
+
+
+MIGRATIONS = [
+    Migration(1, 'create products collection', create_products_collection),
+    Migration(2, 'index products by name',
+              lambda db: db.products.create_index([('name', ASCENDING)], name='idx_products_name')),
+    Migration(3, 'index products by created_at',
+              lambda db: db.products.create_index([('created_at', DESCENDING)], name='idx_products_created_at')),
+    # Backs q= search; a collection can hold only one text index
+    Migration(4, 'text index on product name and description',
+              lambda db: db.products.create_index(
+                  [('name', TEXT), ('description', TEXT)],
+                  name='idx_products_text', weights={'name': 10, 'description': 1}
+              )),
+    # Price ranges and sort=price_asc/price_desc, with the _id keyset tiebreak
+    Migration(5, 'index products by price',
+              lambda db: db.products.create_index([('price', ASCENDING), ('_id', ASCENDING)], name='idx_products_price_id')),
+    # in_stock=true, optionally with a price range
+    Migration(6, 'index products by stock and price',
+              lambda db: db.products.create_index([('stock', ASCENDING), ('price', ASCENDING)], name='idx_products_stock_price')),
+    Migration(7, 'index products by name with _id tiebreak', replace_name_index),
+    # Backs /api/products/changes
+    Migration(8, 'enable change streams on products', enable_change_streams),
+]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    from app import get_db
+    try:
+        version = MongoMigrator(get_db(), COMPONENT, MIGRATIONS).migrate()
+    except Exception as e:
+        logging.error(f"Migration failed: {str(e)}")
+        return 1
+    logging.info(f"{COMPONENT} schema at version {version}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,16 +5,39 @@ User management and authentication microservice
 
 import os
 import psycopg2
-from flask import Flask, jsonify, request
-from flask_cors import CORS
+from psycopg2.extras import execute_values
+from flask import Response, jsonify, request
 import logging
 from datetime import datetime
 
+from common import compression, lifecycle, tracing
+from common.bulk import (
+    BulkRequestError,
+    bulk_summary,
+    item_created,
+    item_error,
+    parse_bulk_items
+)
+from common.changes import ChangeCursorError, purge_changes, read_changes, record_changes
+from common.export import NDJSON_MIMETYPE, stream_query
+from common.pagination import (
+    PaginationError,
+    decode_time_cursor,
+    encode_cursor,
+    parse_fields,
+    parse_ids,
+    parse_limit,
+    select_columns
+)
+from common.migrations import PostgresMigrator, latest_version
+from common.pgpool import PostgresPool
+from common.serialization import row_mapper
+from migrations import COMPONENT, MIGRATIONS
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+app = lifecycle.create_app(__name__, 'user-service')
 
 # Database configuration
 DB_CONFIG = {
@@ -25,46 +48,36 @@ DB_CONFIG = {
     'port': os.getenv('DB_PORT', '5432')
 }
 
+USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'created_at', 'updated_at')
+# Maps a full users row, as selected or returned by every write, to its document
+user_document = row_mapper(USER_FIELDS, USER_FIELDS)
+USERNAME_MAX_LENGTH = 100
+EMAIL_MAX_LENGTH = 255
+NAME_MAX_LENGTH = 100
+
+# Connection pool, one per worker process
+db_pool = PostgresPool(DB_CONFIG)
+
 def get_db_connection():
-    """Create and return database connection"""
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        raise
+    """Check out a pooled database connection for use in a with block"""
+    return db_pool.connection()
 
-def init_database():
-    """Initialize database tables"""
-    try:
-        conn = get_db_connection()
+def check_database():
+    """Round trip to Postgres on a pooled connection"""
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(100) UNIQUE NOT NULL,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                first_name VARCHAR(100),
-                last_name VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        conn.commit()
+        cursor.execute('SELECT 1')
         cursor.close()
-        conn.close()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Database initialization error: {str(e)}")
+
+# Each worker opens its DB_POOL_MIN connections before taking traffic
+lifecycle.on_worker_start(db_pool.fill)
+lifecycle.readiness_check('database', check_database)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     try:
-        conn = get_db_connection()
-        conn.close()
+        check_database()
         return jsonify({
             'status': 'healthy',
             'service': 'user-service',
@@ -80,34 +93,111 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat()
         }), 503
 
-@app.route('/api/users', methods=['GET'])
-def get_users():
-    """Get all users"""
+@app.route('/stats/schema', methods=['GET'])
+def schema_stats():
+    """Applied schema version against the version this build expects"""
     try:
-        conn = get_db_connection()
+        with get_db_connection() as conn:
+            applied = PostgresMigrator(DB_CONFIG, COMPONENT, MIGRATIONS).current_version(conn)
+        expected = latest_version(MIGRATIONS)
+        return jsonify({
+            'component': COMPONENT,
+            'applied_version': applied,
+            'expected_version': expected,
+            'up_to_date': applied >= expected
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stats/db-pool', methods=['GET'])
+def db_pool_stats():
+    """Connection pool statistics for this worker process"""
+    return jsonify(db_pool.stats()), 200
+
+def get_users_by_ids(user_ids, fields):
+    """Users for the given ids in request order, with None for misses"""
+    columns = select_columns(fields, ('id',))
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, username, email, first_name, last_name, created_at, updated_at FROM users ORDER BY created_at DESC")
+        cursor.execute(f"SELECT {', '.join(columns)} FROM users WHERE id = ANY(%s)", (list(set(user_ids)),))
         users = cursor.fetchall()
         cursor.close()
-        conn.close()
+    
+    with tracing.span('serialize', rows=len(users)):
+        to_document = row_mapper(columns, fields)
+        id_index = columns.index('id')
+        found = {user[id_index]: to_document(user) for user in users}
+        result = [found.get(user_id) for user_id in user_ids]
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        return jsonify({'users': result, 'count': len(found), 'missing': missing}), 200
+
+@app.route('/api/users', methods=['GET'])
+def get_users():
+    """Get a page of users, newest first, or specific users with ids="""
+    try:
+        if 'ids' in request.args:
+            return get_users_by_ids(
+                parse_ids(request.args['ids'], int),
+                parse_fields(request.args.get('fields'), USER_FIELDS)
+            )
+        limit = parse_limit(request.args.get('limit'))
+        fields = parse_fields(request.args.get('fields'), USER_FIELDS)
+        after = request.args.get('after')
+        columns = select_columns(fields, ('created_at', 'id'))
+        
+        # xmin is the row version: every update writes it anew
+        query = f"SELECT {', '.join(columns)}, xmin FROM users"
+        params = []
+        if after:
+            query += " WHERE (created_at, id) < (%s, %s)"
+            params.extend(decode_time_cursor(after))
+        query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+        params.append(limit + 1)
+        
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            users = cursor.fetchall()
+            cursor.close()
         
-        result = []
-        for user in users:
-            result.append({
-                'id': user[0],
-                'username': user[1],
-                'email': user[2],
-                'first_name': user[3],
-                'last_name': user[4],
-                'created_at': user[5].isoformat() if user[5] else None,
-                'updated_at': user[6].isoformat() if user[6] else None
-            })
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            last = dict(zip(columns, users[-1]))
+            next_cursor = encode_cursor(last['created_at'], last['id'])
         
-        return jsonify({'users': result, 'count': len(result)}), 200
+        id_index = columns.index('id')
+        etag = compression.version_etag(columns, next_cursor, [(user[id_index], user[-1]) for user in users])
+        unchanged = compression.conditional(etag)
+        if unchanged is not None:
+            return unchanged
+        
+        with tracing.span('serialize', rows=len(users)):
+            to_document = row_mapper(columns, fields)
+            result = [to_document(user) for user in users]
+            response = jsonify({'users': result, 'count': len(result), 'next_cursor': next_cursor})
+            response.set_etag(etag)
+            return response, 200
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting users: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/users/export', methods=['GET'])
+def export_users():
+    """Stream every user as newline-delimited JSON"""
+    try:
+        fields = parse_fields(request.args.get('fields'), USER_FIELDS)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    query = f"SELECT {', '.join(fields)} FROM users ORDER BY id"
+    return Response(
+        stream_query(db_pool, 'users_export', query, (), fields, fields),
+        mimetype=NDJSON_MIMETYPE
+    )
+
 @app.route('/api/users', methods=['POST'])
 def create_user():
     """Create a new user"""
@@ -120,63 +210,144 @@ def create_user():
         
         if not username or not email:
             return jsonify({'error': 'Username and email are required'}), 400
+        error = user_field_error(username, email, first_name, last_name)
+        if error:
+            return jsonify({'error': error}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO users (username, email, first_name, last_name)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id, username, email, first_name, last_name, created_at, updated_at
-        """, (username, email, first_name, last_name))
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO users (username, email, first_name, last_name)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id, username, email, first_name, last_name, created_at, updated_at
+            """, (username, email, first_name, last_name))
         
-        user = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
+            user = user_document(cursor.fetchone())
+            record_changes(cursor, 'user', 'create', [user])
+            conn.commit()
+            cursor.close()
         
-        return jsonify({
-            'id': user[0],
-            'username': user[1],
-            'email': user[2],
-            'first_name': user[3],
-            'last_name': user[4],
-            'created_at': user[5].isoformat() if user[5] else None,
-            'updated_at': user[6].isoformat() if user[6] else None
-        }), 201
+        return jsonify(user), 201
     except psycopg2.IntegrityError as e:
         return jsonify({'error': 'User already exists'}), 409
     except Exception as e:
         logger.error(f"Error creating user: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def text_field_error(value, name, max_length, required=True):
+    """Message for a value that is not a string of at most max_length characters, or None"""
+    if value is None and not required:
+        return None
+    if not isinstance(value, str) or len(value) > max_length or '\x00' in value:
+        return f'{name} must be a string of at most {max_length} characters'
+    return None
+
+def user_field_error(username, email, first_name, last_name):
+    """Validate what Postgres would otherwise refuse or silently cast"""
+    return (text_field_error(username, 'username', USERNAME_MAX_LENGTH)
+            or text_field_error(email, 'email', EMAIL_MAX_LENGTH)
+            or text_field_error(first_name, 'first_name', NAME_MAX_LENGTH, required=False)
+            or text_field_error(last_name, 'last_name', NAME_MAX_LENGTH, required=False))
+
+@app.route('/api/users/bulk', methods=['POST'])
+def create_users_bulk():
+    """Create many users with one multi-row INSERT"""
+    try:
+        items = parse_bulk_items(request.get_json(silent=True))
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    results = []
+    rows = []
+    usernames = set()
+    emails = set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('username') or not item.get('email'):
+            results.append(item_error(index, 'Username and email are required'))
+            continue
+        row = (index, item['username'], item['email'], item.get('first_name', ''), item.get('last_name', ''))
+        error = user_field_error(*row[1:])
+        if error:
+            results.append(item_error(index, error))
+            continue
+        if row[1] in usernames or row[2] in emails:
+            # Taken by an earlier item of this batch
+            results.append(item_error(index, 'User already exists', 409))
+            continue
+        usernames.add(row[1])
+        emails.add(row[2])
+        rows.append(row)
+    
+    if rows:
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                users = execute_values(cursor, """
+                    INSERT INTO users (username, email, first_name, last_name)
+                    VALUES %s
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, username, email, first_name, last_name, created_at, updated_at
+                """, [row[1:] for row in rows], page_size=len(rows), fetch=True)
+                record_changes(cursor, 'user', 'create', [user_document(user) for user in users])
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Error creating users in bulk: {str(e)}")
+            results.extend(item_error(row[0], str(e), 500) for row in rows)
+            body, status = bulk_summary(results)
+            return jsonify(body), status
+        
+        # Usernames are distinct strings within the batch, so each inserted row
+        # belongs to exactly one item; the items Postgres skipped conflict with stored users
+        positions = {row[1]: row[0] for row in rows}
+        inserted = {positions[user[1]]: user for user in users}
+        for row in rows:
+            user = inserted.get(row[0])
+            if user is not None:
+                results.append(item_created(row[0], 'user', user_document(user)))
+            else:
+                results.append(item_error(row[0], 'User already exists', 409))
+    
+    body, status = bulk_summary(results)
+    return jsonify(body), status
+
+@app.route('/api/users/changes', methods=['GET'])
+def get_user_changes():
+    """User change events after the since cursor, oldest first"""
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        with get_db_connection() as conn:
+            events, next_cursor = read_changes(conn, 'user', request.args.get('since'), limit)
+        purge_changes(db_pool)
+        response = jsonify({'events': events, 'count': len(events), 'next_cursor': next_cursor})
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
+    except ChangeCursorError as e:
+        return jsonify({'error': str(e)}), e.status
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error getting user changes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """Get a specific user"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, email, first_name, last_name, created_at, updated_at FROM users WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, username, email, first_name, last_name, created_at, updated_at FROM users WHERE id = %s", (user_id,))
+            user = cursor.fetchone()
+            cursor.close()
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        return jsonify({
-            'id': user[0],
-            'username': user[1],
-            'email': user[2],
-            'first_name': user[3],
-            'last_name': user[4],
-            'created_at': user[5].isoformat() if user[5] else None,
-            'updated_at': user[6].isoformat() if user[6] else None
-        }), 200
+        return jsonify(user_document(user)), 200
     except Exception as e:
         logger.error(f"Error getting user: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    init_database()
     port = int(os.getenv('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
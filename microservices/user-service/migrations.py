@@ -0,0 +1,48 @@
+"""
+User Service schema migrations
+Run once per deploy with `python migrations.py`, before new pods start
+"""
+
+import logging
+import sys
+
+from common.changes import CREATE_CHANGE_EVENTS
+from common.migrations import Migration, PostgresMigrator, create_index_concurrently, sql
+
+COMPONENT = 'user-service'
+
+MIGRATIONS = [
+    Migration(1, 'create users table', sql("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            first_name VARCHAR(100),
+            last_name VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)),
+    # Serves the (created_at, id) keyset in get_users and the export
+    Migration(2, 'index users by created_at',
+              create_index_concurrently('idx_users_created_at_id', 'users', 'created_at, id'),
+              transactional=False),
+    # Outbox read by /api/users/changes; shared with order-service
+    Migration(3, 'create change_events table', CREATE_CHANGE_EVENTS),
+]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    from app import DB_CONFIG
+    try:
+        version = PostgresMigrator(DB_CONFIG, COMPONENT, MIGRATIONS).migrate()
+    except Exception as e:
+        logging.error(f"Migration failed: {str(e)}")
+        return 1
+    logging.info(f"{COMPONENT} schema at version {version}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())